@@ -0,0 +1,263 @@
+"""
+Load test for the public hot paths and the analytics endpoints.
+
+Seeds a database with users, pages, links and click/view/share events
+(generate_data.py: Zipf-skewed popularity, daily seasonality), then
+drives the app in-process over ASGI (httpx.ASGITransport: no network, no
+uvicorn) at a configurable concurrency and reports throughput and
+p50/p95/p99 latency per scenario. The numbers cover the app and the
+database only; use it to compare code changes, not to size servers.
+
+Database:
+    --mongo URL       a local mongod (a throwaway database is created and dropped)
+    (default)         mongomock_motor in-memory stand-in, if installed; it has
+                      no time-series collections, no query planner and no
+                      command monitoring (no db q/req column), and its
+                      aggregations are slow Python loops - keep the dataset
+                      small and only compare it with itself
+
+Regression gate: results are stored per database backend in
+hot_paths_baseline.json. --check fails if a scenario's p95 grew or its
+throughput dropped by more than --tolerance.
+
+Usage (from backend/):
+    python benchmarks/bench_hot_paths.py [--requests 1000] [--concurrency 32]
+    python benchmarks/bench_hot_paths.py --mongo mongodb://127.0.0.1:27017 --check
+    python benchmarks/bench_hot_paths.py --save
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from generate_data import DatasetSpec, generate  # noqa: E402
+
+BASELINE_PATH = Path(__file__).resolve().parent / "hot_paths_baseline.json"
+BROWSER_UA = "Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) AppleWebKit/605.1.15 Mobile/15E148 Safari/604.1"
+PREVIEW_BOT_UA = "TelegramBot (like TwitterBot)"
+# Aggregation-heavy admin/owner views: far fewer requests per run than the public hot paths
+ANALYTICS_SCENARIOS = {"page_analytics", "global_analytics"}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo", help="MongoDB URL of a local mongod (default: mongomock stand-in)")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--pages-per-user", type=int, default=4)
+    parser.add_argument("--links-per-page", type=int, default=6)
+    parser.add_argument("--events-per-page", type=int, default=25, help="average seeded clicks and views per page")
+    parser.add_argument("--requests", type=int, default=1000, help="requests per hot-path scenario")
+    parser.add_argument("--analytics-requests", type=int, default=100, help="requests per analytics scenario")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--scenario", action="append", help="run only these scenarios (repeatable)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", action="store_true", help="store the results as the baseline for this backend")
+    parser.add_argument("--check", action="store_true", help="exit 1 on regression against the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.3, help="allowed p95 growth / throughput drop (0.3 = 30%%)")
+    return parser.parse_args()
+
+
+def configure_environment(args) -> str:
+    """Environment server.py reads at import time; returns the backend name"""
+    os.environ["MONGO_URL"] = args.mongo or "mongodb://localhost:27017"
+    os.environ["DB_NAME"] = f"bench_{uuid.uuid4().hex[:8]}"
+    os.environ.setdefault("JWT_SECRET", "benchmark-secret-benchmark-secret-0000")
+    os.environ.setdefault("OWNER_EMAIL", "owner@example.com")
+    os.environ["RATE_LIMIT_BACKEND"] = "memory"
+    os.environ["APP_ENV"] = "benchmark"  # X-DB-Queries headers
+    if args.mongo:
+        return "mongod"
+
+    try:
+        import mongomock_motor
+        import motor.motor_asyncio
+    except ImportError:
+        sys.exit("mongomock_motor is not installed: pip install mongomock-motor, or pass --mongo URL")
+    motor.motor_asyncio.AsyncIOMotorClient = mongomock_motor.AsyncMongoMockClient
+    return "mongomock"
+
+
+async def seed(server, args, rng: random.Random) -> dict:
+    """Insert the dataset; returns ids the scenarios pick from, most popular first"""
+    pages = args.users * args.pages_per_user
+    spec = DatasetSpec(
+        users=args.users, pages_per_user=args.pages_per_user, links_per_page=args.links_per_page,
+        clicks=pages * args.events_per_page, views=pages * args.events_per_page,
+        shares=pages * args.events_per_page // 5, days=30
+    )
+    dataset = await generate(server, spec, rng)
+    await server.load_routing_table()
+    return {
+        "slugs": [p["slug"] for p in dataset["pages"]],
+        "page_ids": [p["id"] for p in dataset["pages"]],
+        "link_ids": [link["id"] for p in dataset["pages"] for link in dataset["links"][p["id"]]],
+        "owner_tokens": {p["id"]: server.create_token(p["user_id"], "user") for p in dataset["pages"]},
+        "user_tokens": [server.create_token(u["id"], "user") for u in dataset["users"]],
+        "events": sum(dataset["events"].values()),
+    }
+
+
+def random_ip(rng: random.Random) -> str:
+    return f"10.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}"
+
+
+def build_scenarios(data: dict, rng: random.Random) -> dict:
+    """name -> function returning (method, url, headers) for one request"""
+    def pick_zipf(items):
+        # Popular releases get most of the traffic
+        return items[min(int(rng.paretovariate(1.2)) - 1, len(items) - 1)]
+
+    def browser():
+        return {"user-agent": BROWSER_UA, "x-forwarded-for": random_ip(rng)}
+
+    def artist_page():
+        return "GET", f"/api/artist/{pick_zipf(data['slugs'])}", browser()
+
+    def click():
+        return "GET", f"/api/click/{pick_zipf(data['link_ids'])}", browser()
+
+    def track_view():
+        return "POST", f"/api/track/view/{pick_zipf(data['page_ids'])}", browser()
+
+    def share_link_bot():
+        return "GET", f"/api/s/{pick_zipf(data['slugs'])}", {"user-agent": PREVIEW_BOT_UA}
+
+    def page_analytics():
+        page_id = rng.choice(data["page_ids"])
+        return "GET", f"/api/analytics/{page_id}", {"authorization": f"Bearer {data['owner_tokens'][page_id]}"}
+
+    def global_analytics():
+        return "GET", "/api/analytics/global/summary", {"authorization": f"Bearer {rng.choice(data['user_tokens'])}"}
+
+    return {
+        "artist_page": artist_page,
+        "click": click,
+        "track_view": track_view,
+        "share_link_bot": share_link_bot,
+        "page_analytics": page_analytics,
+        "global_analytics": global_analytics,
+    }
+
+
+async def run_scenario(client, make_request, total: int, concurrency: int, count_queries: bool) -> dict:
+    latencies = []
+    db_queries = []
+    errors = 0
+    remaining = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            method, url, headers = make_request()
+            started = time.perf_counter()
+            response = await client.request(method, url, headers=headers)
+            latencies.append((time.perf_counter() - started) * 1000)
+            if response.status_code >= 400:
+                errors += 1
+            if count_queries and "x-db-queries" in response.headers:
+                db_queries.append(int(response.headers["x-db-queries"]))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    quantiles = statistics.quantiles(latencies, n=100)
+    return {
+        "requests": total,
+        "errors": errors,
+        "rps": round(total / elapsed, 1),
+        "p50_ms": round(quantiles[49], 2),
+        "p95_ms": round(quantiles[94], 2),
+        "p99_ms": round(quantiles[98], 2),
+        "db_queries_avg": round(statistics.mean(db_queries), 2) if db_queries else None,
+    }
+
+
+def check(results: dict, baseline: dict, tolerance: float) -> list:
+    problems = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            problems.append(f"{name}: p95 {result['p95_ms']}ms vs baseline {base['p95_ms']}ms")
+        if result["rps"] < base["rps"] * (1 - tolerance):
+            problems.append(f"{name}: {result['rps']} req/s vs baseline {base['rps']} req/s")
+        if result["errors"] > base["errors"]:
+            problems.append(f"{name}: {result['errors']} errors vs baseline {base['errors']}")
+    return problems
+
+
+async def main():
+    args = parse_args()
+    backend = configure_environment(args)
+    rng = random.Random(args.seed)
+
+    import httpx
+    import server
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    if backend == "mongod":
+        await server.ensure_event_collections()
+        await server.ensure_indexes()
+
+    try:
+        seed_started = time.perf_counter()
+        data = await seed(server, args, rng)
+        pages = len(data["page_ids"])
+        print(f"[{backend}] seeded {args.users} users, {pages} pages, {len(data['link_ids'])} links, "
+              f"{data['events']} events in {time.perf_counter() - seed_started:.1f}s")
+
+        scenarios = build_scenarios(data, rng)
+        selected = args.scenario or list(scenarios)
+        transport = httpx.ASGITransport(app=server.app)
+        results = {}
+        async with httpx.AsyncClient(transport=transport, base_url=f"http://{server.MAIN_DOMAIN}") as client:
+            print(f"{'scenario':<18} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7} {'db q/req':>9}")
+            for name in selected:
+                count_queries = backend == "mongod"
+                total = args.analytics_requests if name in ANALYTICS_SCENARIOS else args.requests
+                await run_scenario(client, scenarios[name], min(20, total), args.concurrency, count_queries)  # warm-up
+                result = await run_scenario(client, scenarios[name], total, args.concurrency, count_queries)
+                results[name] = result
+                db_q = "-" if result["db_queries_avg"] is None else result["db_queries_avg"]
+                print(f"{name:<18} {result['rps']:>9} {result['p50_ms']:>8} {result['p95_ms']:>8} "
+                      f"{result['p99_ms']:>8} {result['errors']:>7} {db_q:>9}")
+    finally:
+        await server.flush_page_views()
+        await server.client.drop_database(os.environ["DB_NAME"])
+        server._image_executor.shutdown(wait=False)
+
+    baselines = json.loads(BASELINE_PATH.read_text()) if BASELINE_PATH.exists() else {}
+    if args.save:
+        baselines[backend] = {
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "analytics_requests": args.analytics_requests,
+            "python": sys.version.split()[0],
+            "scenarios": {**baselines.get(backend, {}).get("scenarios", {}), **results},
+        }
+        BASELINE_PATH.write_text(json.dumps(baselines, indent=2) + "\n")
+        print(f"baseline for {backend} saved to {BASELINE_PATH.name}")
+    elif backend in baselines:
+        problems = check(results, baselines[backend]["scenarios"], args.tolerance)
+        for problem in problems:
+            print(f"REGRESSION {problem}")
+        if problems and args.check:
+            sys.exit(1)
+        if not problems:
+            print(f"no regressions against the {backend} baseline (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,143 @@
+"""
+Per-request overhead of the Subdomain/OG middleware stack.
+
+Compares the previous BaseHTTPMiddleware implementation against the current
+raw ASGI middleware by driving a trivial endpoint directly through the ASGI
+interface (no network, no database).
+
+Usage (from backend/):
+    python benchmarks/bench_middleware.py [--requests 20000]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# server.py requires these at import time; the benchmark never touches the DB
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "benchmark")
+os.environ.setdefault("JWT_SECRET", "benchmark")
+os.environ.setdefault("OWNER_EMAIL", "owner@example.com")
+
+from starlette.applications import Starlette  # noqa: E402
+from starlette.middleware.base import BaseHTTPMiddleware  # noqa: E402
+from starlette.requests import Request  # noqa: E402
+from starlette.responses import PlainTextResponse  # noqa: E402
+from starlette.routing import Route  # noqa: E402
+
+import server  # noqa: E402
+
+
+class LegacySubdomainMiddleware(BaseHTTPMiddleware):
+    """Previous implementation, kept here only as the benchmark baseline"""
+    async def dispatch(self, request: Request, call_next):
+        host = request.headers.get("host", "").split(":")[0].lower()
+        subdomain = request.headers.get("x-subdomain", "").lower().strip()
+        if not subdomain and host:
+            if host.endswith(f".{server.MAIN_DOMAIN}"):
+                subdomain = host.replace(f".{server.MAIN_DOMAIN}", "")
+            elif host == server.MAIN_DOMAIN or host == f"www.{server.MAIN_DOMAIN}":
+                subdomain = ""
+        request.state.subdomain = subdomain if subdomain and subdomain != "www" else ""
+        return await call_next(request)
+
+
+class LegacyOGBotMiddleware(BaseHTTPMiddleware):
+    """Previous implementation (non-bot path), kept only as the benchmark baseline"""
+    async def dispatch(self, request: Request, call_next):
+        path = request.url.path
+        if path.startswith('/api') or '.' in path.split('/')[-1]:
+            return await call_next(request)
+        slug = path.lstrip('/')
+        if not slug or '/' in slug:
+            return await call_next(request)
+        if not server.is_bot(request.headers.get('user-agent', '')):
+            return await call_next(request)
+        return await call_next(request)
+
+
+async def endpoint(request: Request):
+    return PlainTextResponse(getattr(request.state, "subdomain", "") or "-")
+
+
+def build_app(middlewares):
+    app = Starlette(routes=[Route("/api/ping", endpoint), Route("/{slug}", endpoint)])
+    for middleware in middlewares:
+        app.add_middleware(middleware)
+    return app
+
+
+def make_scope(path: str) -> dict:
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "https",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [
+            (b"host", f"music.{server.MAIN_DOMAIN}".encode()),
+            (b"user-agent", b"Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36"),
+            (b"accept", b"*/*"),
+        ],
+        "client": ("127.0.0.1", 50000),
+        "server": ("127.0.0.1", 8001),
+    }
+
+
+async def request_once(app, path: str):
+    body_sent = False
+
+    async def receive():
+        nonlocal body_sent
+        if not body_sent:
+            body_sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        # Like a real server: block until the client disconnects (never, here)
+        await asyncio.Event().wait()
+
+    async def send(message):
+        pass
+
+    await app(make_scope(path), receive, send)
+
+
+async def drive(app, path: str, n: int) -> float:
+    # Warm up routing and middleware stack construction
+    for _ in range(200):
+        await request_once(app, path)
+
+    start = time.perf_counter()
+    for _ in range(n):
+        await request_once(app, path)
+    return (time.perf_counter() - start) / n * 1e6
+
+
+async def main(n: int):
+    variants = {
+        "no middleware": [],
+        "BaseHTTPMiddleware (before)": [LegacySubdomainMiddleware, LegacyOGBotMiddleware],
+        "raw ASGI (after)": [server.SubdomainMiddleware, server.OGBotMiddleware],
+    }
+    for path in ("/api/ping", "/artist-slug"):
+        print(f"\n{path}  ({n} requests)")
+        baseline = None
+        for name, middlewares in variants.items():
+            per_request = await drive(build_app(middlewares), path, n)
+            if baseline is None:
+                baseline = per_request
+            print(f"  {name:<30} {per_request:8.1f} us/req   overhead {per_request - baseline:7.1f} us")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=20000)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests))
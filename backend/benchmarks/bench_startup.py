@@ -0,0 +1,146 @@
+"""
+Cold-start cost of `import server`, measured with `python -X importtime`.
+
+Each run imports server.py in a fresh interpreter and parses the importtime
+report: total import time, server.py's own module body (route registration),
+the heaviest direct dependencies, and whether any module that is meant to be
+imported lazily (PIL, resend, psutil, pyarrow, httpx) got loaded eagerly again.
+
+Results are compared against startup_baseline.json so regressions show up in
+review. Absolute numbers are machine-specific: re-record the baseline with
+--save when moving to different hardware.
+
+Usage (from backend/):
+    python benchmarks/bench_startup.py [--runs 7] [--top 15]
+    python benchmarks/bench_startup.py --check      # exit 1 on regression
+    python benchmarks/bench_startup.py --save       # record a new baseline
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+BASELINE_PATH = Path(__file__).resolve().parent / "startup_baseline.json"
+
+# Must not be imported by `import server`; they load on first use
+LAZY_MODULES = ("PIL", "resend", "psutil", "pyarrow", "httpx")
+
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def import_once() -> dict:
+    """Import server.py in a fresh interpreter and parse its importtime report"""
+    env = {
+        **os.environ,
+        # server.py requires these at import time; nothing connects to MongoDB
+        "MONGO_URL": os.environ.get("MONGO_URL", "mongodb://localhost:27017"),
+        "DB_NAME": os.environ.get("DB_NAME", "benchmark"),
+        "JWT_SECRET": os.environ.get("JWT_SECRET", "benchmark"),
+        "OWNER_EMAIL": os.environ.get("OWNER_EMAIL", "owner@example.com"),
+    }
+    started = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import server"],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True
+    )
+    wall_ms = (time.perf_counter() - started) * 1000
+    if proc.returncode != 0:
+        raise RuntimeError(f"import server failed:\n{proc.stderr[-2000:]}")
+
+    modules = {}
+    direct_deps = {}
+    for line in proc.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        modules[name] = (int(self_us), int(cumulative_us))
+        # importtime indents by nesting depth: " server", "   its imports", ...
+        # and prints children before their parent, so depth-1 lines seen before
+        # another top-level import (site, usercustomize) are not server's
+        if len(indent) == 3:
+            direct_deps[name] = int(cumulative_us)
+        elif len(indent) == 1 and name != "server":
+            direct_deps.clear()
+
+    server_self, server_total = modules["server"]
+    return {
+        "wall_ms": wall_ms,
+        "import_ms": server_total / 1000,
+        "server_body_ms": server_self / 1000,
+        "direct_deps_ms": {name: us / 1000 for name, us in direct_deps.items()},
+        "eager_lazy_modules": sorted(
+            name for name in modules if name.split(".")[0] in LAZY_MODULES
+        ),
+    }
+
+
+def summarize(runs: list, top: int) -> dict:
+    deps = {}
+    for run in runs:
+        for name, ms in run["direct_deps_ms"].items():
+            deps.setdefault(name, []).append(ms)
+    heaviest = sorted(((statistics.median(v), k) for k, v in deps.items()), reverse=True)[:top]
+    return {
+        "runs": len(runs),
+        "python": sys.version.split()[0],
+        "wall_ms": round(statistics.median(r["wall_ms"] for r in runs), 1),
+        "import_ms": round(statistics.median(r["import_ms"] for r in runs), 1),
+        "server_body_ms": round(statistics.median(r["server_body_ms"] for r in runs), 1),
+        "heaviest_deps_ms": {name: round(ms, 1) for ms, name in heaviest},
+        "eager_lazy_modules": sorted({m for r in runs for m in r["eager_lazy_modules"]}),
+    }
+
+
+def check(result: dict, baseline: dict, tolerance: float) -> list:
+    problems = []
+    for key in ("import_ms", "server_body_ms"):
+        limit = baseline[key] * (1 + tolerance)
+        if result[key] > limit:
+            problems.append(f"{key}: {result[key]}ms > {limit:.1f}ms (baseline {baseline[key]}ms +{tolerance:.0%})")
+    if result["eager_lazy_modules"]:
+        problems.append(f"lazily imported modules loaded at import time: {', '.join(result['eager_lazy_modules'][:10])}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=7)
+    parser.add_argument("--top", type=int, default=15, help="heaviest direct dependencies to list")
+    parser.add_argument("--save", action="store_true", help="write the result as the new baseline")
+    parser.add_argument("--check", action="store_true", help="exit 1 if slower than the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown for --check (0.25 = 25%%)")
+    args = parser.parse_args()
+
+    import_once()  # warm the filesystem / bytecode caches
+    result = summarize([import_once() for _ in range(args.runs)], args.top)
+
+    print(f"import server: {result['import_ms']:.1f} ms "
+          f"(module body {result['server_body_ms']:.1f} ms, process wall {result['wall_ms']:.1f} ms, "
+          f"median of {result['runs']})")
+    print("heaviest direct imports:")
+    for name, ms in result["heaviest_deps_ms"].items():
+        print(f"  {ms:>8.1f} ms  {name}")
+
+    if BASELINE_PATH.exists() and not args.save:
+        baseline = json.loads(BASELINE_PATH.read_text())
+        print(f"baseline: import {baseline['import_ms']} ms, module body {baseline['server_body_ms']} ms")
+        problems = check(result, baseline, args.tolerance)
+        for problem in problems:
+            print(f"REGRESSION {problem}")
+        if problems and args.check:
+            sys.exit(1)
+
+    if args.save:
+        BASELINE_PATH.write_text(json.dumps(result, indent=2) + "\n")
+        print(f"baseline saved to {BASELINE_PATH.name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+"""
+Synthetic dataset generator for scale testing.
+
+Fills a database with users, pages, links and click/view/share events in
+the shapes server.py writes, at volumes the analytics and admin endpoints
+see in production (millions of events), with realistic skew:
+
+- release popularity is Zipfian: the rank-k page gets traffic ~ 1/k^s
+  (--zipf), and within a page the first links take most of the clicks
+- countries follow COUNTRY_WEIGHTS (mostly Russia and neighbours)
+- timestamps follow a daily cycle (HOURLY_WEIGHTS, quiet at night, peak in
+  the evening, Moscow time) and a weekly one (busier weekends) over --days
+
+Events are generated and inserted in insert_many batches of --batch-size, so
+memory stays flat however many are requested. Page/link counters (views,
+clicks, shares, qr_scans) are set from the generated events, so the cached
+counters and the event collections agree.
+
+The generate() coroutine is reused by bench_hot_paths.py for its seed data.
+
+Usage (from backend/):
+    python benchmarks/generate_data.py --mongo mongodb://127.0.0.1:27017 --db muslink_scale \\
+        --users 5000 --clicks 5000000 --views 10000000 --shares 500000
+    python benchmarks/generate_data.py --mongo ... --db ... --drop   # replace an existing dataset
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import sys
+import time
+import uuid
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+PLATFORMS = ["spotify", "apple", "yandex", "vk", "youtube", "deezer", "soundcloud", "tidal"]
+COUNTRY_WEIGHTS = {
+    "Россия": 62, "Казахстан": 8, "Беларусь": 6, "Украина": 5, "Узбекистан": 3,
+    "Германия": 3, "США": 2, "Армения": 2, "Грузия": 1, "Неизвестно": 8,
+}
+COUNTRY_CITIES = {
+    "Россия": ["Москва", "Санкт-Петербург", "Новосибирск", "Екатеринбург", "Казань"],
+    "Казахстан": ["Алматы", "Астана"],
+    "Беларусь": ["Минск"],
+    "Украина": ["Киев", "Харьков"],
+}
+# Relative traffic per hour of the day, Moscow time (UTC+3)
+HOURLY_WEIGHTS = [
+    3, 2, 1.5, 1, 1, 1, 1.5, 2.5, 4, 5, 5.5, 6,
+    6.5, 6.5, 6.5, 7, 7.5, 8, 9, 10, 10.5, 10, 8, 5,
+]
+WEEKDAY_WEIGHTS = [0.9, 0.9, 0.95, 1.0, 1.1, 1.25, 1.2]  # Monday..Sunday
+AUDIENCE_UTC_OFFSET_HOURS = 3
+SHARE_TYPE_WEIGHTS = {"link": 60, "social": 25, "qr": 15}
+REFERRERS = [None, None, None, "instagram.com", "vk.com", "t.me", "tiktok.com", "youtube.com"]
+
+
+@dataclass
+class DatasetSpec:
+    users: int = 1000
+    pages_per_user: int = 5
+    links_per_page: int = 6
+    clicks: int = 100_000
+    views: int = 200_000
+    shares: int = 10_000
+    days: int = 90
+    zipf: float = 1.1
+    batch_size: int = 10_000
+
+
+def zipf_cum_weights(n: int, s: float) -> list:
+    """Cumulative weights for rank 1..n with P(k) ~ 1/k^s"""
+    return list(itertools.accumulate(1 / k ** s for k in range(1, n + 1)))
+
+
+class EventClock:
+    """Samples event timestamps following the daily and weekly traffic cycle"""
+
+    def __init__(self, now: datetime, days: int, rng: random.Random):
+        self.rng = rng
+        start = (now - timedelta(days=days)).replace(minute=0, second=0, microsecond=0)
+        local = timedelta(hours=AUDIENCE_UTC_OFFSET_HOURS)
+        self.slots = []
+        weights = []
+        slot = start
+        while slot < now:
+            local_slot = slot + local
+            self.slots.append(slot)
+            weights.append(HOURLY_WEIGHTS[local_slot.hour] * WEEKDAY_WEIGHTS[local_slot.weekday()])
+            slot += timedelta(hours=1)
+        self.cum_weights = list(itertools.accumulate(weights))
+        self.now = now
+
+    def sample(self, k: int) -> list:
+        hours = self.rng.choices(self.slots, cum_weights=self.cum_weights, k=k)
+        return [min(hour + timedelta(seconds=self.rng.random() * 3600), self.now) for hour in hours]
+
+
+def build_catalog(spec: DatasetSpec, now: datetime, rng: random.Random):
+    """Users, pages (ordered by popularity rank) and links per page"""
+    created = now - timedelta(days=spec.days)
+    users, pages, links = [], [], {}
+    for u in range(spec.users):
+        user_id = str(uuid.uuid4())
+        verified = rng.random() < 0.1
+        users.append({
+            "id": user_id,
+            "email": f"synthetic{u}@example.com",
+            "username": f"synthetic{u}",
+            "password_hash": "!",  # no login
+            "role": "user",
+            "status": "active",
+            "plan": rng.choices(["free", "pro"], weights=[80, 20])[0],
+            "is_verified": verified,
+            "is_banned": False,
+            "verified": verified,
+            "verification_status": "approved" if verified else "none",
+            "show_verification_badge": True,
+            "created_at": created.isoformat()
+        })
+        for p in range(spec.pages_per_user):
+            page_id = str(uuid.uuid4())
+            pages.append({
+                "id": page_id,
+                "user_id": user_id,
+                "title": f"Release {u}-{p}",
+                "slug": f"synthetic-{u}-{p}",
+                "artist_name": f"Artist {u}",
+                "release_title": f"Release {u}-{p}",
+                "description": "",
+                "cover_image": "",
+                "background_image": "",
+                "status": "active",
+                "views": 0,
+                "qr_enabled": True,
+                "page_theme": "dark",
+                "created_at": created.isoformat()
+            })
+            platforms = rng.sample(PLATFORMS, min(spec.links_per_page, len(PLATFORMS)))
+            links[page_id] = [{
+                "id": str(uuid.uuid4()),
+                "page_id": page_id,
+                "platform": platform,
+                "url": f"https://example.com/{platform}/{page_id}",
+                "active": True,
+                "order": order,
+                "clicks": 0,
+                "created_at": created.isoformat()
+            } for order, platform in enumerate(platforms)]
+    # Popularity does not follow the owner: rank the pages at random
+    rng.shuffle(pages)
+    return users, pages, links
+
+
+def geo(rng: random.Random, countries: list, country_weights: list):
+    country = rng.choices(countries, cum_weights=country_weights)[0]
+    cities = COUNTRY_CITIES.get(country)
+    return country, rng.choice(cities) if cities else "Неизвестно"
+
+
+async def insert_events(server, collection: str, total: int, spec: DatasetSpec, make_doc, pages: list,
+                        clock: EventClock, rng: random.Random, progress=None) -> int:
+    """Generate `total` events in insert_many batches; make_doc(page, timestamp) builds one"""
+    if total <= 0:
+        return 0
+    page_weights = zipf_cum_weights(len(pages), spec.zipf)
+    inserted = 0
+    while inserted < total:
+        k = min(spec.batch_size, total - inserted)
+        batch_pages = rng.choices(pages, cum_weights=page_weights, k=k)
+        docs = [make_doc(page, at) for page, at in zip(batch_pages, clock.sample(k))]
+        await server.db[collection].insert_many(docs, ordered=False)
+        inserted += k
+        if progress:
+            progress(collection, inserted, total)
+    return inserted
+
+
+async def generate(server, spec: DatasetSpec, rng: random.Random, progress=None) -> dict:
+    """
+    Insert a synthetic dataset through server.db and return what callers pick from:
+    users, pages in popularity order (most visited first) and links per page id.
+    """
+    now = datetime.now(timezone.utc)
+    users, pages, links = build_catalog(spec, now, rng)
+    clock = EventClock(now, spec.days, rng)
+    countries = list(COUNTRY_WEIGHTS)
+    country_weights = list(itertools.accumulate(COUNTRY_WEIGHTS.values()))
+    share_types = list(SHARE_TYPE_WEIGHTS)
+    share_weights = list(itertools.accumulate(SHARE_TYPE_WEIGHTS.values()))
+    link_weights = {n: zipf_cum_weights(n, 1.0) for n in {len(page_links) for page_links in links.values()}}
+
+    views, clicks, shares = Counter(), Counter(), Counter()
+
+    def click_doc(page, at):
+        page_links = links[page["id"]]
+        link = rng.choices(page_links, cum_weights=link_weights[len(page_links)])[0]
+        clicks[link["id"]] += 1
+        country, city = geo(rng, countries, country_weights)
+        return server.event_doc(
+            {"page_id": page["id"], "link_id": link["id"]}, at,
+            id=str(uuid.uuid4()), referrer=rng.choice(REFERRERS), country=country, city=city, source="link"
+        )
+
+    def view_doc(page, at):
+        views[page["id"]] += 1
+        country, city = geo(rng, countries, country_weights)
+        return server.event_doc(
+            {"page_id": page["id"]}, at,
+            id=str(uuid.uuid4()), country=country, city=city, source="direct"
+        )
+
+    def share_doc(page, at):
+        share_type = rng.choices(share_types, cum_weights=share_weights)[0]
+        shares[(page["id"], share_type)] += 1
+        country, city = geo(rng, countries, country_weights)
+        return server.event_doc(
+            {"page_id": page["id"]}, at,
+            id=str(uuid.uuid4()), type=share_type, country=country, city=city
+        )
+
+    events = {
+        "view_events": await insert_events(server, "view_events", spec.views, spec, view_doc, pages, clock, rng, progress),
+        "click_events": await insert_events(server, "click_events", spec.clicks, spec, click_doc, pages, clock, rng, progress),
+        "share_events": await insert_events(server, "share_events", spec.shares, spec, share_doc, pages, clock, rng, progress),
+    }
+
+    # Counters the pages/links carry next to the event collections
+    for page in pages:
+        page["views"] = views[page["id"]]
+        page["qr_scans"] = shares[(page["id"], "qr")]
+        page_shares = 0
+        for share_type in ("link", "social"):
+            page[f"shares_{share_type}"] = shares[(page["id"], share_type)]
+            page_shares += page[f"shares_{share_type}"]
+        page["shares"] = page_shares
+        for link in links[page["id"]]:
+            link["clicks"] = clicks[link["id"]]
+
+    all_links = [link for page_links in links.values() for link in page_links]
+    for collection, docs in (("users", users), ("pages", pages), ("links", all_links)):
+        for start in range(0, len(docs), spec.batch_size):
+            await server.db[collection].insert_many(docs[start:start + spec.batch_size], ordered=False)
+
+    return {"users": users, "pages": pages, "links": links, "events": events}
+
+
+def parse_args():
+    defaults = DatasetSpec()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo", default=os.environ.get("MONGO_URL"), help="MongoDB URL (default: $MONGO_URL)")
+    parser.add_argument("--db", required=True, help="database to fill")
+    parser.add_argument("--drop", action="store_true", help="drop the database first")
+    parser.add_argument("--users", type=int, default=defaults.users)
+    parser.add_argument("--pages-per-user", type=int, default=defaults.pages_per_user)
+    parser.add_argument("--links-per-page", type=int, default=defaults.links_per_page)
+    parser.add_argument("--clicks", type=int, default=defaults.clicks)
+    parser.add_argument("--views", type=int, default=defaults.views)
+    parser.add_argument("--shares", type=int, default=defaults.shares)
+    parser.add_argument("--days", type=int, default=defaults.days, help="spread events over the last N days")
+    parser.add_argument("--zipf", type=float, default=defaults.zipf, help="popularity skew exponent s")
+    parser.add_argument("--batch-size", type=int, default=defaults.batch_size, help="documents per insert_many")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    if not args.mongo:
+        parser.error("--mongo or MONGO_URL is required")
+    return args
+
+
+async def main():
+    args = parse_args()
+    # server.py reads these at import time
+    os.environ["MONGO_URL"] = args.mongo
+    os.environ["DB_NAME"] = args.db
+    os.environ.setdefault("JWT_SECRET", "synthetic-data")
+    os.environ.setdefault("OWNER_EMAIL", "owner@example.com")
+    import server
+
+    if args.drop:
+        await server.client.drop_database(args.db)
+    elif await server.db.pages.estimated_document_count():
+        sys.exit(f"{args.db} already has pages; pass --drop to replace them")
+    await server.ensure_event_collections()
+    await server.ensure_indexes()
+
+    spec = DatasetSpec(
+        users=args.users, pages_per_user=args.pages_per_user, links_per_page=args.links_per_page,
+        clicks=args.clicks, views=args.views, shares=args.shares,
+        days=args.days, zipf=args.zipf, batch_size=args.batch_size
+    )
+    started = time.perf_counter()
+    last_report = [started]
+
+    def progress(collection, inserted, total):
+        if inserted == total or time.perf_counter() - last_report[0] > 5:
+            last_report[0] = time.perf_counter()
+            elapsed = last_report[0] - started
+            print(f"  {collection}: {inserted:,}/{total:,} ({elapsed:.0f}s)", flush=True)
+
+    result = await generate(server, spec, random.Random(args.seed), progress)
+    elapsed = time.perf_counter() - started
+    total_events = sum(result["events"].values())
+    print(f"{args.db}: {len(result['users']):,} users, {len(result['pages']):,} pages, "
+          f"{sum(len(v) for v in result['links'].values()):,} links, {total_events:,} events "
+          f"in {elapsed:.1f}s ({total_events / elapsed:,.0f} events/s)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,10 +1,12 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Query, Header, Request
+from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Query, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import RedirectResponse, FileResponse, JSONResponse, HTMLResponse
+from fastapi.responses import RedirectResponse, FileResponse, JSONResponse, Response, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.background import BackgroundTask
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ReturnDocument, monitoring
+from pymongo.errors import CollectionInvalid, DuplicateKeyError, OperationFailure
 import os
 import logging
 import re
@@ -16,20 +18,91 @@ from datetime import datetime, timezone, timedelta
 import jwt
 import bcrypt
 import base64
-from PIL import Image, ImageFilter
 import aiofiles
 import io
-import httpx
-import resend
+import csv
+import json
+import zlib
+import zipfile
+import tempfile
 import asyncio
 import secrets
+import hashlib
+import time
+import sys
+import threading
+import traceback
+import contextvars
+import math
+import ipaddress
+import socket
+from collections import Counter, OrderedDict, defaultdict, deque
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# MongoDB command accounting: PerfMiddleware puts a RequestDbStats in this
+# context var; Motor copies the context into its executor threads, so the
+# listener attributes each command to the request that issued it.
+class RequestDbStats:
+    __slots__ = ("roundtrips", "time_ms", "shapes")
+    
+    def __init__(self):
+        self.roundtrips = 0
+        self.time_ms = 0.0
+        self.shapes = {}  # query shape -> times issued in this request
+
+# Commands that continue an earlier query rather than issue a new one
+CURSOR_COMMANDS = {"getMore", "killCursors"}
+
+def _value_shape(value) -> str:
+    if isinstance(value, dict):
+        return "{" + ",".join(f"{k}:{_value_shape(v)}" for k, v in sorted(value.items())) + "}"
+    if isinstance(value, list):
+        return "[" + (_value_shape(value[0]) if value else "") + "]"
+    return "?"
+
+def query_shape(command_name: str, command) -> str:
+    """Command, collection and filter with literal values stripped, e.g. `find users {id:?}`"""
+    spec = None
+    if command_name == "find":
+        spec = command.get("filter")
+    elif command_name == "aggregate":
+        pipeline = command.get("pipeline") or [{}]
+        spec = pipeline[0].get("$match", {"stage": list(pipeline[0])[:1]})
+    elif command_name in ("count", "distinct", "findAndModify"):
+        spec = command.get("query")
+    elif command_name in ("update", "delete"):
+        statements = command.get("updates" if command_name == "update" else "deletes") or [{}]
+        spec = statements[0].get("q")
+    return f"{command_name} {command.get(command_name)} {_value_shape(spec) if spec is not None else ''}".rstrip()
+
+_request_db_stats = contextvars.ContextVar("request_db_stats", default=None)
+_db_command_counts = defaultdict(int)
+
+class DbCommandListener(monitoring.CommandListener):
+    def started(self, event):
+        _db_command_counts[event.command_name] += 1
+        stats = _request_db_stats.get()
+        if stats is not None:
+            stats.roundtrips += 1
+            if event.command_name not in CURSOR_COMMANDS:
+                shape = query_shape(event.command_name, event.command)
+                stats.shapes[shape] = stats.shapes.get(shape, 0) + 1
+    
+    def succeeded(self, event):
+        stats = _request_db_stats.get()
+        if stats is not None:
+            stats.time_ms += event.duration_micros / 1000
+    
+    def failed(self, event):
+        self.succeeded(event)
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[DbCommandListener()])
 db = client[os.environ['DB_NAME']]
 
 # JWT Config
@@ -40,8 +113,12 @@ JWT_EXPIRATION_HOURS = 24
 # Resend Config
 RESEND_API_KEY = os.environ.get('RESEND_API_KEY')
 SENDER_EMAIL = os.environ.get('SENDER_EMAIL', 'onboarding@resend.dev')
-if RESEND_API_KEY:
+
+async def send_email(params: dict):
+    """Send through Resend off the event loop (resend is imported on first use, it is slow to load)"""
+    import resend
     resend.api_key = RESEND_API_KEY
+    return await asyncio.to_thread(resend.Emails.send, params)
 
 # Frontend URL for reset links
 FRONTEND_URL = os.environ.get('FRONTEND_URL', 'http://localhost:3000')
@@ -54,6 +131,10 @@ UPLOAD_DIR.mkdir(exist_ok=True)
 COVERS_DIR = UPLOAD_DIR / 'covers'
 COVERS_DIR.mkdir(exist_ok=True)
 
+# Rendered Open Graph cards directory
+OG_CARDS_DIR = UPLOAD_DIR / 'og'
+OG_CARDS_DIR.mkdir(exist_ok=True)
+
 # ===================== RBAC CONFIGURATION =====================
 
 # Owner email - gets automatic owner role
@@ -103,6 +184,7 @@ _geo_cache = {}
 
 async def get_geo_from_ip(ip: str) -> dict:
     """Get country and city from IP address using ip-api.com (free, no key needed)"""
+    import httpx
     # Return cached result if exists
     if ip in _geo_cache:
         return _geo_cache[ip]
@@ -150,25 +232,229 @@ def get_client_ip(request: Request) -> str:
     
     return ""
 
+# Proxies in front of the app that set X-Forwarded-For (Caddy: 1). Only entries
+# they wrote are trusted; 0 means clients connect directly.
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', '1'))
+
+def get_trusted_client_ip(request: Request) -> str:
+    """
+    Client IP as seen by the outermost trusted proxy. Unlike get_client_ip()
+    it ignores entries the client added to X-Forwarded-For itself, so it can
+    key limits.
+    """
+    if TRUSTED_PROXY_HOPS:
+        hops = [hop.strip() for hop in request.headers.get("X-Forwarded-For", "").split(",") if hop.strip()]
+        if len(hops) >= TRUSTED_PROXY_HOPS:
+            return hops[-TRUSTED_PROXY_HOPS]
+    return request.client.host if request.client else ""
+
+# ===================== RATE LIMITING =====================
+
+# Per-client limits keyed by get_trusted_client_ip(). Two algorithms:
+# - sliding window: weighted count of the current and previous fixed window
+# - token bucket: `limit` burst capacity refilled evenly over `window_seconds`
+# State lives in a pluggable backend: "memory" (per process, bounded LRU) or
+# "mongo" (shared by all workers, expired through a TTL index on rate_limits).
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'mongo')
+RATE_LIMIT_MEMORY_MAX_KEYS = 100_000
+
+class MemoryRateLimitBackend:
+    """In-process rate limit state, bounded to max_keys (least recently used evicted)"""
+    def __init__(self, max_keys: int = RATE_LIMIT_MEMORY_MAX_KEYS):
+        self.max_keys = max_keys
+        self._entries = OrderedDict()
+    
+    def _touch(self, key: str, value: list):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_keys:
+            self._entries.popitem(last=False)
+    
+    async def sliding_window(self, key: str, window_index: int) -> tuple:
+        """Count a hit, return (current_window_count, previous_window_count)"""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < window_index - 1:
+            entry = [window_index, 0, 0]
+        elif entry[0] == window_index - 1:
+            entry = [window_index, 0, entry[1]]
+        entry[1] += 1
+        self._touch(key, entry)
+        return entry[1], entry[2]
+    
+    async def token_bucket(self, key: str, capacity: int, refill_per_second: float, now: float) -> tuple:
+        """Take a token if available, return (allowed, tokens_left)"""
+        entry = self._entries.get(key) or [float(capacity), now]
+        tokens = min(capacity, entry[0] + (now - entry[1]) * refill_per_second)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._touch(key, [tokens, now])
+        return allowed, tokens
+
+class MongoRateLimitBackend:
+    """Rate limit state shared by all workers: one document per key, updated atomically"""
+    def __init__(self, collection):
+        self.collection = collection
+    
+    async def sliding_window(self, key: str, window_index: int, expires_at: datetime) -> tuple:
+        doc = await self.collection.find_one_and_update(
+            {"_id": key},
+            [{"$set": {
+                "prev": {"$switch": {
+                    "branches": [
+                        {"case": {"$eq": ["$window", window_index]}, "then": "$prev"},
+                        {"case": {"$eq": ["$window", window_index - 1]}, "then": "$count"}
+                    ],
+                    "default": 0
+                }},
+                "count": {"$add": [
+                    {"$cond": [{"$eq": ["$window", window_index]}, "$count", 0]},
+                    1
+                ]},
+                "window": window_index,
+                "expires_at": expires_at
+            }}],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return doc["count"], doc.get("prev", 0)
+    
+    async def token_bucket(self, key: str, capacity: int, refill_per_second: float, now: float, expires_at: datetime) -> tuple:
+        doc = await self.collection.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {
+                    "tokens": {"$min": [
+                        capacity,
+                        {"$add": [
+                            {"$ifNull": ["$tokens", capacity]},
+                            {"$multiply": [{"$subtract": [now, {"$ifNull": ["$ts", now]}]}, refill_per_second]}
+                        ]}
+                    ]},
+                    "ts": now,
+                    "expires_at": expires_at
+                }},
+                {"$set": {"allowed": {"$gte": ["$tokens", 1]}}},
+                {"$set": {"tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", 1]}, "$tokens"]}}}
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return doc["allowed"], doc["tokens"]
+
+_memory_rate_limit_backend = MemoryRateLimitBackend()
+_mongo_rate_limit_backend = MongoRateLimitBackend(db.rate_limits)
+
+class RateLimit:
+    """
+    FastAPI dependency enforcing `limit` requests per `window_seconds` per client IP.
+    Usage: @app.post(..., dependencies=[Depends(RateLimit("login", 10, 60))])
+    """
+    def __init__(self, name: str, limit: int, window_seconds: int, algorithm: str = "sliding_window", backend: Optional[str] = None):
+        if algorithm not in ("sliding_window", "token_bucket"):
+            raise ValueError(f"Unknown rate limit algorithm: {algorithm}")
+        self.name = name
+        self.limit = limit
+        self.window_seconds = window_seconds
+        self.algorithm = algorithm
+        self.backend = backend or RATE_LIMIT_BACKEND
+    
+    async def check(self, client_key: str) -> tuple:
+        """Count a hit for client_key, return (allowed, retry_after_seconds)"""
+        key = f"{self.name}:{client_key}"
+        now = time.time()
+        use_mongo = self.backend == "mongo"
+        
+        if self.algorithm == "token_bucket":
+            refill = self.limit / self.window_seconds
+            if use_mongo:
+                expires_at = datetime.now(timezone.utc) + timedelta(seconds=self.window_seconds)
+                allowed, tokens = await _mongo_rate_limit_backend.token_bucket(key, self.limit, refill, now, expires_at)
+            else:
+                allowed, tokens = await _memory_rate_limit_backend.token_bucket(key, self.limit, refill, now)
+            return allowed, max(1, int((1 - tokens) / refill) + 1) if not allowed else 0
+        
+        window_index = int(now // self.window_seconds)
+        if use_mongo:
+            expires_at = datetime.fromtimestamp((window_index + 2) * self.window_seconds, timezone.utc)
+            count, previous = await _mongo_rate_limit_backend.sliding_window(key, window_index, expires_at)
+        else:
+            count, previous = await _memory_rate_limit_backend.sliding_window(key, window_index)
+        
+        elapsed_fraction = (now % self.window_seconds) / self.window_seconds
+        estimated = previous * (1 - elapsed_fraction) + count
+        if estimated <= self.limit:
+            return True, 0
+        return False, max(1, int(self.window_seconds * (1 - elapsed_fraction)) + 1)
+    
+    async def check_request(self, request: Request) -> tuple:
+        """check() keyed by the client IP; fails open"""
+        client_key = get_trusted_client_ip(request) or "unknown"
+        try:
+            return await self.check(client_key)
+        except Exception as e:
+            # Fail open: a rate limiter outage must not take the endpoint down
+            logging.warning(f"Rate limit check failed for {self.name}: {e}")
+            return True, 0
+    
+    async def __call__(self, request: Request):
+        allowed, retry_after = await self.check_request(request)
+        if not allowed:
+            raise HTTPException(
+                status_code=429,
+                detail="Too many requests. Please try again later.",
+                headers={"Retry-After": str(retry_after)}
+            )
+
+# Limits for public/unauthenticated endpoints
+LOGIN_RATE_LIMIT = RateLimit("login", 10, 60)
+REGISTER_RATE_LIMIT = RateLimit("register", 5, 3600)
+FORGOT_PASSWORD_RATE_LIMIT = RateLimit("forgot_password", 5, 3600)
+RESET_PASSWORD_RATE_LIMIT = RateLimit("reset_password", 10, 3600)
+WAITLIST_RATE_LIMIT = RateLimit("waitlist", 1, 60)
+LOOKUP_RATE_LIMIT = RateLimit("lookup", 30, 60, algorithm="token_bucket")
+# Per worker: a shared-state round-trip on every click/view would cost more than it protects.
+# Redirect routes check it in the handler and only skip recording, never the redirect.
+TRACKING_RATE_LIMIT = RateLimit("tracking", 120, 60, algorithm="token_bucket", backend="memory")
+
+# Expensive authenticated endpoints
+ANALYTICS_EXPORT_RATE_LIMIT = RateLimit("analytics_export", 30, 3600)
+
 app = FastAPI()
-api_router = APIRouter(prefix="/api")
 
 # ===================== SUBDOMAIN MIDDLEWARE =====================
 
 # Main domain (without subdomain)
 MAIN_DOMAIN = os.environ.get('MAIN_DOMAIN', 'mytrack.cc')
 
-class SubdomainMiddleware(BaseHTTPMiddleware):
+def get_scope_header(scope: dict, name: bytes) -> str:
+    """Read a single header from a raw ASGI scope (name must be lowercase bytes)"""
+    for key, value in scope.get("headers", ()):
+        if key == name:
+            return value.decode("latin-1")
+    return ""
+
+class SubdomainMiddleware:
     """
     Middleware to handle subdomain routing.
     Extracts subdomain from Host header and adds it to request state.
     Example: music.mytrack.cc -> subdomain = "music"
+    
+    Implemented as a raw ASGI middleware: it only annotates the scope and
+    passes receive/send through untouched, so responses are never wrapped.
     """
-    async def dispatch(self, request: Request, call_next):
-        host = request.headers.get("host", "").split(":")[0].lower()
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        host = get_scope_header(scope, b"host").split(":")[0].lower()
         
         # Check for X-Subdomain header (for Nginx proxy)
-        subdomain = request.headers.get("x-subdomain", "").lower().strip()
+        subdomain = get_scope_header(scope, b"x-subdomain").lower().strip()
         
         # If no X-Subdomain header, extract from Host
         if not subdomain and host:
@@ -179,11 +465,10 @@ class SubdomainMiddleware(BaseHTTPMiddleware):
             elif host == MAIN_DOMAIN or host == f"www.{MAIN_DOMAIN}":
                 subdomain = ""
         
-        # Store subdomain in request state for use in routes
-        request.state.subdomain = subdomain if subdomain and subdomain != "www" else ""
+        # Store subdomain in request state for use in routes (request.state reads scope["state"])
+        scope.setdefault("state", {})["subdomain"] = subdomain if subdomain and subdomain != "www" else ""
         
-        response = await call_next(request)
-        return response
+        await self.app(scope, receive, send)
 
 app.add_middleware(SubdomainMiddleware)
 
@@ -223,15 +508,62 @@ OG_DESCRIPTIONS = {
 
 FRONTEND_URL = os.environ.get('FRONTEND_URL', 'http://localhost:3000')
 
+# Bot detection: one precompiled alternation + LRU of recent User-Agent verdicts
+BOT_VERDICT_CACHE_SIZE = 4096
+BOT_USER_AGENTS_REFRESH_SECONDS = 60
+_bot_ua_regex = None
+_bot_verdict_cache = OrderedDict()
+
+def set_bot_user_agents(user_agents: List[str]):
+    """Replace the bot substring list, recompile the matcher and drop cached verdicts"""
+    global BOT_USER_AGENTS, _bot_ua_regex
+    cleaned = sorted({ua.lower().strip() for ua in user_agents if ua and ua.strip()})
+    BOT_USER_AGENTS = cleaned
+    if cleaned:
+        _bot_ua_regex = re.compile("|".join(re.escape(ua) for ua in cleaned), re.IGNORECASE)
+    else:
+        _bot_ua_regex = re.compile(r"(?!)")  # never matches
+    _bot_verdict_cache.clear()
+
+set_bot_user_agents(BOT_USER_AGENTS)
+
 def is_bot(user_agent: str) -> bool:
     """Check if the request is from a social media bot"""
     if not user_agent:
         return False
-    ua_lower = user_agent.lower()
-    return any(bot in ua_lower for bot in BOT_USER_AGENTS)
+    
+    verdict = _bot_verdict_cache.get(user_agent)
+    if verdict is not None:
+        _bot_verdict_cache.move_to_end(user_agent)
+        return verdict
+    
+    verdict = _bot_ua_regex.search(user_agent) is not None
+    _bot_verdict_cache[user_agent] = verdict
+    if len(_bot_verdict_cache) > BOT_VERDICT_CACHE_SIZE:
+        _bot_verdict_cache.popitem(last=False)
+    return verdict
+
+async def load_bot_user_agents():
+    """Load the bot list from app_settings (falls back to the built-in list)"""
+    settings = await db.app_settings.find_one({"key": "bot_user_agents"}, {"_id": 0})
+    if settings and settings.get("value") and settings["value"] != BOT_USER_AGENTS:
+        set_bot_user_agents(settings["value"])
+        logging.info(f"Bot User-Agent list reloaded: {len(BOT_USER_AGENTS)} entries")
+
+async def bot_user_agents_refresh_loop():
+    """Periodically pick up bot list changes made by other workers"""
+    while True:
+        await asyncio.sleep(BOT_USER_AGENTS_REFRESH_SECONDS)
+        try:
+            await load_bot_user_agents()
+        except Exception as e:
+            logging.warning(f"Bot User-Agent list refresh failed: {e}")
 
 async def get_page_for_og(slug: str) -> dict:
     """Get page data for OG tags"""
+    if not await lookup_slug_route(slug):
+        return None
+    
     page = await db.pages.find_one({"slug": slug}, {"_id": 0})
     if not page:
         return None
@@ -243,12 +575,15 @@ async def get_page_for_og(slug: str) -> dict:
     )
     
     return {
+        "id": page.get("id"),
+        "user_id": page.get("user_id"),
+        "artist_name": page.get("artist_name", ""),
         "title": page.get("title", "Music Release"),
         "cover_image": page.get("cover_image", ""),
         "language": user.get("preferred_language", "en") if user else "en"
     }
 
-def generate_og_html(slug: str, title: str, cover_image: str, language: str) -> str:
+def generate_og_html(slug: str, title: str, cover_image: str, language: str, card_url: Optional[str] = None) -> str:
     """Generate HTML page with OG tags for social media crawlers"""
     # Normalize language
     lang = language.lower() if language.lower() in OG_DESCRIPTIONS else "en"
@@ -256,8 +591,11 @@ def generate_og_html(slug: str, title: str, cover_image: str, language: str) ->
     # Generate description
     description = OG_DESCRIPTIONS[lang].format(title=title)
     
-    # Use cover image or default
-    og_image = cover_image if cover_image and (cover_image.startswith("http") or cover_image.startswith("/")) else f"{FRONTEND_URL}/og-default.png"
+    # Prefer the rendered 1200x630 card, then the cover image, then the default
+    if card_url:
+        og_image = card_url
+    else:
+        og_image = cover_image if cover_image and (cover_image.startswith("http") or cover_image.startswith("/")) else f"{FRONTEND_URL}/og-default.png"
     if og_image.startswith("/"):
         og_image = f"{FRONTEND_URL}{og_image}"
     
@@ -311,62 +649,140 @@ def generate_og_html(slug: str, title: str, cover_image: str, language: str) ->
 </body>
 </html>'''
 
-class OGBotMiddleware(BaseHTTPMiddleware):
+# ===================== OG HTML CACHE =====================
+
+# Rendered OG pages keyed by slug. The ETag is a hash of the rendered HTML,
+# so it changes whenever title, cover, artist or owner language change.
+OG_CACHE_TTL_SECONDS = 300
+OG_CACHE_MAX_ENTRIES = 2048
+_og_html_cache = OrderedDict()
+_og_html_inflight = {}
+_og_cache_generation = 0
+
+async def _build_og_entry(slug: str) -> Optional[dict]:
+    generation = _og_cache_generation
+    page_data = await get_page_for_og(slug)
+    if not page_data:
+        return None
+    
+    card_version = og_card_version(page_data['title'], page_data['artist_name'], page_data['cover_image'])
+    html = generate_og_html(
+        slug=slug,
+        title=page_data['title'],
+        cover_image=page_data['cover_image'],
+        language=page_data['language'],
+        card_url=f"/api/og-image/{slug}.jpg?v={card_version}"
+    )
+    body = html.encode("utf-8")
+    entry = {
+        "page_id": page_data["id"],
+        "user_id": page_data["user_id"],
+        "title": page_data["title"],
+        "artist_name": page_data["artist_name"],
+        "cover_image": page_data["cover_image"],
+        "card_version": card_version,
+        "body": body,
+        "etag": f'"og-{hashlib.sha1(body).hexdigest()[:16]}"',
+        "expires": time.monotonic() + OG_CACHE_TTL_SECONDS
+    }
+    
+    # Don't store a render that raced with an invalidation
+    if generation == _og_cache_generation:
+        _og_html_cache[slug] = entry
+        _og_html_cache.move_to_end(slug)
+        while len(_og_html_cache) > OG_CACHE_MAX_ENTRIES:
+            _og_html_cache.popitem(last=False)
+    return entry
+
+async def get_og_entry(slug: str) -> Optional[dict]:
+    """Get rendered OG HTML for a slug; concurrent misses share a single DB fetch"""
+    entry = _og_html_cache.get(slug)
+    if entry and entry["expires"] > time.monotonic():
+        _og_html_cache.move_to_end(slug)
+        return entry
+    
+    task = _og_html_inflight.get(slug)
+    if task is None:
+        task = asyncio.create_task(_build_og_entry(slug))
+        _og_html_inflight[slug] = task
+        task.add_done_callback(lambda _, slug=slug: _og_html_inflight.pop(slug, None))
+    return await asyncio.shield(task)
+
+def invalidate_og_cache(slug: Optional[str] = None, user_id: Optional[str] = None):
+    """Drop cached OG HTML for a slug and/or every page of a user"""
+    global _og_cache_generation
+    _og_cache_generation += 1
+    if slug:
+        _og_html_cache.pop(slug, None)
+    if user_id:
+        for cached_slug in [k for k, v in _og_html_cache.items() if v["user_id"] == user_id]:
+            _og_html_cache.pop(cached_slug, None)
+
+def og_html_response(entry: dict, if_none_match: str = "") -> Response:
+    """Serve pre-encoded OG HTML, answering conditional requests with 304"""
+    headers = {"ETag": entry["etag"], "Cache-Control": f"public, max-age={OG_CACHE_TTL_SECONDS}"}
+    if if_none_match and entry["etag"] in if_none_match:
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry["body"], media_type="text/html", headers=headers)
+
+# Paths that never carry an artist slug
+OG_SKIP_PREFIXES = (
+    '/api', '/static', '/uploads', '/assets', '/multilinks', '/random-cover',
+    '/analytics', '/domains', '/settings', '/verification', '/support', '/admin', '/page/',
+)
+OG_SKIP_PATHS = {'/', '/login', '/register', '/forgot-password', '/reset-password', '/demo', '/pricing'}
+
+class OGBotMiddleware:
     """
     Middleware to serve OG tags HTML to social media bots.
     Regular users get the SPA (index.html).
+    
+    Implemented as a raw ASGI middleware: non-bot traffic is passed straight
+    through, bots on a known slug get the OG HTML without calling the app.
     """
-    async def dispatch(self, request: Request, call_next):
-        path = request.url.path
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        path = scope["path"]
         
         # Skip API routes, static files, and special paths
-        if (path.startswith('/api') or 
-            path.startswith('/static') or 
-            path.startswith('/uploads') or
-            path.startswith('/assets') or
-            path in ['/', '/login', '/register', '/forgot-password', '/reset-password', '/demo', '/pricing'] or
-            path.startswith('/multilinks') or
-            path.startswith('/random-cover') or
-            path.startswith('/analytics') or
-            path.startswith('/domains') or
-            path.startswith('/settings') or
-            path.startswith('/verification') or
-            path.startswith('/support') or
-            path.startswith('/admin') or
-            path.startswith('/page/') or
+        if (path in OG_SKIP_PATHS or
+            path.startswith(OG_SKIP_PREFIXES) or
             '.' in path.split('/')[-1]):  # Skip files with extensions
-            return await call_next(request)
+            await self.app(scope, receive, send)
+            return
         
         # Extract potential slug (e.g., /artist-name)
         slug = path.lstrip('/')
         if not slug or '/' in slug:
-            return await call_next(request)
+            await self.app(scope, receive, send)
+            return
         
         # Check if this is a bot request
-        user_agent = request.headers.get('user-agent', '')
+        user_agent = get_scope_header(scope, b"user-agent")
         if not is_bot(user_agent):
-            return await call_next(request)
+            await self.app(scope, receive, send)
+            return
         
-        # Get page data for OG tags
+        # Get rendered OG HTML (cached per slug)
         try:
-            page_data = await get_page_for_og(slug)
-            if not page_data:
-                return await call_next(request)
-            
-            # Generate OG HTML
-            html = generate_og_html(
-                slug=slug,
-                title=page_data['title'],
-                cover_image=page_data['cover_image'],
-                language=page_data['language']
-            )
-            
-            logging.info(f"Serving OG HTML for bot: {user_agent[:50]}... slug: {slug}")
-            return HTMLResponse(content=html, status_code=200)
-            
+            entry = await get_og_entry(slug)
         except Exception as e:
             logging.error(f"OG middleware error: {e}")
-            return await call_next(request)
+            entry = None
+        
+        if not entry:
+            await self.app(scope, receive, send)
+            return
+        
+        logging.info(f"Serving OG HTML for bot: {user_agent[:50]}... slug: {slug}")
+        response = og_html_response(entry, get_scope_header(scope, b"if-none-match"))
+        await response(scope, receive, send)
 
 # Add OG middleware BEFORE subdomain middleware
 app.add_middleware(OGBotMiddleware)
@@ -593,7 +1009,16 @@ async def check_access(user: dict, requirement: str, value: any = None) -> bool:
     
     return True
 
-async def get_current_user(authorization: str = Header(None)):
+async def get_authorization_header(request: Request) -> Optional[str]:
+    """
+    Authorization header for the auth dependencies below.
+    Read from the request rather than declared as Header(None): FastAPI builds a
+    validator for every declared parameter of every route using the dependency,
+    and ~90 routes depend on these.
+    """
+    return request.headers.get("authorization")
+
+async def get_current_user(authorization: Optional[str] = Depends(get_authorization_header)):
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Not authenticated")
     token = authorization.split(" ")[1]
@@ -612,14 +1037,14 @@ async def get_current_user(authorization: str = Header(None)):
     
     return user
 
-async def get_admin_user(authorization: str = Header(None)):
+async def get_admin_user(authorization: Optional[str] = Depends(get_authorization_header)):
     """Require at least moderator role"""
     user = await get_current_user(authorization)
     if not has_role_permission(user.get("role", "user"), "moderator"):
         raise HTTPException(status_code=403, detail="Доступ запрещён. Требуется роль модератора или выше.")
     return user
 
-async def get_owner_user(authorization: str = Header(None)):
+async def get_owner_user(authorization: Optional[str] = Depends(get_authorization_header)):
     """Require owner role"""
     user = await get_current_user(authorization)
     if user.get("role") != "owner":
@@ -648,20 +1073,860 @@ async def get_page_with_admin_access(page_id: str, user: dict) -> dict:
     
     return page
 
+# PIL is imported inside the image helpers: they only run in _image_executor
+# threads, and most workers never render an image between restarts.
+
+def blur_image(img: "Image.Image", size: tuple, radius: int = 30) -> "Image.Image":
+    """Downscale and Gaussian-blur an image (used for page and OG card backgrounds)"""
+    from PIL import ImageFilter
+    img = img.convert('RGB')
+    img = img.resize(size)
+    return img.filter(ImageFilter.GaussianBlur(radius=radius))
+
 def generate_blurred_background(input_path: str, output_path: str):
     """Generate blurred background from cover image"""
+    from PIL import Image
     try:
         with Image.open(input_path) as img:
-            img = img.convert('RGB')
-            img = img.resize((400, 400))
-            blurred = img.filter(ImageFilter.GaussianBlur(radius=30))
+            blurred = blur_image(img, (400, 400))
             blurred.save(output_path, 'JPEG', quality=70)
     except Exception as e:
         logging.error(f"Error generating blurred background: {e}")
 
+# ===================== OG CARD IMAGES =====================
+
+OG_CARD_SIZE = (1200, 630)
+OG_CARD_COVER_SIZE = 470
+OG_CARD_MAX_SOURCE_BYTES = 15 * 1024 * 1024
+OG_CARD_FETCH_MAX_REDIRECTS = 3
+# A card rendered without its cover because the fetch failed is served for
+# this long, then the fetch is retried
+OG_CARD_FAILED_RETRY_SECONDS = 300
+OG_CARD_FONT_CANDIDATES = [
+    os.environ.get('OG_CARD_FONT', ''),
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf',
+    '/usr/share/fonts/dejavu/DejaVuSans-Bold.ttf',
+    '/usr/share/fonts/TTF/DejaVuSans-Bold.ttf',
+    'DejaVuSans-Bold.ttf',
+]
+
+# Image work (PIL) runs off the event loop in a small dedicated pool
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', '2'))
+_image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+_og_card_inflight = {}
+
+def og_card_version(title: str, artist_name: str, cover_image: str) -> str:
+    """Version of a page's OG card - changes when anything drawn on it changes"""
+    key = f"{title}\0{artist_name}\0{cover_image}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+
+def _load_card_font(size: int):
+    from PIL import ImageFont
+    for candidate in OG_CARD_FONT_CANDIDATES:
+        if not candidate:
+            continue
+        try:
+            return ImageFont.truetype(candidate, size)
+        except OSError:
+            continue
+    return ImageFont.load_default(size=size)
+
+def _wrap_text(draw: "ImageDraw.ImageDraw", text: str, font, max_width: int, max_lines: int) -> List[str]:
+    lines = []
+    current = ""
+    for word in text.split():
+        candidate = f"{current} {word}".strip()
+        if draw.textlength(candidate, font=font) <= max_width:
+            current = candidate
+            continue
+        if current:
+            lines.append(current)
+        current = word
+        if len(lines) == max_lines:
+            break
+    if current and len(lines) < max_lines:
+        lines.append(current)
+    
+    # Ellipsize the last line if text was cut
+    if lines and " ".join(lines) != " ".join(text.split()):
+        last = lines[-1]
+        while last and draw.textlength(last + "…", font=font) > max_width:
+            last = last[:-1]
+        lines[-1] = last.rstrip() + "…"
+    return lines
+
+def render_og_card(cover_bytes: Optional[bytes], title: str, artist_name: str, output_path: str):
+    """Compose a 1200x630 JPEG card: blurred cover background, cover art, title and artist"""
+    from PIL import Image, ImageDraw, ImageOps
+    width, height = OG_CARD_SIZE
+    cover = None
+    if cover_bytes:
+        try:
+            cover = Image.open(io.BytesIO(cover_bytes))
+            cover.draft('RGB', (OG_CARD_COVER_SIZE, OG_CARD_COVER_SIZE))  # fast JPEG downscale on decode
+            cover = cover.convert('RGB')
+        except Exception as e:
+            logging.warning(f"OG card: unreadable cover image: {e}")
+            cover = None
+    
+    if cover:
+        # Blur at low resolution, then scale up - same look as page backgrounds, fraction of the cost
+        background = blur_image(ImageOps.fit(cover, (width // 3, height // 3)), (width // 3, height // 3), radius=10)
+        card = background.resize(OG_CARD_SIZE, Image.BILINEAR)
+        card = Image.blend(card, Image.new('RGB', OG_CARD_SIZE, (0, 0, 0)), 0.45)
+    else:
+        card = Image.new('RGB', OG_CARD_SIZE, (10, 10, 10))
+    
+    draw = ImageDraw.Draw(card)
+    margin = (height - OG_CARD_COVER_SIZE) // 2
+    
+    # Cover art with rounded corners
+    if cover:
+        art = ImageOps.fit(cover, (OG_CARD_COVER_SIZE, OG_CARD_COVER_SIZE), Image.LANCZOS)
+        mask = Image.new('L', art.size, 0)
+        ImageDraw.Draw(mask).rounded_rectangle((0, 0, *art.size), radius=24, fill=255)
+        card.paste(art, (margin, margin), mask)
+    else:
+        draw.rounded_rectangle(
+            (margin, margin, margin + OG_CARD_COVER_SIZE, margin + OG_CARD_COVER_SIZE),
+            radius=24, fill=(217, 70, 239)
+        )
+    
+    # Title and artist
+    text_x = margin * 2 + OG_CARD_COVER_SIZE
+    text_width = width - text_x - margin
+    title_font = _load_card_font(60)
+    artist_font = _load_card_font(38)
+    brand_font = _load_card_font(28)
+    
+    title_lines = _wrap_text(draw, title or "Music Release", title_font, text_width, 3)
+    artist_lines = _wrap_text(draw, artist_name, artist_font, text_width, 1) if artist_name else []
+    
+    line_height = 72
+    block_height = len(title_lines) * line_height + (60 if artist_lines else 0)
+    y = (height - block_height) // 2
+    for line in title_lines:
+        draw.text((text_x, y), line, font=title_font, fill=(255, 255, 255))
+        y += line_height
+    if artist_lines:
+        draw.text((text_x, y + 12), artist_lines[0], font=artist_font, fill=(212, 212, 216))
+    
+    draw.text((width - margin, height - margin), "Muslink", font=brand_font, fill=(217, 70, 239), anchor="rd")
+    
+    # Write atomically so concurrent readers never see a partial file
+    tmp_path = f"{output_path}.{uuid.uuid4().hex}.tmp"
+    card.save(tmp_path, 'JPEG', quality=82, optimize=True, progressive=True)
+    os.replace(tmp_path, output_path)
+
+def resolve_upload_path(url: str) -> Optional[Path]:
+    """Map a /api/uploads/... or /uploads/... URL to a file inside UPLOAD_DIR"""
+    path = url.split("?")[0]
+    if path.startswith("/api/"):
+        path = path[len("/api"):]
+    if not path.startswith("/uploads/"):
+        return None
+    candidate = (UPLOAD_DIR / path[len("/uploads/"):]).resolve()
+    if UPLOAD_DIR.resolve() not in candidate.parents or not candidate.is_file():
+        return None
+    return candidate
+
+class CoverFetchError(Exception):
+    """Transient failure fetching a remote cover (network error, 5xx, 429)"""
+
+async def is_public_host(host: str) -> bool:
+    """True if every address the host resolves to is globally routable (no loopback, private, link-local...)"""
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(host, None, type=socket.SOCK_STREAM)
+    except socket.gaierror:
+        return False
+    if not infos:
+        return False
+    for info in infos:
+        address = ipaddress.ip_address(info[4][0].split("%")[0])
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        if not address.is_global:
+            return False
+    return True
+
+async def fetch_remote_cover(url: str) -> Optional[bytes]:
+    """
+    GET a user-supplied cover URL: only public hosts (re-checked on every
+    redirect hop) and at most OG_CARD_MAX_SOURCE_BYTES read.
+    Returns None when the cover is unusable; raises CoverFetchError on transient failures.
+    """
+    import httpx
+    async with httpx.AsyncClient(timeout=5.0, follow_redirects=False) as client:
+        for _ in range(OG_CARD_FETCH_MAX_REDIRECTS + 1):
+            parsed = urlparse(url)
+            if parsed.scheme not in ("http", "https") or not parsed.hostname or not await is_public_host(parsed.hostname):
+                logging.warning(f"OG card: cover URL not allowed: {url}")
+                return None
+            
+            async with client.stream("GET", url) as response:
+                if response.is_redirect:
+                    url = str(response.url.join(response.headers["location"]))
+                    continue
+                if response.status_code >= 500 or response.status_code == 429:
+                    raise CoverFetchError(f"HTTP {response.status_code}")
+                if response.status_code != 200:
+                    return None
+                if int(response.headers.get("content-length") or 0) > OG_CARD_MAX_SOURCE_BYTES:
+                    return None
+                
+                chunks = []
+                size = 0
+                async for chunk in response.aiter_bytes():
+                    size += len(chunk)
+                    if size > OG_CARD_MAX_SOURCE_BYTES:
+                        return None
+                    chunks.append(chunk)
+                return b"".join(chunks)
+    
+    logging.warning(f"OG card: too many redirects for cover {url}")
+    return None
+
+async def load_cover_bytes(cover_image: str) -> Optional[bytes]:
+    """Read a page cover from local uploads or fetch it from a public remote URL"""
+    import httpx
+    if not cover_image:
+        return None
+    
+    local_path = resolve_upload_path(cover_image)
+    if local_path:
+        async with aiofiles.open(local_path, 'rb') as f:
+            return await f.read()
+    
+    if cover_image.startswith("http"):
+        try:
+            return await fetch_remote_cover(cover_image)
+        except (httpx.HTTPError, CoverFetchError) as e:
+            raise CoverFetchError(f"cover fetch failed for {cover_image}: {e}") from e
+    return None
+
+def og_card_fallback_path(output_path: Path) -> Path:
+    """Where a card rendered without its cover (failed fetch) is kept until the retry"""
+    return output_path.with_suffix(".nocover.jpg")
+
+async def _render_og_card_file(entry: dict, output_path: Path) -> Path:
+    try:
+        cover_bytes = await load_cover_bytes(entry["cover_image"])
+    except CoverFetchError as e:
+        # Serve a card without the cover for now, but don't keep it as this version's card
+        logging.warning(f"OG card: {e}")
+        cover_bytes = None
+        output_path = og_card_fallback_path(output_path)
+    
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(
+        _image_executor, render_og_card,
+        cover_bytes, entry["title"], entry["artist_name"], str(output_path)
+    )
+    
+    # Remove cards for older versions of this page
+    for old_card in OG_CARDS_DIR.glob(f"{entry['page_id']}_*.jpg"):
+        if old_card != output_path:
+            old_card.unlink(missing_ok=True)
+    return output_path
+
+def remove_og_cards(page_id: str):
+    """Delete every rendered card of a page"""
+    for card in OG_CARDS_DIR.glob(f"{page_id}_*.jpg"):
+        card.unlink(missing_ok=True)
+
+async def get_og_card_path(entry: dict) -> Path:
+    """Get the on-disk card for a page version, rendering it once if missing"""
+    output_path = OG_CARDS_DIR / f"{entry['page_id']}_{entry['card_version']}.jpg"
+    if output_path.exists():
+        return output_path
+    fallback_path = og_card_fallback_path(output_path)
+    try:
+        if time.time() - fallback_path.stat().st_mtime < OG_CARD_FAILED_RETRY_SECONDS:
+            return fallback_path
+    except FileNotFoundError:
+        pass
+    
+    key = output_path.name
+    task = _og_card_inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_render_og_card_file(entry, output_path))
+        _og_card_inflight[key] = task
+        task.add_done_callback(lambda _, key=key: _og_card_inflight.pop(key, None))
+    return await asyncio.shield(task)
+
+# ===================== SLUG ROUTING TABLE =====================
+
+# In-memory map of every public entry point, so hot paths can reject unknown
+# slugs/ids (scanners, typos) without a database round-trip. Loaded once at
+# startup and updated on local writes. Every write also bumps a shared epoch
+# in app_settings and appends the ids it touched to routing_changes; other
+# workers poll the epoch every ROUTING_REFRESH_SECONDS (one indexed read) and
+# re-read only those pages/subdomains. A slug created on another worker is
+# therefore unknown here for at most that long. Changes to a user (profile,
+# plan, ban) go through the same log so every worker drops the user's cached
+# subdomain resolutions.
+# Misses are trusted while the table is in sync; a table that has not synced
+# for ROUTING_STALE_SECONDS (database trouble) falls back to database lookups.
+ROUTING_REFRESH_SECONDS = 1
+ROUTING_STALE_SECONDS = 30
+ROUTING_CHANGE_LOG_TTL_SECONDS = 3600
+ROUTING_CHANGE_BATCH = 1000          # a longer backlog is cheaper as a full reload
+ROUTE_PAGE_PROJECTION = {"_id": 0, "id": 1, "slug": 1, "user_id": 1, "status": 1, "version": 1}
+_slug_routes = {}        # slug -> {"page_id", "user_id", "status", "version"}
+_page_slugs = {}         # page_id -> slug
+_subdomain_users = {}    # subdomain -> user_id
+_routing_state = {"loaded": False, "epoch": None, "gap_epoch": None, "synced_at": 0.0}
+
+def _route_from_page(page: dict) -> dict:
+    return {
+        "page_id": page["id"],
+        "user_id": page.get("user_id"),
+        "status": page.get("status", "active"),
+        "version": page.get("version", 0)
+    }
+
+def _apply_page_route(page: dict):
+    """Put a page into the routing table, dropping the slug it had before"""
+    old_slug = _page_slugs.get(page["id"])
+    if old_slug and old_slug != page["slug"] and _slug_routes.get(old_slug, {}).get("page_id") == page["id"]:
+        _slug_routes.pop(old_slug, None)
+    _slug_routes[page["slug"]] = _route_from_page(page)
+    _page_slugs[page["id"]] = page["slug"]
+    _public_pages.pop(page["id"], None)
+
+def _drop_page_route(page_id: str):
+    slug = _page_slugs.pop(page_id, None)
+    if slug and _slug_routes.get(slug, {}).get("page_id") == page_id:
+        _slug_routes.pop(slug, None)
+    _public_pages.pop(page_id, None)
+
+def routing_table_trusted() -> bool:
+    """True while the table is loaded and recently synced, so a miss means 'does not exist'"""
+    return _routing_state["loaded"] and time.monotonic() - _routing_state["synced_at"] < ROUTING_STALE_SECONDS
+
+async def load_routing_table():
+    """(Re)build the routing table from pages and subdomains"""
+    global _slug_routes, _page_slugs, _subdomain_users
+    settings = await db.app_settings.find_one({"key": "routing_epoch"}, {"_id": 0, "value": 1})
+    epoch = settings.get("value", 0) if settings else 0
+    
+    slug_routes = {}
+    page_slugs = {}
+    async for page in db.pages.find({}, ROUTE_PAGE_PROJECTION):
+        slug_routes[page["slug"]] = _route_from_page(page)
+        page_slugs[page["id"]] = page["slug"]
+    
+    subdomain_users = {}
+    async for sub in db.subdomains.find({}, {"_id": 0, "subdomain": 1, "user_id": 1}):
+        subdomain_users[sub["subdomain"]] = sub["user_id"]
+    
+    _slug_routes, _page_slugs, _subdomain_users = slug_routes, page_slugs, subdomain_users
+    _subdomain_cache.clear()
+    _public_pages.clear()
+    _routing_state["loaded"] = True
+    _routing_state["epoch"] = epoch
+    _routing_state["gap_epoch"] = None
+    _routing_state["synced_at"] = time.monotonic()
+    logging.info(f"Routing table loaded: {len(slug_routes)} pages, {len(subdomain_users)} subdomains")
+
+async def refresh_routes(page_ids, subdomains, user_ids=()):
+    """Re-read the given pages and subdomains and apply them to the routing table"""
+    page_ids = list(page_ids)
+    if page_ids:
+        found = {}
+        async for page in db.pages.find({"id": {"$in": page_ids}}, ROUTE_PAGE_PROJECTION):
+            found[page["id"]] = page
+        for page_id in page_ids:
+            if page_id in found:
+                _apply_page_route(found[page_id])
+            else:
+                _drop_page_route(page_id)
+    
+    subdomains = list(subdomains)
+    if subdomains:
+        found = {}
+        async for sub in db.subdomains.find({"subdomain": {"$in": subdomains}}, {"_id": 0, "subdomain": 1, "user_id": 1}):
+            found[sub["subdomain"]] = sub["user_id"]
+        for subdomain in subdomains:
+            if subdomain in found:
+                _subdomain_users[subdomain] = found[subdomain]
+            else:
+                _subdomain_users.pop(subdomain, None)
+            invalidate_subdomain_cache(subdomain=subdomain)
+    
+    for user_id in user_ids:
+        invalidate_subdomain_cache(user_id=user_id)
+
+async def publish_routing_change(page_ids=(), subdomains=(), user_ids=()):
+    """Tell other workers which pages/subdomains/users changed"""
+    result = await db.app_settings.find_one_and_update(
+        {"key": "routing_epoch"},
+        {"$inc": {"value": 1}},
+        upsert=True,
+        return_document=True,
+        projection={"_id": 0, "value": 1}
+    )
+    await db.routing_changes.insert_one({
+        "seq": result["value"],
+        "page_ids": list(page_ids),
+        "subdomains": list(subdomains),
+        "user_ids": list(user_ids),
+        "expires_at": datetime.now(timezone.utc) + timedelta(seconds=ROUTING_CHANGE_LOG_TTL_SECONDS)
+    })
+    # If nobody else bumped the epoch since our last sync, we are already current
+    if _routing_state["epoch"] is not None and result["value"] == _routing_state["epoch"] + 1:
+        _routing_state["epoch"] = result["value"]
+
+async def sync_routing_table():
+    """Apply changes other workers logged since our epoch; reload fully only when the log can't cover it"""
+    if not _routing_state["loaded"]:
+        await load_routing_table()
+        return
+    settings = await db.app_settings.find_one({"key": "routing_epoch"}, {"_id": 0, "value": 1})
+    epoch = settings.get("value", 0) if settings else 0
+    applied = _routing_state["epoch"]
+    if epoch == applied:
+        _routing_state["synced_at"] = time.monotonic()
+        return
+    if epoch < applied or epoch - applied > ROUTING_CHANGE_BATCH:
+        await load_routing_table()
+        return
+    
+    page_ids, subdomains, user_ids = set(), set(), set()
+    cursor = db.routing_changes.find({"seq": {"$gt": applied, "$lte": epoch}}, {"_id": 0}).sort("seq", 1)
+    async for change in cursor:
+        if change["seq"] != applied + 1:
+            break
+        page_ids.update(change.get("page_ids", []))
+        subdomains.update(change.get("subdomains", []))
+        user_ids.update(change.get("user_ids", []))
+        applied = change["seq"]
+    
+    if applied < epoch:
+        # The next entry is missing: its writer is between the epoch bump and
+        # the insert, or the entry expired. Wait one round, then reload.
+        if _routing_state["gap_epoch"] == applied:
+            await load_routing_table()
+            return
+        _routing_state["gap_epoch"] = applied
+    else:
+        _routing_state["gap_epoch"] = None
+    
+    await refresh_routes(page_ids, subdomains, user_ids)
+    _routing_state["epoch"] = applied
+    _routing_state["synced_at"] = time.monotonic()
+
+async def routing_refresh_loop():
+    """Keep the routing table in step with writes made by other workers"""
+    while True:
+        await asyncio.sleep(ROUTING_REFRESH_SECONDS)
+        try:
+            await sync_routing_table()
+        except Exception as e:
+            logging.warning(f"Routing table refresh failed: {e}")
+
+async def set_page_route(page: dict, old_slug: Optional[str] = None):
+    """Add or update a page in the routing table"""
+    if old_slug and old_slug != page["slug"] and _slug_routes.get(old_slug, {}).get("page_id") == page["id"]:
+        _slug_routes.pop(old_slug, None)
+    _apply_page_route(page)
+    await publish_routing_change(page_ids=[page["id"]])
+
+async def remove_page_routes(page_ids: List[str]):
+    """Drop pages from the routing table"""
+    for page_id in page_ids:
+        _drop_page_route(page_id)
+    await publish_routing_change(page_ids=page_ids)
+
+async def set_subdomain_route(subdomain: str, user_id: Optional[str]):
+    """Add (user_id) or remove (None) a subdomain in the routing table"""
+    if user_id:
+        _subdomain_users[subdomain] = user_id
+    else:
+        _subdomain_users.pop(subdomain, None)
+    invalidate_subdomain_cache(subdomain=subdomain)
+    await publish_routing_change(subdomains=[subdomain])
+
+async def lookup_slug_route(slug: str) -> Optional[dict]:
+    """Route for a slug; falls back to the database while the table is not trusted"""
+    if routing_table_trusted():
+        return _slug_routes.get(slug)
+    page = await db.pages.find_one({"slug": slug}, ROUTE_PAGE_PROJECTION)
+    return _route_from_page(page) if page else None
+
+async def lookup_page_slug(page_id: str) -> Optional[str]:
+    """Slug for a page id; falls back to the database while the table is not trusted"""
+    if routing_table_trusted():
+        return _page_slugs.get(page_id)
+    page = await db.pages.find_one({"id": page_id}, {"_id": 0, "slug": 1})
+    return page["slug"] if page else None
+
+def subdomain_may_exist(subdomain: str) -> bool:
+    """False only when the trusted table knows the subdomain does not exist"""
+    return not routing_table_trusted() or subdomain in _subdomain_users
+
+# ===================== PUBLIC PAGE CACHE =====================
+
+# Active pages with their active links, as served by /artist/{slug}. An entry
+# is dropped whenever the routing table applies a change for its page - local
+# writes and other workers' change log entries alike - so content is as fresh
+# as the routing table. The TTL only bounds how stale counters (views, link
+# clicks) may get.
+PUBLIC_PAGE_CACHE_TTL_SECONDS = 30
+PUBLIC_PAGE_CACHE_MAX_ENTRIES = 5000
+_public_pages = OrderedDict()  # page_id -> {"page", "links", "expires"}
+
+async def load_public_page(page_id: str) -> Optional[dict]:
+    """Active page document and its active links (cached)"""
+    entry = _public_pages.get(page_id)
+    if entry and entry["expires"] > time.monotonic():
+        _public_pages.move_to_end(page_id)
+        return entry
+    
+    page = await db.pages.find_one({"id": page_id, "status": "active"}, {"_id": 0})
+    if not page:
+        _public_pages.pop(page_id, None)
+        return None
+    links = await db.links.find({"page_id": page_id, "active": True}, {"_id": 0}).sort("order", 1).to_list(100)
+    entry = {"page": page, "links": links, "expires": time.monotonic() + PUBLIC_PAGE_CACHE_TTL_SECONDS}
+    _public_pages[page_id] = entry
+    while len(_public_pages) > PUBLIC_PAGE_CACHE_MAX_ENTRIES:
+        _public_pages.popitem(last=False)
+    return entry
+
+async def publish_page_content_change(page_id: str):
+    """A page's links changed: drop its cached public page here and on every other worker"""
+    _public_pages.pop(page_id, None)
+    await publish_routing_change(page_ids=[page_id])
+
+# ===================== SUBDOMAIN RESOLUTION CACHE =====================
+
+# subdomain -> {"subdomain": doc or None, "user": owner or None, "expires": ...}
+# Missing subdomains are cached too (negative entries): with wildcard DNS,
+# random-host scans would otherwise cost two queries each.
+SUBDOMAIN_CACHE_TTL_SECONDS = 60
+SUBDOMAIN_NEGATIVE_TTL_SECONDS = 30
+SUBDOMAIN_CACHE_MAX_ENTRIES = 10000
+SUBDOMAIN_OWNER_PROJECTION = {
+    "_id": 0, "id": 1, "username": 1, "is_banned": 1, "plan": 1,
+    "verified": 1, "show_verification_badge": 1, "artist_name": 1,
+    "profile_description": 1, "contact_email": 1, "social_links": 1
+}
+_subdomain_cache = OrderedDict()
+
+async def resolve_subdomain_owner(subdomain: str) -> dict:
+    """
+    Resolve a subdomain to its document and owner (cached).
+    Returns {"subdomain": None, "user": None} when the subdomain does not exist.
+    """
+    entry = _subdomain_cache.get(subdomain)
+    if entry and entry["expires"] > time.monotonic():
+        _subdomain_cache.move_to_end(subdomain)
+        return entry
+    
+    subdomain_doc = None
+    user = None
+    if subdomain_may_exist(subdomain):
+        subdomain_doc = await db.subdomains.find_one({"subdomain": subdomain}, {"_id": 0})
+    if subdomain_doc:
+        user = await db.users.find_one({"id": subdomain_doc["user_id"]}, SUBDOMAIN_OWNER_PROJECTION)
+    
+    ttl = SUBDOMAIN_CACHE_TTL_SECONDS if subdomain_doc else SUBDOMAIN_NEGATIVE_TTL_SECONDS
+    entry = {"subdomain": subdomain_doc, "user": user, "expires": time.monotonic() + ttl}
+    _subdomain_cache[subdomain] = entry
+    while len(_subdomain_cache) > SUBDOMAIN_CACHE_MAX_ENTRIES:
+        _subdomain_cache.popitem(last=False)
+    return entry
+
+async def invalidate_user_caches(user_id: str):
+    """A user's profile, plan or status changed: drop their cached resolutions here and on every other worker"""
+    invalidate_subdomain_cache(user_id=user_id)
+    await publish_routing_change(user_ids=[user_id])
+
+def invalidate_subdomain_cache(subdomain: Optional[str] = None, user_id: Optional[str] = None):
+    """Drop cached resolution for a subdomain and/or every subdomain of a user"""
+    if subdomain:
+        _subdomain_cache.pop(subdomain, None)
+    if user_id:
+        for cached in [k for k, v in _subdomain_cache.items() if v["user"] and v["user"].get("id") == user_id]:
+            _subdomain_cache.pop(cached, None)
+
+# ===================== DEFERRED VIEW COUNTERS =====================
+
+# Page view increments are accumulated in memory and flushed as one
+# unordered bulk write, instead of an $inc round-trip on every page view.
+VIEW_FLUSH_SECONDS = 5
+_pending_page_views = defaultdict(int)
+
+def record_page_view(page_id: str):
+    _pending_page_views[page_id] += 1
+    publish_live(page_id, "views")
+
+async def flush_page_views():
+    """Write accumulated view increments to the pages collection"""
+    if not _pending_page_views:
+        return
+    pending = dict(_pending_page_views)
+    _pending_page_views.clear()
+    try:
+        await db.pages.bulk_write(
+            [UpdateOne({"id": page_id}, {"$inc": {"views": count}}) for page_id, count in pending.items()],
+            ordered=False
+        )
+    except Exception as e:
+        # Put the increments back so the next flush retries them
+        for page_id, count in pending.items():
+            _pending_page_views[page_id] += count
+        logging.warning(f"Page view flush failed: {e}")
+
+async def page_view_flush_loop():
+    while True:
+        await asyncio.sleep(VIEW_FLUSH_SECONDS)
+        await flush_page_views()
+
+# ===================== SYSTEM METRICS SAMPLER =====================
+
+# Every worker samples host and own-process stats every
+# SYSTEM_METRICS_INTERVAL_SECONDS (non-blocking: psutil.cpu_percent(None)
+# measures since the previous call) and keeps the latest sample in memory
+# for the live dashboard. Each finished minute is written as a "1m" rollup
+# document shared by all workers (host stats from the first writer, one
+# `workers.<pid>` entry per worker). "1h" rollups are rebuilt from the stored
+# 1m rollups SYSTEM_METRICS_HOUR_ROLLUP_DELAY_MINUTES into the next hour, when
+# every worker has written its last minute, and on worker start, so hours
+# nobody was running across still get one. Both expire through the TTL index
+# on system_metrics.expires_at.
+SYSTEM_METRICS_INTERVAL_SECONDS = 10
+SYSTEM_METRICS_RETENTION = {"1m": timedelta(days=2), "1h": timedelta(days=90)}
+SYSTEM_METRICS_HOUR_ROLLUP_DELAY_MINUTES = 5
+LOOP_LAG_PROBE_SECONDS = 0.5
+_latest_system_sample = {}
+_minute_samples = []
+_loop_lag = {"last_ms": 0.0, "max_ms": 0.0}
+
+async def event_loop_lag_monitor():
+    """Measure how late the loop wakes up from a fixed sleep (time spent blocked)"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_PROBE_SECONDS)
+        lag_ms = max(0.0, (loop.time() - started - LOOP_LAG_PROBE_SECONDS) * 1000)
+        _loop_lag_histogram.observe(lag_ms)
+        _loop_lag["last_ms"] = lag_ms
+        _loop_lag["max_ms"] = max(_loop_lag["max_ms"], lag_ms)
+
+# psutil.Process of this worker, kept between samples: Process.cpu_percent(None)
+# measures since the previous call on the same instance (0.0 on a new one)
+_worker_process = None
+
+def collect_system_sample() -> dict:
+    """One psutil snapshot of the host and this worker process (runs in a thread)"""
+    global _worker_process
+    import psutil
+    memory = psutil.virtual_memory()
+    disk = psutil.disk_usage('/')
+    net_io = psutil.net_io_counters()
+    try:
+        load_1, load_5, load_15 = psutil.getloadavg()
+    except (AttributeError, OSError):
+        load_1, load_5, load_15 = 0, 0, 0
+    
+    if _worker_process is None or _worker_process.pid != os.getpid():
+        _worker_process = psutil.Process()
+    process = _worker_process
+    with process.oneshot():
+        process_stats = {
+            "pid": process.pid,
+            "cpu_percent": process.cpu_percent(None),
+            "rss_mb": round(process.memory_info().rss / (1024 ** 2), 1),
+            "threads": process.num_threads(),
+        }
+    
+    return {
+        "timestamp": datetime.now(timezone.utc),
+        "cpu": {
+            "percent": psutil.cpu_percent(None),
+            "count": psutil.cpu_count(),
+            "load_1m": round(load_1, 2),
+            "load_5m": round(load_5, 2),
+            "load_15m": round(load_15, 2)
+        },
+        "memory": {
+            "total_gb": round(memory.total / (1024 ** 3), 2),
+            "used_gb": round(memory.used / (1024 ** 3), 2),
+            "percent": memory.percent
+        },
+        "disk": {
+            "total_gb": round(disk.total / (1024 ** 3), 2),
+            "used_gb": round(disk.used / (1024 ** 3), 2),
+            "percent": disk.percent
+        },
+        "network": {
+            "bytes_sent": net_io.bytes_sent,
+            "bytes_recv": net_io.bytes_recv
+        },
+        "boot_time": psutil.boot_time(),
+        "process": process_stats
+    }
+
+async def take_system_sample() -> dict:
+    sample = await asyncio.to_thread(collect_system_sample)
+    sample["process"]["loop_lag_ms"] = round(_loop_lag["last_ms"], 2)
+    sample["process"]["loop_lag_max_ms"] = round(_loop_lag["max_ms"], 2)
+    _loop_lag["max_ms"] = 0.0
+    _latest_system_sample.clear()
+    _latest_system_sample.update(sample)
+    return sample
+
+def _avg(values: list) -> float:
+    return round(sum(values) / len(values), 2) if values else 0.0
+
+def build_minute_rollup(samples: List[dict]) -> tuple:
+    """Condense one minute of samples into (host stats, this worker's stats)"""
+    first, last = samples[0], samples[-1]
+    seconds = max((last["timestamp"] - first["timestamp"]).total_seconds(), 1)
+    host = {
+        "cpu": {
+            "percent_avg": _avg([s["cpu"]["percent"] for s in samples]),
+            "percent_max": max(s["cpu"]["percent"] for s in samples),
+            "load_1m": last["cpu"]["load_1m"]
+        },
+        "memory": {
+            "percent_avg": _avg([s["memory"]["percent"] for s in samples]),
+            "used_gb": last["memory"]["used_gb"]
+        },
+        "disk": {"percent": last["disk"]["percent"], "used_gb": last["disk"]["used_gb"]},
+        "network": {
+            "sent_kbps": round((last["network"]["bytes_sent"] - first["network"]["bytes_sent"]) / 1024 / seconds, 2),
+            "recv_kbps": round((last["network"]["bytes_recv"] - first["network"]["bytes_recv"]) / 1024 / seconds, 2)
+        }
+    }
+    worker = {
+        "cpu_percent_avg": _avg([s["process"]["cpu_percent"] for s in samples]),
+        "rss_mb": last["process"]["rss_mb"],
+        "threads": last["process"]["threads"],
+        "loop_lag_ms_avg": _avg([s["process"]["loop_lag_ms"] for s in samples]),
+        "loop_lag_ms_max": max(s["process"]["loop_lag_max_ms"] for s in samples)
+    }
+    return host, worker
+
+async def write_minute_rollup(minute: datetime, samples: List[dict]):
+    host, worker = build_minute_rollup(samples)
+    await db.system_metrics.update_one(
+        {"_id": f"1m:{minute.isoformat()}"},
+        {
+            "$setOnInsert": {
+                "resolution": "1m",
+                "timestamp": minute,
+                "expires_at": minute + SYSTEM_METRICS_RETENTION["1m"],
+                **host
+            },
+            "$set": {f"workers.{os.getpid()}": worker}
+        },
+        upsert=True
+    )
+
+async def write_hour_rollup(hour: datetime):
+    """(Re)build the hour's rollup from its 1m rollups; idempotent, so every worker may try"""
+    rollup_id = f"1h:{hour.isoformat()}"
+    minutes = await db.system_metrics.find({
+        "resolution": "1m",
+        "timestamp": {"$gte": hour, "$lt": hour + timedelta(hours=1)}
+    }).to_list(60)
+    if not minutes:
+        return
+    
+    workers = [w for m in minutes for w in m.get("workers", {}).values()]
+    doc = {
+        "resolution": "1h",
+        "timestamp": hour,
+        "expires_at": hour + SYSTEM_METRICS_RETENTION["1h"],
+        "cpu": {
+            "percent_avg": _avg([m["cpu"]["percent_avg"] for m in minutes]),
+            "percent_max": max(m["cpu"]["percent_max"] for m in minutes),
+            "load_1m": minutes[-1]["cpu"]["load_1m"]
+        },
+        "memory": {
+            "percent_avg": _avg([m["memory"]["percent_avg"] for m in minutes]),
+            "used_gb": minutes[-1]["memory"]["used_gb"]
+        },
+        "disk": minutes[-1]["disk"],
+        "network": {
+            "sent_kbps": _avg([m["network"]["sent_kbps"] for m in minutes]),
+            "recv_kbps": _avg([m["network"]["recv_kbps"] for m in minutes])
+        },
+        "workers_summary": {
+            "rss_mb_max": max((w["rss_mb"] for w in workers), default=0),
+            "loop_lag_ms_avg": _avg([w["loop_lag_ms_avg"] for w in workers]),
+            "loop_lag_ms_max": max((w["loop_lag_ms_max"] for w in workers), default=0)
+        },
+        "minutes": len(minutes)
+    }
+    try:
+        await db.system_metrics.replace_one({"_id": rollup_id}, doc, upsert=True)
+    except DuplicateKeyError:
+        pass  # another worker upserted it at the same time
+
+def _utc_hour(timestamp: datetime) -> datetime:
+    """Start of the hour, timezone-aware (documents come back from MongoDB naive)"""
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+async def write_missing_hour_rollups(now: datetime) -> int:
+    """
+    Roll up every finished hour whose 1m rollups are not all in its 1h rollup
+    yet (none written, or written before all its minutes were stored). An hour counts
+    as finished SYSTEM_METRICS_HOUR_ROLLUP_DELAY_MINUTES after it ends.
+    Returns the number of hours written.
+    """
+    before = _utc_hour(now - timedelta(minutes=SYSTEM_METRICS_HOUR_ROLLUP_DELAY_MINUTES))
+    minute_counts = Counter()
+    async for doc in db.system_metrics.find(
+        {"resolution": "1m", "timestamp": {"$lt": before}}, {"_id": 0, "timestamp": 1}
+    ):
+        minute_counts[_utc_hour(doc["timestamp"])] += 1
+    if not minute_counts:
+        return 0
+
+    built = {}
+    async for doc in db.system_metrics.find(
+        {"resolution": "1h", "timestamp": {"$gte": min(minute_counts)}}, {"_id": 0, "timestamp": 1, "minutes": 1}
+    ):
+        built[_utc_hour(doc["timestamp"])] = doc.get("minutes")
+
+    written = 0
+    for hour in sorted(minute_counts):
+        # Fewer minutes than the rollup used: the oldest 1m rollups are expiring
+        if minute_counts[hour] > built.get(hour, 0):
+            await write_hour_rollup(hour)
+            written += 1
+    return written
+
+async def system_metrics_sampler():
+    """Sample every interval, write 1m rollups as minutes finish and catch up on 1h rollups"""
+    current_minute = None
+    while True:
+        try:
+            sample = await take_system_sample()
+            minute = sample["timestamp"].replace(second=0, microsecond=0)
+            if current_minute and minute != current_minute and _minute_samples:
+                finished = list(_minute_samples)
+                _minute_samples.clear()
+                await write_minute_rollup(current_minute, finished)
+            if current_minute is None or (
+                minute != current_minute and minute.minute == SYSTEM_METRICS_HOUR_ROLLUP_DELAY_MINUTES
+            ):
+                await write_missing_hour_rollups(sample["timestamp"])
+            current_minute = minute
+            _minute_samples.append(sample)
+        except Exception as e:
+            logging.warning(f"System metrics sample failed: {e}")
+        await asyncio.sleep(SYSTEM_METRICS_INTERVAL_SECONDS)
+
 # ===================== AUTH ROUTES =====================
 
-@api_router.post("/auth/register", response_model=TokenResponse)
+@app.post("/api/auth/register", response_model=TokenResponse, dependencies=[Depends(REGISTER_RATE_LIMIT)])
 async def register(data: UserCreate):
     existing = await db.users.find_one({"$or": [{"email": data.email}, {"username": data.username}]})
     if existing:
@@ -714,7 +1979,7 @@ async def register(data: UserCreate):
         }
     }
 
-@api_router.post("/auth/login", response_model=TokenResponse)
+@app.post("/api/auth/login", response_model=TokenResponse, dependencies=[Depends(LOGIN_RATE_LIMIT)])
 async def login(data: UserLogin):
     user = await db.users.find_one({"email": data.email}, {"_id": 0})
     if not user or not verify_password(data.password, user["password_hash"]):
@@ -751,7 +2016,7 @@ async def login(data: UserLogin):
         }
     }
 
-@api_router.post("/auth/forgot-password")
+@app.post("/api/auth/forgot-password", dependencies=[Depends(FORGOT_PASSWORD_RATE_LIMIT)])
 async def forgot_password(data: ForgotPasswordRequest):
     """Send password reset email"""
     user = await db.users.find_one({"email": data.email}, {"_id": 0})
@@ -821,7 +2086,7 @@ async def forgot_password(data: ForgotPasswordRequest):
                 "subject": "Сброс пароля MyTrack",
                 "html": html_content
             }
-            await asyncio.to_thread(resend.Emails.send, params)
+            await send_email(params)
             logging.info(f"Password reset email sent to {data.email}")
         except Exception as e:
             logging.error(f"Failed to send reset email: {str(e)}")
@@ -829,7 +2094,7 @@ async def forgot_password(data: ForgotPasswordRequest):
     
     return {"message": "Если email существует, инструкции по сбросу пароля будут отправлены"}
 
-@api_router.post("/auth/reset-password")
+@app.post("/api/auth/reset-password", dependencies=[Depends(RESET_PASSWORD_RATE_LIMIT)])
 async def reset_password(data: ResetPasswordRequest):
     """Reset password using token"""
     if len(data.new_password) < 6:
@@ -859,7 +2124,7 @@ async def reset_password(data: ResetPasswordRequest):
     
     return {"message": "Пароль успешно изменён"}
 
-@api_router.get("/auth/me")
+@app.get("/api/auth/me")
 async def get_me(user: dict = Depends(get_current_user)):
     # Get plan config for user
     plan_config = await get_plan_config(user.get("plan", "free"))
@@ -889,7 +2154,7 @@ class ChangePasswordRequest(BaseModel):
     current_password: str
     new_password: str
 
-@api_router.put("/settings/profile")
+@app.put("/api/settings/profile")
 async def update_profile(data: UpdateProfileRequest, user: dict = Depends(get_current_user)):
     """Update user profile (username, email)"""
     update_data = {}
@@ -912,12 +2177,13 @@ async def update_profile(data: UpdateProfileRequest, user: dict = Depends(get_cu
         raise HTTPException(status_code=400, detail="Нет данных для обновления")
     
     await db.users.update_one({"id": user["id"]}, {"$set": update_data})
+    await invalidate_user_caches(user["id"])
     
     # Return updated user
     updated_user = await db.users.find_one({"id": user["id"]}, {"_id": 0, "password_hash": 0})
     return {"message": "Профиль обновлён", "user": updated_user}
 
-@api_router.put("/settings/password")
+@app.put("/api/settings/password")
 async def change_password(data: ChangePasswordRequest, user: dict = Depends(get_current_user)):
     """Change user password"""
     # Verify current password
@@ -938,7 +2204,7 @@ async def change_password(data: ChangePasswordRequest, user: dict = Depends(get_
     
     return {"message": "Пароль успешно изменён"}
 
-@api_router.delete("/settings/account")
+@app.delete("/api/settings/account")
 async def delete_account(user: dict = Depends(get_current_user)):
     """Delete user account (not allowed for admins)"""
     if user["role"] == "admin":
@@ -951,21 +2217,25 @@ async def delete_account(user: dict = Depends(get_current_user)):
     page_ids = [p["id"] for p in pages]
     
     # Delete all related data
+    for page_id in page_ids:
+        remove_og_cards(page_id)
     if page_ids:
         await db.links.delete_many({"page_id": {"$in": page_ids}})
-        await db.clicks.delete_many({"page_id": {"$in": page_ids}})
-        await db.views.delete_many({"page_id": {"$in": page_ids}})
-        await db.shares.delete_many({"page_id": {"$in": page_ids}})
+        await delete_page_events(page_ids)
+        await db.page_analytics.delete_many({"page_id": {"$in": page_ids}})
+        await db.page_daily_uniques.delete_many({"page_id": {"$in": page_ids}})
     
     # Delete pages
     await db.pages.delete_many({"user_id": user_id})
+    await remove_page_routes(page_ids)
+    invalidate_og_cache(user_id=user_id)
     
     # Delete user
     await db.users.delete_one({"id": user_id})
     
     return {"message": "Аккаунт и все связанные данные удалены"}
 
-@api_router.put("/settings/site-navigation")
+@app.put("/api/settings/site-navigation")
 async def toggle_site_navigation(data: dict, user: dict = Depends(get_current_user)):
     """Toggle site navigation mode (shows arrows on public pages)"""
     enabled = data.get("enabled", False)
@@ -993,7 +2263,7 @@ class ContactInfoUpdate(BaseModel):
     profile_description: Optional[str] = ""
     artist_name: Optional[str] = ""
 
-@api_router.get("/profile/contacts")
+@app.get("/api/profile/contacts")
 async def get_contact_info(user: dict = Depends(get_current_user)):
     """Get user's contact information"""
     return {
@@ -1010,7 +2280,7 @@ async def get_contact_info(user: dict = Depends(get_current_user)):
         })
     }
 
-@api_router.put("/profile/contacts")
+@app.put("/api/profile/contacts")
 async def update_contact_info(data: ContactInfoUpdate, user: dict = Depends(get_current_user)):
     """Update user's contact information (email and social links)"""
     update_data = {}
@@ -1031,10 +2301,11 @@ async def update_contact_info(data: ContactInfoUpdate, user: dict = Depends(get_
         raise HTTPException(status_code=400, detail="Нет данных для обновления")
     
     await db.users.update_one({"id": user["id"]}, {"$set": update_data})
+    await invalidate_user_caches(user["id"])
     
     return {"message": "Контактная информация обновлена"}
 
-@api_router.get("/users/{user_id}/pages")
+@app.get("/api/users/{user_id}/pages")
 async def get_user_pages_public(user_id: str):
     """Get all active pages for a user (for site navigation)"""
     pages = await db.pages.find(
@@ -1051,7 +2322,7 @@ class VerificationRequest(BaseModel):
     social_links: str  # Links to social media profiles
     description: str  # Why they should be verified
 
-@api_router.get("/verification/status")
+@app.get("/api/verification/status")
 async def get_verification_status(user: dict = Depends(get_current_user)):
     """Get current verification status"""
     # Get pending request if any
@@ -1067,7 +2338,7 @@ async def get_verification_status(user: dict = Depends(get_current_user)):
         "pending_request": request
     }
 
-@api_router.post("/verification/request")
+@app.post("/api/verification/request")
 async def submit_verification_request(data: VerificationRequest, user: dict = Depends(get_current_user)):
     """Submit verification request"""
     
@@ -1103,7 +2374,7 @@ async def submit_verification_request(data: VerificationRequest, user: dict = De
     
     return {"message": "Заявка на верификацию отправлена", "request_id": request["id"]}
 
-@api_router.put("/settings/verification-badge")
+@app.put("/api/settings/verification-badge")
 async def toggle_verification_badge(user: dict = Depends(get_current_user)):
     """Toggle verification badge visibility"""
     current = user.get("show_verification_badge", True)
@@ -1111,11 +2382,13 @@ async def toggle_verification_badge(user: dict = Depends(get_current_user)):
         {"id": user["id"]},
         {"$set": {"show_verification_badge": not current}}
     )
+    await invalidate_user_caches(user["id"])
+    
     return {"show_badge": not current}
 
 # ===================== NOTIFICATIONS ROUTES =====================
 
-@api_router.get("/notifications")
+@app.get("/api/notifications")
 async def get_notifications(user: dict = Depends(get_current_user)):
     """Get user notifications"""
     notifications = await db.notifications.find(
@@ -1130,7 +2403,7 @@ async def get_notifications(user: dict = Depends(get_current_user)):
     
     return {"notifications": notifications, "unread_count": unread_count}
 
-@api_router.put("/notifications/{notification_id}/read")
+@app.put("/api/notifications/{notification_id}/read")
 async def mark_notification_read(notification_id: str, user: dict = Depends(get_current_user)):
     """Mark notification as read"""
     await db.notifications.update_one(
@@ -1139,7 +2412,7 @@ async def mark_notification_read(notification_id: str, user: dict = Depends(get_
     )
     return {"success": True}
 
-@api_router.put("/notifications/read-all")
+@app.put("/api/notifications/read-all")
 async def mark_all_notifications_read(user: dict = Depends(get_current_user)):
     """Mark all notifications as read"""
     await db.notifications.update_many(
@@ -1150,7 +2423,7 @@ async def mark_all_notifications_read(user: dict = Depends(get_current_user)):
 
 # ===================== PAGE ROUTES =====================
 
-@api_router.get("/pages")
+@app.get("/api/pages")
 async def get_user_pages(user: dict = Depends(get_current_user)):
     # Sort by created_at descending - newest first
     pages = await db.pages.find({"user_id": user["id"]}, {"_id": 0}).sort("created_at", -1).to_list(100)
@@ -1166,7 +2439,7 @@ async def get_user_pages(user: dict = Depends(get_current_user)):
     
     return pages
 
-@api_router.post("/pages")
+@app.post("/api/pages")
 async def create_page(data: PageCreate, user: dict = Depends(get_current_user)):
     
     # Check page limit
@@ -1204,9 +2477,10 @@ async def create_page(data: PageCreate, user: dict = Depends(get_current_user)):
     
     await db.pages.insert_one(page)
     page.pop("_id", None)
+    await set_page_route(page)
     return page
 
-@api_router.get("/pages/{page_id}")
+@app.get("/api/pages/{page_id}")
 async def get_page(page_id: str, user: dict = Depends(get_current_user)):
     # Use admin access check - owner/admin/moder can access any page
     page = await get_page_with_admin_access(page_id, user)
@@ -1215,7 +2489,7 @@ async def get_page(page_id: str, user: dict = Depends(get_current_user)):
     page["links"] = links
     return page
 
-@api_router.put("/pages/{page_id}")
+@app.put("/api/pages/{page_id}")
 async def update_page(page_id: str, data: PageUpdate, user: dict = Depends(get_current_user)):
     # Use admin access check - owner/admin/moder can edit any page
     page = await get_page_with_admin_access(page_id, user)
@@ -1229,27 +2503,35 @@ async def update_page(page_id: str, data: PageUpdate, user: dict = Depends(get_c
             raise HTTPException(status_code=400, detail="Slug already exists")
     
     if update_data:
-        await db.pages.update_one({"id": page_id}, {"$set": update_data})
+        await db.pages.update_one({"id": page_id}, {"$set": update_data, "$inc": {"version": 1}})
+        invalidate_og_cache(slug=page["slug"])
     
     updated = await db.pages.find_one({"id": page_id}, {"_id": 0})
+    if update_data:
+        await set_page_route(updated, old_slug=page["slug"])
     return updated
 
-@api_router.delete("/pages/{page_id}")
+@app.delete("/api/pages/{page_id}")
 async def delete_page(page_id: str, user: dict = Depends(get_current_user)):
     # Use admin access check - owner/admin/moder can delete any page
     page = await get_page_with_admin_access(page_id, user)
     
     await db.pages.delete_one({"id": page_id})
+    await remove_page_routes([page_id])
+    invalidate_og_cache(slug=page["slug"])
+    remove_og_cards(page_id)
     
-    # Delete associated links and clicks
+    # Delete associated links and events
     await db.links.delete_many({"page_id": page_id})
-    await db.clicks.delete_many({"page_id": page_id})
+    await delete_page_events([page_id])
+    await db.page_analytics.delete_one({"page_id": page_id})
+    await db.page_daily_uniques.delete_many({"page_id": page_id})
     
     return {"message": "Page deleted"}
 
 # ===================== LINK ROUTES =====================
 
-@api_router.get("/pages/{page_id}/links")
+@app.get("/api/pages/{page_id}/links")
 async def get_page_links(page_id: str, user: dict = Depends(get_current_user)):
     # Use admin access check
     page = await get_page_with_admin_access(page_id, user)
@@ -1257,7 +2539,7 @@ async def get_page_links(page_id: str, user: dict = Depends(get_current_user)):
     links = await db.links.find({"page_id": page_id}, {"_id": 0}).sort("order", 1).to_list(100)
     return links
 
-@api_router.post("/pages/{page_id}/links")
+@app.post("/api/pages/{page_id}/links")
 async def create_link(page_id: str, data: LinkCreate, user: dict = Depends(get_current_user)):
     # Use admin access check
     page = await get_page_with_admin_access(page_id, user)
@@ -1278,10 +2560,11 @@ async def create_link(page_id: str, data: LinkCreate, user: dict = Depends(get_c
     }
     
     await db.links.insert_one(link)
+    await publish_page_content_change(page_id)
     link.pop("_id", None)
     return link
 
-@api_router.put("/pages/{page_id}/links/reorder")
+@app.put("/api/pages/{page_id}/links/reorder")
 async def reorder_links(page_id: str, data: LinkReorder, user: dict = Depends(get_current_user)):
     # Use admin access check
     page = await get_page_with_admin_access(page_id, user)
@@ -1292,12 +2575,13 @@ async def reorder_links(page_id: str, data: LinkReorder, user: dict = Depends(ge
             {"id": link_id, "page_id": page_id},
             {"$set": {"order": index}}
         )
+    await publish_page_content_change(page_id)
     
     # Return updated links in new order
     links = await db.links.find({"page_id": page_id}, {"_id": 0}).sort("order", 1).to_list(100)
     return links
 
-@api_router.put("/pages/{page_id}/links/{link_id}")
+@app.put("/api/pages/{page_id}/links/{link_id}")
 async def update_link(page_id: str, link_id: str, data: LinkUpdate, user: dict = Depends(get_current_user)):
     # Use admin access check
     page = await get_page_with_admin_access(page_id, user)
@@ -1305,11 +2589,12 @@ async def update_link(page_id: str, link_id: str, data: LinkUpdate, user: dict =
     update_data = {k: v for k, v in data.model_dump().items() if v is not None}
     if update_data:
         await db.links.update_one({"id": link_id, "page_id": page_id}, {"$set": update_data})
+        await publish_page_content_change(page_id)
     
     updated = await db.links.find_one({"id": link_id}, {"_id": 0})
     return updated
 
-@api_router.delete("/pages/{page_id}/links/{link_id}")
+@app.delete("/api/pages/{page_id}/links/{link_id}")
 async def delete_link(page_id: str, link_id: str, user: dict = Depends(get_current_user)):
     # Use admin access check
     page = await get_page_with_admin_access(page_id, user)
@@ -1317,6 +2602,7 @@ async def delete_link(page_id: str, link_id: str, user: dict = Depends(get_curre
     result = await db.links.delete_one({"id": link_id, "page_id": page_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Link not found")
+    await publish_page_content_change(page_id)
     
     return {"message": "Link deleted"}
 
@@ -1327,24 +2613,12 @@ class WaitlistRequest(BaseModel):
     feature: Optional[str] = ""
     language: Optional[str] = "en"
 
-# Simple in-memory rate limiting (per IP)
-waitlist_rate_limit = {}
-WAITLIST_RATE_LIMIT_SECONDS = 60
-
-@api_router.post("/waitlist")
+@app.post("/api/waitlist", dependencies=[Depends(WAITLIST_RATE_LIMIT)])
 async def add_to_waitlist(data: WaitlistRequest, request: Request):
     """Add email to waitlist for PRO features"""
-    # Rate limiting by IP
-    client_ip = request.client.host if request.client else "unknown"
+    client_ip = get_client_ip(request) or "unknown"
     now = datetime.now(timezone.utc)
     
-    if client_ip in waitlist_rate_limit:
-        last_request = waitlist_rate_limit[client_ip]
-        if (now - last_request).total_seconds() < WAITLIST_RATE_LIMIT_SECONDS:
-            raise HTTPException(status_code=429, detail="Too many requests. Please try again later.")
-    
-    waitlist_rate_limit[client_ip] = now
-    
     # Check if email already exists
     existing = await db.waitlist.find_one({"email": data.email.lower()})
     if existing:
@@ -1396,7 +2670,7 @@ async def add_to_waitlist(data: WaitlistRequest, request: Request):
             
             lang = data.language if data.language in subjects else "en"
             
-            resend.Emails.send({
+            await send_email({
                 "from": SENDER_EMAIL,
                 "to": data.email,
                 "subject": subjects[lang],
@@ -1410,7 +2684,7 @@ async def add_to_waitlist(data: WaitlistRequest, request: Request):
 
 # ===================== OG ENDPOINT FOR BOTS =====================
 
-@api_router.get("/og-check/{slug}")
+@app.get("/api/og-check/{slug}")
 async def check_og_for_bots(slug: str, request: Request):
     """
     Endpoint that checks User-Agent and returns either:
@@ -1420,29 +2694,42 @@ async def check_og_for_bots(slug: str, request: Request):
     user_agent = request.headers.get('user-agent', '')
     
     if is_bot(user_agent):
-        # Get page data for OG tags
-        page_data = await get_page_for_og(slug)
-        if not page_data:
+        # Get rendered OG HTML
+        entry = await get_og_entry(slug)
+        if not entry:
             return JSONResponse({"is_bot": True, "page_found": False})
         
-        # Generate OG HTML
-        html = generate_og_html(
-            slug=slug,
-            title=page_data['title'],
-            cover_image=page_data['cover_image'],
-            language=page_data['language']
-        )
-        
         logging.info(f"Serving OG HTML for bot: {user_agent[:50]}... slug: {slug}")
-        return HTMLResponse(content=html, status_code=200)
+        return og_html_response(entry, request.headers.get('if-none-match', ''))
     
     return JSONResponse({"is_bot": False, "redirect": f"/{slug}"})
 
+@app.get("/api/og-image/{slug}.jpg")
+async def get_og_image(slug: str):
+    """Serve the 1200x630 Open Graph card for a page (rendered once per page version)"""
+    entry = await get_og_entry(slug)
+    if not entry:
+        raise HTTPException(status_code=404, detail="Page not found")
+    
+    try:
+        card_path = await get_og_card_path(entry)
+    except Exception as e:
+        logging.error(f"OG card render failed for {slug}: {e}")
+        raise HTTPException(status_code=500, detail="Card rendering failed")
+    
+    # A card missing its cover only until the fetch is retried
+    max_age = OG_CARD_FAILED_RETRY_SECONDS if card_path.name.endswith(".nocover.jpg") else 86400
+    return FileResponse(
+        card_path,
+        media_type="image/jpeg",
+        headers={"Cache-Control": f"public, max-age={max_age}"}
+    )
+
 # ===================== SHARE LINK ROUTE FOR SOCIAL MEDIA =====================
 # Use /api/s/{slug} for sharing links that bots will crawl correctly
 # Example: https://mus.link/api/s/artist-name (users share this link)
 
-@api_router.get("/s/{slug}")
+@app.get("/api/s/{slug}")
 async def share_link_with_og(slug: str, request: Request):
     """
     Share link route with OG tags for social media bots.
@@ -1452,40 +2739,37 @@ async def share_link_with_og(slug: str, request: Request):
     user_agent = request.headers.get('user-agent', '')
     frontend_url = os.environ.get('FRONTEND_URL', 'http://localhost:3000')
     
-    # Get page data
-    page_data = await get_page_for_og(slug)
+    # Get rendered OG HTML (also tells us whether the page exists)
+    entry = await get_og_entry(slug)
     
-    if not page_data:
+    if not entry:
         # Page not found, redirect to home
         return RedirectResponse(url=frontend_url, status_code=302)
     
     if is_bot(user_agent):
-        # Generate OG HTML for bots
-        html = generate_og_html(
-            slug=slug,
-            title=page_data['title'],
-            cover_image=page_data['cover_image'],
-            language=page_data['language']
-        )
         logging.info(f"Serving OG for bot via /api/s/: {user_agent[:50]}... slug: {slug}")
-        return HTMLResponse(content=html)
+        return og_html_response(entry, request.headers.get('if-none-match', ''))
     
     # For regular users, redirect to the actual page
     return RedirectResponse(url=f"{frontend_url}/{slug}", status_code=302)
 
 # ===================== PUBLIC ROUTES =====================
 
-@api_router.get("/artist/{slug}")
+@app.get("/api/artist/{slug}")
 async def get_public_page(slug: str):
-    page = await db.pages.find_one({"slug": slug, "status": "active"}, {"_id": 0})
-    if not page:
+    route = await lookup_slug_route(slug)
+    if not route or route["status"] != "active":
         raise HTTPException(status_code=404, detail="Page not found")
     
-    # Increment view count
-    await db.pages.update_one({"slug": slug}, {"$inc": {"views": 1}})
+    cached = await load_public_page(route["page_id"])
+    if not cached:
+        raise HTTPException(status_code=404, detail="Page not found")
+    page = dict(cached["page"])
     
-    links = await db.links.find({"page_id": page["id"], "active": True}, {"_id": 0}).sort("order", 1).to_list(100)
-    page["links"] = links
+    # Increment view count (flushed in batches)
+    record_page_view(page["id"])
+    
+    page["links"] = cached["links"]
     page["views"] = page.get("views", 0) + 1
     
     # Get user info (verification, site navigation, plan features, and contact info)
@@ -1510,7 +2794,753 @@ async def get_public_page(slug: str):
     
     return page
 
-@api_router.get("/click/{link_id}")
+# ===================== ANALYTICS EVENT STORAGE =====================
+
+# Clicks, views and shares live in time-series collections: `timestamp` is a
+# native BSON date and `meta` ({page_id[, link_id]}) is the metaField, so
+# per-page range queries scan only that page's buckets.
+# The old plain collections (ISO-string timestamps) are copied over by the
+# backfill_time_series_events migration and dropped once fully migrated.
+EVENT_COLLECTIONS = {
+    # time-series collection: (legacy collection, meta fields)
+    "click_events": ("clicks", ("page_id", "link_id")),
+    "view_events": ("views", ("page_id",)),
+    "share_events": ("shares", ("page_id",)),
+}
+EVENT_BACKFILL_BATCH_SIZE = 1000
+
+def event_doc(meta: dict, timestamp: Optional[datetime] = None, **fields) -> dict:
+    """Build a time-series event document"""
+    return {
+        "timestamp": timestamp or datetime.now(timezone.utc),
+        "meta": meta,
+        **fields
+    }
+
+async def delete_page_events(page_ids: List[str]):
+    """Delete the events of pages, including rows still in legacy collections awaiting the backfill"""
+    for name, (legacy_name, _) in EVENT_COLLECTIONS.items():
+        await db[name].delete_many({"meta.page_id": {"$in": page_ids}})
+        await db[legacy_name].delete_many({"page_id": {"$in": page_ids}})
+
+async def ensure_event_collections():
+    """Create the time-series event collections (indexes come from INDEX_REGISTRY)"""
+    existing = set(await db.list_collection_names())
+    for name in EVENT_COLLECTIONS:
+        if name not in existing:
+            try:
+                await db.create_collection(name, timeseries={
+                    "timeField": "timestamp",
+                    "metaField": "meta",
+                    "granularity": "hours"
+                })
+            except CollectionInvalid:
+                pass  # created concurrently by another worker
+
+def legacy_event_to_doc(legacy: dict, meta_fields: tuple) -> Optional[dict]:
+    """Convert a legacy event (ISO-string timestamp, flat ids) to a time-series document"""
+    try:
+        timestamp = datetime.fromisoformat(legacy["timestamp"])
+    except (KeyError, TypeError, ValueError):
+        timestamp = legacy["_id"].generation_time
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    
+    meta = {field: legacy.get(field) for field in meta_fields}
+    fields = {k: v for k, v in legacy.items() if k not in ("_id", "timestamp", *meta_fields)}
+    # Normalize pre-localization placeholders
+    for key in ("country", "city"):
+        if fields.get(key) == "Unknown":
+            fields[key] = "Неизвестно"
+    return event_doc(meta, timestamp, **fields)
+
+async def backfill_event_collection(name: str) -> int:
+    """
+    Move one legacy collection into its time-series collection. Copied records
+    are deleted from the legacy collection, which is dropped only once empty,
+    so records written there while the backfill runs are moved too. Records
+    of pages deleted in the meantime are dropped instead of copied.
+    """
+    legacy_name, meta_fields = EVENT_COLLECTIONS[name]
+    if legacy_name not in await db.list_collection_names():
+        return 0
+    
+    progress_key = f"event_backfill:{legacy_name}"
+    progress = await db.app_settings.find_one({"key": progress_key}) or {}
+    copied = progress.get("copied", 0)
+    
+    while True:
+        batch = await db[legacy_name].find({}).sort("_id", 1).limit(EVENT_BACKFILL_BATCH_SIZE).to_list(EVENT_BACKFILL_BATCH_SIZE)
+        if not batch:
+            break
+        
+        live_pages = set(await db.pages.distinct("id", {"id": {"$in": list({legacy.get("page_id") for legacy in batch})}}))
+        docs = [legacy_event_to_doc(legacy, meta_fields) for legacy in batch if legacy.get("page_id") in live_pages]
+        # Idempotent re-run of a batch interrupted before its progress was saved
+        event_ids = [d["id"] for d in docs if d.get("id")]
+        if event_ids:
+            await db[name].delete_many({"id": {"$in": event_ids}})
+        if docs:
+            await db[name].insert_many(docs, ordered=False)
+        await db[legacy_name].delete_many({"_id": {"$in": [legacy["_id"] for legacy in batch]}})
+        
+        copied += len(docs)
+        await db.app_settings.update_one(
+            {"key": progress_key},
+            {"$set": {"copied": copied, "updated_at": datetime.now(timezone.utc).isoformat()}},
+            upsert=True
+        )
+        await asyncio.sleep(0)
+    
+    if await db[legacy_name].count_documents({}, limit=1):
+        raise RuntimeError(f"{legacy_name} received new records during the backfill; re-run after restarting all workers")
+    await db[legacy_name].drop()
+    await db.app_settings.update_one(
+        {"key": progress_key},
+        {"$set": {"completed_at": datetime.now(timezone.utc).isoformat()}},
+        upsert=True
+    )
+    logging.info(f"Backfilled {copied} {legacy_name} records into {name}")
+    return copied
+
+# ===================== TRACKING INGESTION FILTER =====================
+
+# Drops crawler hits, prefetches and rapid repeats before anything is written.
+# Repeats are detected with a rotating Bloom filter keyed by (ip hash, event,
+# target): two generations, swapped every TRACKING_DEDUP_WINDOW_SECONDS, so a
+# key is remembered for one to two windows in fixed memory per worker.
+TRACKING_DEDUP_WINDOW_SECONDS = 30
+TRACKING_BLOOM_BITS = 1 << 20  # 128 KB per generation
+TRACKING_BLOOM_HASHES = 4
+# Crawler tokens: "<name>bot/<version>" style names, "+http://..." info URLs and
+# known link preview fetchers. Bare "bot" is not enough (CUBOT phones), and the
+# OG bot list is not used here: it names apps (viber, pinterest, yandex) whose
+# in-app browsers are real visitors.
+TRACKING_CRAWLER_REGEX = re.compile(
+    r"bot[/;)-]|bot$|slackbot|\+https?://|crawler|spider|headless|preview|fetcher"
+    r"|facebookexternalhit|facebookcatalog|^whatsapp/|embedly|outbrain|vkshare|python-requests|curl/|wget/",
+    re.IGNORECASE
+)
+# share_type values accepted by /track/share (also used in counter field names)
+SHARE_TYPES = ("link", "qr", "social")
+
+class RotatingBloomFilter:
+    """Time-windowed set membership with a bounded false positive rate"""
+    def __init__(self, bits: int, hashes: int, window_seconds: int):
+        self.bits = bits
+        self.hashes = hashes
+        self.window_seconds = window_seconds
+        self._current = bytearray(bits // 8)
+        self._previous = bytearray(bits // 8)
+        self._rotated_at = time.monotonic()
+    
+    def _positions(self, key: str) -> List[int]:
+        digest = hashlib.blake2b(key.encode(), digest_size=8 * self.hashes).digest()
+        return [int.from_bytes(digest[i * 8:(i + 1) * 8], "little") % self.bits for i in range(self.hashes)]
+    
+    def _rotate(self):
+        now = time.monotonic()
+        elapsed = now - self._rotated_at
+        if elapsed < self.window_seconds:
+            return
+        if elapsed >= 2 * self.window_seconds:
+            self._previous = bytearray(self.bits // 8)
+        else:
+            self._previous = self._current
+        self._current = bytearray(self.bits // 8)
+        self._rotated_at = now
+    
+    def seen_or_add(self, key: str) -> bool:
+        """Return True if key was added within the last window(s), otherwise remember it"""
+        self._rotate()
+        positions = self._positions(key)
+        in_current = all(self._current[p >> 3] & (1 << (p & 7)) for p in positions)
+        if in_current:
+            return True
+        in_previous = all(self._previous[p >> 3] & (1 << (p & 7)) for p in positions)
+        for p in positions:
+            self._current[p >> 3] |= 1 << (p & 7)
+        return in_previous
+
+_tracking_dedup_filter = RotatingBloomFilter(TRACKING_BLOOM_BITS, TRACKING_BLOOM_HASHES, TRACKING_DEDUP_WINDOW_SECONDS)
+_tracking_event_counts = defaultdict(int)  # "<event>:<accepted|bot|prefetch|duplicate>" -> count
+_tracking_counts_since = datetime.now(timezone.utc).isoformat()
+
+def is_tracking_crawler(user_agent: str) -> bool:
+    """Link preview bots plus generic crawlers and HTTP libraries"""
+    if not user_agent:
+        return True
+    return TRACKING_CRAWLER_REGEX.search(user_agent) is not None
+
+def should_record_event(event: str, target_id: str, request: Optional[Request]) -> bool:
+    """Decide whether a tracking hit is written; counts every decision"""
+    if request is None:
+        _tracking_event_counts[f"{event}:accepted"] += 1
+        return True
+    
+    reason = None
+    purpose = request.headers.get("Sec-Purpose") or request.headers.get("Purpose") or request.headers.get("X-Moz") or ""
+    if "prefetch" in purpose.lower():
+        reason = "prefetch"
+    elif is_tracking_crawler(request.headers.get("user-agent", "")):
+        reason = "bot"
+    else:
+        # Trusted hop only: a client rotating X-Forwarded-For must not look like new visitors
+        client_ip = get_trusted_client_ip(request) or ""
+        ip_hash = hashlib.sha256(client_ip.encode()).hexdigest()[:16]
+        if _tracking_dedup_filter.seen_or_add(f"{ip_hash}:{event}:{target_id}"):
+            reason = "duplicate"
+    
+    _tracking_event_counts[f"{event}:{reason or 'accepted'}"] += 1
+    return reason is None
+
+# ===================== PAGE ANALYTICS SKETCHES =====================
+
+# Per-page streaming summaries in page_analytics, so dashboards read
+# breakdowns without scanning click events:
+# - Space-Saving top-K of click countries, cities and referrer hosts, at most
+#   SKETCH_TOP_K_CAPACITY counters per dimension. A count overestimates by at
+#   most its stored error, and every value with more than
+#   clicks / capacity clicks is guaranteed to be listed. Dashboards report
+#   count - error, a lower bound that is exact for values never evicted.
+# Unique visitors are counted separately, per day (UNIQUE VISITORS below).
+# Workers accumulate exact deltas in memory and merge them every
+# SKETCH_FLUSH_SECONDS with a version-checked read-modify-write. The same
+# deltas, summed, go to the site-wide document (page_id SITE_SKETCH_ID).
+SKETCH_FLUSH_SECONDS = 10
+SKETCH_TOP_K_CAPACITY = 64
+SKETCH_DIMENSIONS = ("country", "city", "referrer")
+SKETCH_WRITE_RETRIES = 5
+SITE_SKETCH_ID = "_all"
+
+class SpaceSaving:
+    """Weighted Space-Saving summary: value -> [count, error]"""
+    def __init__(self, capacity: int, counters: Optional[list] = None):
+        self.capacity = capacity
+        self.counters = {value: [count, error] for value, count, error in (counters or [])}
+    
+    def add(self, value: str, weight: int = 1):
+        entry = self.counters.get(value)
+        if entry:
+            entry[0] += weight
+        elif len(self.counters) < self.capacity:
+            self.counters[value] = [weight, 0]
+        else:
+            # Evict the smallest counter; the newcomer inherits its count as error
+            victim = min(self.counters, key=lambda v: self.counters[v][0])
+            floor = self.counters.pop(victim)[0]
+            self.counters[value] = [floor + weight, floor]
+    
+    def to_list(self) -> list:
+        return [[value, count, error] for value, (count, error) in self.counters.items()]
+
+class HyperLogLog:
+    """
+    Distinct count estimate over 64-bit hashes: 2^precision one-byte registers
+    (~1.6% standard error at 12). Serialized sparse - (index, rank) triplets -
+    while that is smaller than the dense registers, so quiet days stay small.
+    """
+    def __init__(self, precision: int = 12, data: Optional[bytes] = None):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size)
+        if data and len(data) == self.size:
+            self.registers[:] = data
+        elif data:
+            for offset in range(0, len(data), 3):
+                self.registers[int.from_bytes(data[offset:offset + 2], "big")] = data[offset + 2]
+    
+    def to_bytes(self) -> bytes:
+        used = [(index, rank) for index, rank in enumerate(self.registers) if rank]
+        if len(used) * 3 >= self.size:
+            return bytes(self.registers)
+        return b"".join(index.to_bytes(2, "big") + bytes((rank,)) for index, rank in used)
+    
+    def add_hash(self, value: int):
+        index = value >> (64 - self.precision)
+        rest = value & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+    
+    def merge(self, other: "HyperLogLog"):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+    
+    def count(self) -> int:
+        m = self.size
+        estimate = (0.7213 / (1 + 1.079 / m)) * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Small range: linear counting
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+# Same host as referrer_host(), for aggregation pipelines ($regexFind capture 0)
+REFERRER_HOST_PATTERN = r"^(?:[A-Za-z][A-Za-z0-9+.-]*://)?(?:[^/?#@]*@)?(?:www\.)?([^/:?#]+)"
+
+# $group keys per dimension when seeding sketches from the click history
+SKETCH_HISTORY_GROUP_KEYS = {
+    "country": "$country",
+    "city": "$city",
+    # Full referrer URLs are near-unique per click: group by host in the pipeline
+    "referrer": {"$let": {
+        "vars": {"match": {"$regexFind": {"input": {"$ifNull": ["$referrer", ""]}, "regex": REFERRER_HOST_PATTERN}}},
+        "in": {"$toLower": {"$arrayElemAt": ["$$match.captures", 0]}}
+    }}
+}
+
+def referrer_host(referrer: Optional[str]) -> Optional[str]:
+    if not referrer:
+        return None
+    host = urlparse(referrer if "://" in referrer else f"//{referrer}").hostname
+    if host and host.startswith("www."):
+        host = host[4:]
+    return host or None
+
+def new_sketch_delta() -> dict:
+    return {"clicks": 0, **{dimension: Counter() for dimension in SKETCH_DIMENSIONS}}
+
+_pending_sketches = defaultdict(new_sketch_delta)
+
+def record_click_sketch(page_id: str, country: str, city: str, referrer: Optional[str]):
+    delta = _pending_sketches[page_id]
+    delta["clicks"] += 1
+    delta["country"][country or "Неизвестно"] += 1
+    delta["city"][city or "Неизвестно"] += 1
+    host = referrer_host(referrer)
+    if host:
+        delta["referrer"][host] += 1
+
+def merge_sketch_delta(target: dict, delta: dict):
+    target["clicks"] += delta["clicks"]
+    for dimension in SKETCH_DIMENSIONS:
+        target[dimension].update(delta[dimension])
+
+async def apply_sketch_delta(page_id: str, delta: dict, extra: Optional[dict] = None):
+    """Merge a delta into the stored sketches, retrying when another worker wrote in between"""
+    for _ in range(SKETCH_WRITE_RETRIES):
+        doc = await db.page_analytics.find_one({"page_id": page_id}, {"_id": 0}) or {}
+        version = doc.get("version", 0)
+        top = {}
+        for dimension in SKETCH_DIMENSIONS:
+            summary = SpaceSaving(SKETCH_TOP_K_CAPACITY, doc.get("top", {}).get(dimension))
+            for value, weight in delta[dimension].most_common():
+                summary.add(value, weight)
+            top[dimension] = summary.to_list()
+        try:
+            await db.page_analytics.update_one(
+                {"page_id": page_id, "version": version},
+                {
+                    "$set": {
+                        "top": top,
+                        "version": version + 1,
+                        "updated_at": datetime.now(timezone.utc).isoformat(),
+                        **(extra or {})
+                    },
+                    "$inc": {"clicks": delta["clicks"]}
+                },
+                upsert=True
+            )
+            return
+        except DuplicateKeyError:
+            continue  # version moved on: re-read and merge again
+    raise RuntimeError(f"Sketch update for {page_id} kept conflicting")
+
+async def flush_page_sketches():
+    """Merge accumulated deltas into page_analytics, plus their sum into the site-wide document"""
+    if not _pending_sketches:
+        return
+    pending = dict(_pending_sketches)
+    _pending_sketches.clear()
+    # A site delta in pending is one re-queued by a failed flush
+    site = pending.pop(SITE_SKETCH_ID, None) or new_sketch_delta()
+    for delta in pending.values():
+        merge_sketch_delta(site, delta)
+    pending[SITE_SKETCH_ID] = site
+    
+    items = list(pending.items())
+    for start in range(0, len(items), 50):
+        chunk = items[start:start + 50]
+        results = await asyncio.gather(*(apply_sketch_delta(p, d) for p, d in chunk), return_exceptions=True)
+        for (page_id, delta), result in zip(chunk, results):
+            if isinstance(result, Exception):
+                # Put it back so the next flush retries it
+                merge_sketch_delta(_pending_sketches[page_id], delta)
+                logging.warning(f"Sketch flush failed for {page_id}: {result}")
+
+async def mark_sketch_ingestion_started() -> datetime:
+    """
+    Record the first boot of a worker that updates sketches at ingestion and
+    return it: clicks before it are seeded by migration 5, later ones are
+    already counted live.
+    """
+    await db.app_settings.update_one(
+        {"key": "sketch_ingestion_started_at"},
+        {"$min": {"value": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+    settings = await db.app_settings.find_one({"key": "sketch_ingestion_started_at"}, {"_id": 0, "value": 1})
+    started = settings["value"]
+    return started if started.tzinfo else started.replace(tzinfo=timezone.utc)
+
+async def page_sketch_flush_loop():
+    while True:
+        await asyncio.sleep(SKETCH_FLUSH_SECONDS)
+        await flush_page_sketches()
+        await flush_unique_visitors()
+
+async def load_page_sketches(page_ids: List[str]) -> List[dict]:
+    return await db.page_analytics.find({"page_id": {"$in": page_ids}}, {"_id": 0}).to_list(None)
+
+def sketch_top(docs: List[dict], dimension: str, limit: int = 10) -> List[tuple]:
+    """Top values of a dimension across one or more sketches (guaranteed counts: count - error)"""
+    totals = Counter()
+    for doc in docs:
+        for value, count, error in doc.get("top", {}).get(dimension, []):
+            totals[value] += count - error
+    return sorted(totals.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+NO_SKETCH_BREAKDOWNS = {"by_country": [], "by_city": [], "by_referrer": []}
+
+def sketch_breakdowns(docs: List[dict]) -> dict:
+    """by_country / by_city / by_referrer as the analytics endpoints return them"""
+    return {
+        "by_country": [{"country": value, "clicks": count} for value, count in sketch_top(docs, "country")],
+        "by_city": [{"city": value, "clicks": count} for value, count in sketch_top(docs, "city")],
+        "by_referrer": [{"referrer": value, "clicks": count} for value, count in sketch_top(docs, "referrer")]
+    }
+
+# ===================== UNIQUE VISITORS =====================
+
+# A visitor id is a salted hash of (IP, User-Agent); no IP is stored. The salt
+# is shared by all workers through app_settings and replaced every UTC day,
+# and the previous days' salts are deleted, so ids can neither be reversed
+# nor linked across days. Each page gets one page_daily_uniques document per
+# day holding two HyperLogLogs: visitors (views and clicks) and clickers.
+# The site-wide totals live under page_id SITE_SKETCH_ID.
+# A visitor returning on another day carries a new id, so merged day
+# sketches count visitor-days: a visitor once per day they visit. The API
+# names the figures accordingly (visitor_days, clicker_days); for a single
+# day they are that day's unique visitors and clickers.
+# Salts are loaded a day ahead (refresh_visitor_salts), so ingestion only
+# reads them from memory.
+UNIQUES_HLL_PRECISION = 12
+VISITOR_SALT_REFRESH_SECONDS = 3600
+NO_UNIQUES = {"visitor_days": None, "clicker_days": None, "visitor_day_ctr": None}
+_visitor_salts = {}  # UTC day -> salt
+
+async def load_visitor_salt(day: str) -> bytes:
+    """Fetch the shared salt of a day, creating it if this worker is first"""
+    key = f"visitor_salt:{day}"
+    try:
+        doc = await db.app_settings.find_one_and_update(
+            {"key": key},
+            {"$setOnInsert": {"value": secrets.token_hex(32), "created_at": datetime.now(timezone.utc).isoformat()}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # Another worker created it first
+        doc = await db.app_settings.find_one({"key": key})
+    _visitor_salts[day] = bytes.fromhex(doc["value"])
+    return _visitor_salts[day]
+
+async def get_visitor_salt(day: str) -> bytes:
+    return _visitor_salts.get(day) or await load_visitor_salt(day)
+
+async def refresh_visitor_salts():
+    """Load today's and tomorrow's salts and forget (here and in the database) older ones"""
+    now = datetime.now(timezone.utc)
+    today = now.strftime("%Y-%m-%d")
+    for day in (today, (now + timedelta(days=1)).strftime("%Y-%m-%d")):
+        if day not in _visitor_salts:
+            await load_visitor_salt(day)
+    for day in [d for d in _visitor_salts if d < today]:
+        del _visitor_salts[day]
+    await db.app_settings.delete_many({"key": {"$regex": "^visitor_salt:", "$lt": f"visitor_salt:{today}"}})
+
+async def visitor_salt_refresh_loop():
+    while True:
+        await asyncio.sleep(VISITOR_SALT_REFRESH_SECONDS)
+        try:
+            await refresh_visitor_salts()
+        except Exception as e:
+            logging.warning(f"Visitor salt refresh failed: {e}")
+
+async def visitor_id(request: Optional[Request]) -> Optional[tuple]:
+    """(UTC day, 64-bit salted visitor hash) for the request"""
+    if not request:
+        return None
+    day = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    salt = await get_visitor_salt(day)
+    key = f"{get_client_ip(request) or ''}|{request.headers.get('user-agent', '')}"
+    return day, int.from_bytes(hashlib.blake2b(key.encode(), key=salt, digest_size=8).digest(), "big")
+
+def new_uniques_delta() -> dict:
+    return {"visitors": set(), "clickers": set()}
+
+_pending_uniques = defaultdict(new_uniques_delta)  # (page_id, day) -> delta
+
+def record_unique_visitor(page_id: str, visitor: Optional[tuple], clicked: bool = False):
+    if not visitor:
+        return
+    day, visitor_hash = visitor
+    delta = _pending_uniques[(page_id, day)]
+    delta["visitors"].add(visitor_hash)
+    if clicked:
+        delta["clickers"].add(visitor_hash)
+
+async def apply_uniques_delta(page_id: str, day: str, delta: dict):
+    """Merge a delta into the page's day sketches, retrying when another worker wrote in between"""
+    doc_id = f"{page_id}:{day}"
+    for _ in range(SKETCH_WRITE_RETRIES):
+        doc = await db.page_daily_uniques.find_one({"_id": doc_id}) or {}
+        version = doc.get("version", 0)
+        update = {"page_id": page_id, "date": day, "version": version + 1}
+        for field in ("visitors", "clickers"):
+            hll = HyperLogLog(UNIQUES_HLL_PRECISION, doc.get(field))
+            for visitor_hash in delta[field]:
+                hll.add_hash(visitor_hash)
+            update[field] = hll.to_bytes()
+        try:
+            await db.page_daily_uniques.update_one({"_id": doc_id, "version": version}, {"$set": update}, upsert=True)
+            return
+        except DuplicateKeyError:
+            continue
+    raise RuntimeError(f"Uniques update for {doc_id} kept conflicting")
+
+async def flush_unique_visitors():
+    """Merge accumulated visitor hashes into the day sketches, per page and site-wide"""
+    if not _pending_uniques:
+        return
+    pending = dict(_pending_uniques)
+    _pending_uniques.clear()
+    for (page_id, day), delta in list(pending.items()):
+        site = pending.setdefault((SITE_SKETCH_ID, day), new_uniques_delta())
+        if page_id != SITE_SKETCH_ID:
+            site["visitors"] |= delta["visitors"]
+            site["clickers"] |= delta["clickers"]
+    
+    items = list(pending.items())
+    for start in range(0, len(items), 50):
+        chunk = items[start:start + 50]
+        results = await asyncio.gather(*(apply_uniques_delta(p, d, delta) for (p, d), delta in chunk), return_exceptions=True)
+        for ((page_id, day), delta), result in zip(chunk, results):
+            if isinstance(result, Exception):
+                # Put it back so the next flush retries it
+                retry = _pending_uniques[(page_id, day)]
+                retry["visitors"] |= delta["visitors"]
+                retry["clickers"] |= delta["clickers"]
+                logging.warning(f"Uniques flush failed for {page_id} {day}: {result}")
+
+async def load_daily_uniques(page_ids: List[str], since_day: str) -> List[dict]:
+    return await db.page_daily_uniques.find(
+        {"page_id": {"$in": page_ids}, "date": {"$gte": since_day}},
+        {"_id": 0, "date": 1, "visitors": 1, "clickers": 1}
+    ).to_list(None)
+
+def merge_uniques(docs: List[dict]) -> dict:
+    """Visitor-days over the union of day sketches (any pages, any days)"""
+    visitors = HyperLogLog(UNIQUES_HLL_PRECISION)
+    clickers = HyperLogLog(UNIQUES_HLL_PRECISION)
+    for doc in docs:
+        visitors.merge(HyperLogLog(UNIQUES_HLL_PRECISION, doc.get("visitors")))
+        clickers.merge(HyperLogLog(UNIQUES_HLL_PRECISION, doc.get("clickers")))
+    visitor_days = visitors.count()
+    # Estimates are independent; a clicker is always a visitor
+    clicker_days = min(clickers.count(), visitor_days)
+    return {
+        "visitor_days": visitor_days,
+        "clicker_days": clicker_days,
+        "visitor_day_ctr": round(clicker_days / visitor_days, 4) if visitor_days else None
+    }
+
+def uniques_period(day: str, granularity: str) -> str:
+    if granularity == "week":
+        year, week, _ = datetime.strptime(day, "%Y-%m-%d").isocalendar()
+        return f"{year}-W{week:02d}"
+    if granularity == "month":
+        return day[:7]
+    return day
+
+async def recent_uniques(page_ids: List[str]) -> dict:
+    """Visitor-days over the dashboards' timeline window"""
+    since = datetime.now(timezone.utc) - timedelta(days=ANALYTICS_TIMELINE_DAYS)
+    return merge_uniques(await load_daily_uniques(page_ids, since.strftime("%Y-%m-%d")))
+
+# ===================== LIVE ANALYTICS =====================
+
+# Counter increments from the ingestion path (views, clicks, shares, QR
+# scans) are published to an in-process pub/sub. Each SSE subscriber of
+# /api/analytics/{page_id}/live has its own bounded queue. Publishing never
+# blocks ingestion: when a slow subscriber's queue is full, the increment is
+# kept in its overflow counter and sent with the next message.
+# With LIVE_ANALYTICS_BACKEND=mongo, workers with subscribers list their
+# pages in live_subscriptions (refreshed every LIVE_SUBSCRIPTIONS_REFRESH_SECONDS,
+# expired by TTL). Each worker batches increments for pages watched on other
+# workers into one live_analytics document every LIVE_BROADCAST_SECONDS; with
+# no subscriber anywhere nothing is written. The other workers receive them
+# through a change stream (replica sets) or, on a standalone mongod, by
+# polling while they have subscribers. A new subscriber gets the other
+# workers' increments once they have re-read the registry. "memory" keeps the
+# stream to the worker that ingested the event.
+LIVE_ANALYTICS_BACKEND = os.environ.get('LIVE_ANALYTICS_BACKEND', 'mongo')
+LIVE_QUEUE_SIZE = 100
+LIVE_BROADCAST_SECONDS = 1
+LIVE_SUBSCRIPTIONS_REFRESH_SECONDS = 5
+LIVE_HEARTBEAT_SECONDS = 15
+LIVE_RETENTION = timedelta(minutes=5)
+LIVE_COUNTERS = ("views", "clicks", "shares", "qr_scans")
+LIVE_WORKER_ID = uuid.uuid4().hex
+
+class LiveSubscriber:
+    def __init__(self, page_id: str):
+        self.page_id = page_id
+        self.queue = asyncio.Queue(maxsize=LIVE_QUEUE_SIZE)
+        self.overflow = Counter()
+    
+    def push(self, delta: dict):
+        try:
+            self.queue.put_nowait(delta)
+        except asyncio.QueueFull:
+            self.overflow.update(delta)
+    
+    def drain(self, first: Optional[dict] = None) -> dict:
+        """Everything queued so far, folded into one increment"""
+        total = Counter(first or {})
+        while not self.queue.empty():
+            total.update(self.queue.get_nowait())
+        total.update(self.overflow)
+        self.overflow.clear()
+        return dict(total)
+
+_live_subscribers = defaultdict(set)  # page_id -> LiveSubscriber
+_live_outbox = defaultdict(Counter)  # page_id -> increments not yet broadcast
+_live_registry = {"remote_pages": set(), "registered": False, "dirty": False}
+
+def subscribe_live(page_id: str) -> LiveSubscriber:
+    subscriber = LiveSubscriber(page_id)
+    if page_id not in _live_subscribers:
+        _live_registry["dirty"] = True
+    _live_subscribers[page_id].add(subscriber)
+    return subscriber
+
+def unsubscribe_live(subscriber: LiveSubscriber):
+    subscribers = _live_subscribers.get(subscriber.page_id)
+    if subscribers is not None:
+        subscribers.discard(subscriber)
+        if not subscribers:
+            del _live_subscribers[subscriber.page_id]
+
+def deliver_live(page_id: str, delta: dict):
+    for subscriber in _live_subscribers.get(page_id, ()):
+        subscriber.push(delta)
+
+def publish_live(page_id: str, counter: str, count: int = 1):
+    """Called from the ingestion path for every recorded event"""
+    deliver_live(page_id, {counter: count})
+    if LIVE_ANALYTICS_BACKEND == "mongo" and page_id in _live_registry["remote_pages"]:
+        _live_outbox[page_id][counter] += count
+
+async def sync_live_subscriptions():
+    """Register this worker's watched pages and read the pages other workers watch"""
+    now = datetime.now(timezone.utc)
+    _live_registry["dirty"] = False
+    if _live_subscribers:
+        await db.live_subscriptions.update_one(
+            {"_id": LIVE_WORKER_ID},
+            {"$set": {
+                "pages": list(_live_subscribers),
+                "expires_at": now + timedelta(seconds=LIVE_SUBSCRIPTIONS_REFRESH_SECONDS * 3)
+            }},
+            upsert=True
+        )
+        _live_registry["registered"] = True
+    elif _live_registry["registered"]:
+        await db.live_subscriptions.delete_one({"_id": LIVE_WORKER_ID})
+        _live_registry["registered"] = False
+    _live_registry["remote_pages"] = set(await db.live_subscriptions.distinct(
+        "pages", {"_id": {"$ne": LIVE_WORKER_ID}, "expires_at": {"$gt": now}}
+    ))
+
+async def broadcast_live_increments():
+    """Write this worker's increments since the last call as one document"""
+    if not _live_outbox:
+        return
+    pending = {page_id: dict(counts) for page_id, counts in _live_outbox.items()}
+    _live_outbox.clear()
+    now = datetime.now(timezone.utc)
+    try:
+        await db.live_analytics.insert_one({
+            "worker": LIVE_WORKER_ID,
+            "pages": pending,
+            "created_at": now,
+            "expires_at": now + LIVE_RETENTION
+        })
+    except Exception as e:
+        # Live counters are best effort: the dashboards still read the stored totals
+        logging.warning(f"Live analytics broadcast failed: {e}")
+
+def deliver_remote_increments(doc: dict):
+    if doc.get("worker") == LIVE_WORKER_ID:
+        return
+    for page_id, counts in doc.get("pages", {}).items():
+        deliver_live(page_id, counts)
+
+async def live_broadcast_loop():
+    ticks = 0
+    while True:
+        await asyncio.sleep(LIVE_BROADCAST_SECONDS)
+        ticks += 1
+        if _live_registry["dirty"] or ticks * LIVE_BROADCAST_SECONDS >= LIVE_SUBSCRIPTIONS_REFRESH_SECONDS:
+            ticks = 0
+            try:
+                await sync_live_subscriptions()
+            except Exception as e:
+                logging.warning(f"Live subscriptions sync failed: {e}")
+        await broadcast_live_increments()
+
+async def poll_live_increments():
+    """Fallback for deployments without change streams"""
+    since = datetime.now(timezone.utc)
+    while True:
+        await asyncio.sleep(LIVE_BROADCAST_SECONDS)
+        if not _live_subscribers:
+            since = datetime.now(timezone.utc)
+            continue
+        try:
+            docs = await db.live_analytics.find(
+                {"created_at": {"$gt": since}, "worker": {"$ne": LIVE_WORKER_ID}},
+                {"_id": 0, "worker": 1, "pages": 1, "created_at": 1}
+            ).sort("created_at", 1).to_list(None)
+        except Exception as e:
+            logging.warning(f"Live analytics poll failed: {e}")
+            continue
+        for doc in docs:
+            deliver_remote_increments(doc)
+            since = max(since, as_utc(doc["created_at"]))
+
+async def live_listener_loop():
+    """Receive the other workers' increments"""
+    while True:
+        try:
+            async with db.live_analytics.watch([{"$match": {"operationType": "insert"}}]) as stream:
+                async for change in stream:
+                    deliver_remote_increments(change["fullDocument"])
+        except OperationFailure as e:
+            if e.code in (40573, 20):  # change streams need a replica set
+                logging.info("Change streams unavailable, polling live_analytics instead")
+                await poll_live_increments()
+                return
+            logging.warning(f"Live analytics change stream failed: {e}")
+        except Exception as e:
+            logging.warning(f"Live analytics change stream failed: {e}")
+        await asyncio.sleep(LIVE_BROADCAST_SECONDS)
+
+def sse_message(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.get("/api/click/{link_id}")
 async def track_click(
     link_id: str, 
     referrer: Optional[str] = None,
@@ -1520,6 +3550,10 @@ async def track_click(
     if not link:
         raise HTTPException(status_code=404, detail="Link not found")
     
+    allowed, _ = await TRACKING_RATE_LIMIT.check_request(request)
+    if not allowed or not should_record_event("click", link_id, request):
+        return RedirectResponse(url=link["url"], status_code=302)
+    
     # Get geo info from IP
     country = "Неизвестно"
     city = "Неизвестно"
@@ -1536,30 +3570,33 @@ async def track_click(
             city = geo["city"]
     
     # Track click with geo data
-    click = {
-        "id": str(uuid.uuid4()),
-        "link_id": link_id,
-        "page_id": link["page_id"],
-        "timestamp": datetime.now(timezone.utc).isoformat(),
-        "referrer": referrer,
-        "country": country,
-        "city": city,
-        "source": "link"
-    }
-    await db.clicks.insert_one(click)
+    click = event_doc(
+        {"page_id": link["page_id"], "link_id": link_id},
+        id=str(uuid.uuid4()),
+        referrer=referrer,
+        country=country,
+        city=city,
+        source="link"
+    )
+    await db.click_events.insert_one(click)
+    record_click_sketch(link["page_id"], country, city, referrer)
+    record_unique_visitor(link["page_id"], await visitor_id(request), clicked=True)
     
     # Increment click count
     await db.links.update_one({"id": link_id}, {"$inc": {"clicks": 1}})
+    publish_live(link["page_id"], "clicks")
     
     return RedirectResponse(url=link["url"], status_code=302)
 
 # Track page view with geo
-@api_router.post("/track/view/{page_id}")
+@app.post("/api/track/view/{page_id}", dependencies=[Depends(TRACKING_RATE_LIMIT)])
 async def track_page_view(page_id: str, request: Request = None):
-    page = await db.pages.find_one({"id": page_id})
-    if not page:
+    if not await lookup_page_slug(page_id):
         raise HTTPException(status_code=404, detail="Page not found")
     
+    if not should_record_event("view", page_id, request):
+        return {"success": True, "recorded": False}
+    
     country = "Неизвестно"
     city = "Неизвестно"
     if request:
@@ -1574,25 +3611,29 @@ async def track_page_view(page_id: str, request: Request = None):
             country = geo["country"]
             city = geo["city"]
     
-    view = {
-        "id": str(uuid.uuid4()),
-        "page_id": page_id,
-        "timestamp": datetime.now(timezone.utc).isoformat(),
-        "country": country,
-        "city": city,
-        "source": "direct"
-    }
-    await db.views.insert_one(view)
+    view = event_doc(
+        {"page_id": page_id},
+        id=str(uuid.uuid4()),
+        country=country,
+        city=city,
+        source="direct"
+    )
+    await db.view_events.insert_one(view)
+    record_unique_visitor(page_id, await visitor_id(request))
     
     return {"success": True}
 
 # Track share
-@api_router.post("/track/share/{page_id}")
+@app.post("/api/track/share/{page_id}", dependencies=[Depends(TRACKING_RATE_LIMIT)])
 async def track_share(page_id: str, share_type: str = "link", request: Request = None):
-    page = await db.pages.find_one({"id": page_id})
-    if not page:
+    if share_type not in SHARE_TYPES:
+        raise HTTPException(status_code=400, detail="Unknown share type")
+    if not await lookup_page_slug(page_id):
         raise HTTPException(status_code=404, detail="Page not found")
     
+    if not should_record_event(f"share_{share_type}", page_id, request):
+        return {"success": True, "recorded": False}
+    
     country = "Неизвестно"
     city = "Неизвестно"
     if request:
@@ -1607,28 +3648,33 @@ async def track_share(page_id: str, share_type: str = "link", request: Request =
             country = geo["country"]
             city = geo["city"]
     
-    share = {
-        "id": str(uuid.uuid4()),
-        "page_id": page_id,
-        "timestamp": datetime.now(timezone.utc).isoformat(),
-        "type": share_type,  # "link", "qr", "social"
-        "country": country,
-        "city": city
-    }
-    await db.shares.insert_one(share)
+    share = event_doc(
+        {"page_id": page_id},
+        id=str(uuid.uuid4()),
+        type=share_type,  # SHARE_TYPES
+        country=country,
+        city=city
+    )
+    await db.share_events.insert_one(share)
     
     # Increment share count on page
     await db.pages.update_one({"id": page_id}, {"$inc": {"shares": 1, f"shares_{share_type}": 1}})
+    publish_live(page_id, "shares")
     
     return {"success": True}
 
 # Track QR scan
-@api_router.get("/qr/{page_id}")
+@app.get("/api/qr/{page_id}")
 async def track_qr_scan(page_id: str, request: Request = None):
-    page = await db.pages.find_one({"id": page_id, "status": "active"}, {"_id": 0})
-    if not page:
+    slug = await lookup_page_slug(page_id)
+    route = await lookup_slug_route(slug) if slug else None
+    if not route or route["status"] != "active":
         raise HTTPException(status_code=404, detail="Page not found")
     
+    allowed, _ = await TRACKING_RATE_LIMIT.check_request(request)
+    if not allowed or not should_record_event("qr", page_id, request):
+        return RedirectResponse(url=f"/{slug}", status_code=302)
+    
     country = "Неизвестно"
     city = "Неизвестно"
     if request:
@@ -1644,25 +3690,25 @@ async def track_qr_scan(page_id: str, request: Request = None):
             city = geo["city"]
     
     # Track QR scan as a share
-    share = {
-        "id": str(uuid.uuid4()),
-        "page_id": page_id,
-        "timestamp": datetime.now(timezone.utc).isoformat(),
-        "type": "qr",
-        "country": country,
-        "city": city
-    }
-    await db.shares.insert_one(share)
+    share = event_doc(
+        {"page_id": page_id},
+        id=str(uuid.uuid4()),
+        type="qr",
+        country=country,
+        city=city
+    )
+    await db.share_events.insert_one(share)
     
     # Increment QR scan count
     await db.pages.update_one({"id": page_id}, {"$inc": {"qr_scans": 1}})
+    publish_live(page_id, "qr_scans")
     
     # Redirect to public page
-    return RedirectResponse(url=f"/{page['slug']}", status_code=302)
+    return RedirectResponse(url=f"/{slug}", status_code=302)
 
 # ===================== ANALYTICS ROUTES =====================
 
-@api_router.get("/analytics/{page_id}")
+@app.get("/api/analytics/{page_id}")
 async def get_page_analytics(page_id: str, user: dict = Depends(get_current_user)):
     page = await db.pages.find_one({"id": page_id, "user_id": user["id"]}, {"_id": 0})
     if not page:
@@ -1677,30 +3723,12 @@ async def get_page_analytics(page_id: str, user: dict = Depends(get_current_user
     plan_config = await get_plan_config(user.get("plan", "free"))
     has_advanced = plan_config.get("has_advanced_analytics", False)
     
-    by_country = []
-    by_city = []
-    
-    # Only fetch detailed geo data for PRO users
+    # Detailed geo/referrer breakdowns and uniques only for PRO users, read from the page's sketches
+    breakdowns = dict(NO_SKETCH_BREAKDOWNS)
+    uniques = dict(NO_UNIQUES)
     if has_advanced:
-        # Get clicks by country for this page
-        clicks_cursor = db.clicks.aggregate([
-            {"$match": {"page_id": page_id}},
-            {"$group": {"_id": "$country", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}},
-            {"$limit": 10}
-        ])
-        async for doc in clicks_cursor:
-            by_country.append({"country": doc["_id"] or "Неизвестно", "clicks": doc["count"]})
-        
-        # Get clicks by city for this page
-        city_cursor = db.clicks.aggregate([
-            {"$match": {"page_id": page_id}},
-            {"$group": {"_id": "$city", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}},
-            {"$limit": 10}
-        ])
-        async for doc in city_cursor:
-            by_city.append({"city": doc["_id"] or "Неизвестно", "clicks": doc["count"]})
+        sketches, uniques = await asyncio.gather(load_page_sketches([page_id]), recent_uniques([page_id]))
+        breakdowns = sketch_breakdowns(sketches)
     
     return {
         "page_id": page_id,
@@ -1710,13 +3738,257 @@ async def get_page_analytics(page_id: str, user: dict = Depends(get_current_user
         "links": links,
         "shares": page.get("shares", 0),
         "qr_scans": page.get("qr_scans", 0),
-        "by_country": by_country,
-        "by_city": by_city,
+        **breakdowns,
+        **uniques,
         "has_advanced_analytics": has_advanced
     }
 
+# Raw click export: streamed from the cursor, never materialized in memory
+# Documents per cursor round trip; each batch is also one chunk of the response
+ANALYTICS_EXPORT_BATCH_SIZE = int(os.environ.get("ANALYTICS_EXPORT_BATCH_SIZE", "5000"))
+EXPORT_COLUMNS = ["timestamp", "link_id", "platform", "country", "city", "referrer", "source"]
+
+def parse_export_bound(value: Optional[str], name: str, end: bool = False) -> Optional[datetime]:
+    """Parse a from/to query value: a date (whole day) or an ISO datetime, UTC if naive"""
+    if not value:
+        return None
+    try:
+        if len(value) == 10:
+            bound = datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+            # A date as the upper bound includes that whole day
+            return bound + timedelta(days=1) if end else bound
+        bound = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid '{name}': expected YYYY-MM-DD or ISO datetime")
+    return bound if bound.tzinfo else bound.replace(tzinfo=timezone.utc)
+
+def click_export_row(doc: dict, platforms: dict) -> dict:
+    link_id = doc["meta"].get("link_id")
+    return {
+        "timestamp": doc["timestamp"].replace(tzinfo=timezone.utc).isoformat(),
+        "link_id": link_id,
+        "platform": platforms.get(link_id, ""),
+        "country": doc.get("country") or "",
+        "city": doc.get("city") or "",
+        "referrer": doc.get("referrer") or "",
+        "source": doc.get("source") or "",
+    }
+
+CSV_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+def csv_safe_cell(value):
+    """Quote values a spreadsheet would run as a formula (referrer, country and city come from clients)"""
+    if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+async def stream_click_export(query: dict, platforms: dict, export_format: str, gzip_output: bool):
+    """
+    Yield the export one cursor batch at a time: memory is bounded by
+    ANALYTICS_EXPORT_BATCH_SIZE rows whatever the size of the range.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if gzip_output else None  # wbits 31: gzip container
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS) if export_format == "csv" else None
+    if writer:
+        writer.writeheader()
+
+    def take_chunk() -> bytes:
+        data = buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(data) if compressor else data
+
+    cursor = db.click_events.find(
+        query, {"_id": 0, "timestamp": 1, "meta": 1, "country": 1, "city": 1, "referrer": 1, "source": 1}
+    ).sort("timestamp", 1).batch_size(ANALYTICS_EXPORT_BATCH_SIZE)
+    rows = 0
+    async for doc in cursor:
+        row = click_export_row(doc, platforms)
+        if writer:
+            writer.writerow({column: csv_safe_cell(value) for column, value in row.items()})
+        else:
+            buffer.write(json.dumps(row, ensure_ascii=False))
+            buffer.write("\n")
+        rows += 1
+        if rows % ANALYTICS_EXPORT_BATCH_SIZE == 0:
+            chunk = take_chunk()
+            if chunk:
+                yield chunk
+
+    chunk = take_chunk()
+    if compressor:
+        chunk += compressor.flush()
+    if chunk:
+        yield chunk
+
+@app.get("/api/analytics/{page_id}/export", dependencies=[Depends(ANALYTICS_EXPORT_RATE_LIMIT)])
+async def export_page_clicks(
+    page_id: str,
+    from_: Optional[str] = Query(None, alias="from"),
+    to: Optional[str] = None,
+    format: str = "csv",
+    gzip: bool = False,
+    user: dict = Depends(get_current_user)
+):
+    """Raw click events of one page as a streamed CSV or NDJSON download (PRO)"""
+    if format not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be csv or ndjson")
+    
+    page = await db.pages.find_one({"id": page_id, "user_id": user["id"]}, {"_id": 0, "slug": 1})
+    if not page:
+        raise HTTPException(status_code=404, detail="Page not found")
+    
+    plan_config = await get_plan_config(user.get("plan", "free"))
+    if not plan_config.get("has_advanced_analytics", False):
+        raise HTTPException(status_code=403, detail="Экспорт статистики доступен только в PRO-версии.")
+    
+    query = {"meta.page_id": page_id}
+    start = parse_export_bound(from_, "from")
+    end = parse_export_bound(to, "to", end=True)
+    if start or end:
+        query["timestamp"] = {**({"$gte": start} if start else {}), **({"$lt": end} if end else {})}
+    
+    links = await db.links.find({"page_id": page_id}, {"_id": 0, "id": 1, "platform": 1}).to_list(100)
+    platforms = {link["id"]: link.get("platform", "") for link in links}
+    
+    filename = f"{page['slug']}-clicks.{format}" + (".gz" if gzip else "")
+    media_type = "application/gzip" if gzip else ("text/csv; charset=utf-8" if format == "csv" else "application/x-ndjson")
+    return StreamingResponse(
+        stream_click_export(query, platforms, format, gzip),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"', "Cache-Control": "no-store"}
+    )
+
+# Breakdowns shared by the owner and admin dashboards. Each collection is read
+# once: groupings run as $facet branches over one scan, and $sort + $limit is
+# a bounded top-N (heap) sort on the server. Geo and referrer breakdowns come
+# from the page sketches instead of the events.
+ANALYTICS_TOP_N = 10
+ANALYTICS_TIMELINE_DAYS = 30
+
+def daily_count_stage(field: str) -> dict:
+    return {"$group": {"_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$timestamp"}}, field: {"$sum": 1}}}
+
+async def click_timeline(match: dict, since: datetime) -> List[dict]:
+    """Clicks per day since `since`; the timestamp bound lets the index limit the scan"""
+    pipeline = [
+        {"$match": {**match, "timestamp": {"$gte": since}}},
+        daily_count_stage("clicks"),
+        {"$sort": {"_id": 1}}
+    ]
+    return [{"date": d["_id"], "clicks": d["clicks"]} async for d in db.click_events.aggregate(pipeline)]
+
+async def share_event_breakdown(match: dict, since: datetime) -> dict:
+    """Shares per day since `since` and shares by type, in one pass over share_events"""
+    pipeline = ([{"$match": match}] if match else []) + [{"$facet": {
+        "timeline": [{"$match": {"timestamp": {"$gte": since}}}, daily_count_stage("shares")],
+        "by_type": [{"$group": {"_id": "$type", "count": {"$sum": 1}}}]
+    }}]
+    result = (await db.share_events.aggregate(pipeline).to_list(1))[0]
+    by_type = {}
+    for d in result["by_type"]:
+        key = d["_id"] or "link"
+        by_type[key] = by_type.get(key, 0) + d["count"]
+    return {
+        "timeline": {d["_id"]: d["shares"] for d in result["timeline"]},
+        "by_type": by_type
+    }
+
+@app.get("/api/analytics/{page_id}/uniques")
+async def get_page_uniques(
+    page_id: str,
+    granularity: str = "day",
+    days: int = Query(30, ge=1, le=366),
+    user: dict = Depends(get_current_user)
+):
+    """
+    Visitor-days, clicker-days and their click-through rate per day, ISO week or
+    month (PRO). Per day these are the unique visitors and clickers of that day.
+    """
+    if granularity not in ("day", "week", "month"):
+        raise HTTPException(status_code=400, detail="granularity must be day, week or month")
+    
+    page = await db.pages.find_one({"id": page_id, "user_id": user["id"]}, {"_id": 0, "id": 1})
+    if not page:
+        raise HTTPException(status_code=404, detail="Page not found")
+    
+    plan_config = await get_plan_config(user.get("plan", "free"))
+    if not plan_config.get("has_advanced_analytics", False):
+        raise HTTPException(status_code=403, detail="Уникальные посетители доступны только в PRO-версии.")
+    
+    since = datetime.now(timezone.utc) - timedelta(days=days - 1)
+    docs = await load_daily_uniques([page_id], since.strftime("%Y-%m-%d"))
+    periods = defaultdict(list)
+    for doc in docs:
+        periods[uniques_period(doc["date"], granularity)].append(doc)
+    
+    return {
+        "page_id": page_id,
+        "granularity": granularity,
+        "since": since.strftime("%Y-%m-%d"),
+        "total": merge_uniques(docs),
+        "series": [{"period": period, **merge_uniques(periods[period])} for period in sorted(periods)]
+    }
+
+@app.get("/api/analytics/{page_id}/live")
+async def stream_page_analytics(page_id: str, user: dict = Depends(get_current_user)):
+    """
+    Server-Sent Events: a "snapshot" event with the page's counters, then
+    "increment" events with views/clicks/shares/qr_scans added since the last one.
+    Read it with fetch() (EventSource cannot send the Authorization header).
+    """
+    # Subscribe before reading the counters: an event recorded in between may be
+    # counted twice (snapshot and increment), but none is missed
+    subscriber = subscribe_live(page_id)
+    try:
+        page = await db.pages.find_one(
+            {"id": page_id, "user_id": user["id"]},
+            {"_id": 0, "views": 1, "shares": 1, "qr_scans": 1}
+        )
+        if not page:
+            raise HTTPException(status_code=404, detail="Page not found")
+        link_totals = await db.links.aggregate([
+            {"$match": {"page_id": page_id}},
+            {"$group": {"_id": None, "clicks": {"$sum": "$clicks"}}}
+        ]).to_list(1)
+    except Exception:
+        unsubscribe_live(subscriber)
+        raise
+    # Views not yet flushed by this worker are included
+    snapshot = {
+        "views": page.get("views", 0) + _pending_page_views.get(page_id, 0),
+        "clicks": link_totals[0]["clicks"] if link_totals else 0,
+        "shares": page.get("shares", 0),
+        "qr_scans": page.get("qr_scans", 0)
+    }
+    
+    # StreamingResponse cancels the generator when the client disconnects
+    async def events():
+        try:
+            yield sse_message("snapshot", snapshot)
+            while True:
+                try:
+                    first = await asyncio.wait_for(subscriber.queue.get(), LIVE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    first = None
+                delta = subscriber.drain(first)
+                if delta:
+                    yield sse_message("increment", delta)
+                else:
+                    # Keeps proxies from closing an idle connection
+                    yield ": keepalive\n\n"
+        finally:
+            unsubscribe_live(subscriber)
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # Global analytics for all user pages
-@api_router.get("/analytics/global/summary")
+@app.get("/api/analytics/global/summary")
 async def get_global_analytics(user: dict = Depends(get_current_user)):
     # Check if user has advanced analytics access
     plan_config = await get_plan_config(user.get("plan", "free"))
@@ -1732,8 +4004,8 @@ async def get_global_analytics(user: dict = Depends(get_current_user)):
             "total_clicks": 0,
             "total_shares": 0,
             "total_qr_scans": 0,
-            "by_country": [],
-            "by_city": [],
+            **NO_SKETCH_BREAKDOWNS,
+            **NO_UNIQUES,
             "timeline": [],
             "pages": [],
             "has_advanced_analytics": has_advanced
@@ -1744,83 +4016,38 @@ async def get_global_analytics(user: dict = Depends(get_current_user)):
     total_shares = sum(p.get("shares", 0) for p in pages)
     total_qr_scans = sum(p.get("qr_scans", 0) for p in pages)
     
-    # Get all links for these pages
-    links = await db.links.find({"page_id": {"$in": page_ids}}, {"_id": 0}).to_list(1000)
-    total_clicks = sum(link.get("clicks", 0) for link in links)
-    
-    by_country = []
-    by_city = []
-    
-    # Only fetch detailed geo data for PRO users
-    if has_advanced:
-        # Get clicks by country
-        clicks_cursor = db.clicks.aggregate([
-            {"$match": {"page_id": {"$in": page_ids}}},
-            {"$group": {"_id": "$country", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}},
-            {"$limit": 10}
-        ])
-        async for doc in clicks_cursor:
-            by_country.append({"country": doc["_id"] or "Неизвестно", "clicks": doc["count"]})
-        
-        # Get clicks by city
-        city_cursor = db.clicks.aggregate([
+    # One pass per collection: link clicks, click timeline, share breakdowns
+    since = datetime.now(timezone.utc) - timedelta(days=ANALYTICS_TIMELINE_DAYS)
+    page_clicks_list, timeline, shares = await asyncio.gather(
+        db.links.aggregate([
             {"$match": {"page_id": {"$in": page_ids}}},
-            {"$group": {"_id": "$city", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}},
-            {"$limit": 10}
-        ])
-        async for doc in city_cursor:
-            by_city.append({"city": doc["_id"] or "Неизвестно", "clicks": doc["count"]})
-    
-    # Get timeline (last 30 days) - available for all
-    thirty_days_ago = (datetime.now(timezone.utc) - timedelta(days=30)).isoformat()
-    timeline_cursor = db.clicks.aggregate([
-        {"$match": {"page_id": {"$in": page_ids}, "timestamp": {"$gte": thirty_days_ago}}},
-        {"$addFields": {"date": {"$substr": ["$timestamp", 0, 10]}}},
-        {"$group": {"_id": "$date", "clicks": {"$sum": 1}}},
-        {"$sort": {"_id": 1}}
-    ])
-    timeline = []
-    async for doc in timeline_cursor:
-        timeline.append({"date": doc["_id"], "clicks": doc["clicks"]})
-    
-    # Get shares timeline
-    shares_cursor = db.shares.aggregate([
-        {"$match": {"page_id": {"$in": page_ids}, "timestamp": {"$gte": thirty_days_ago}}},
-        {"$addFields": {"date": {"$substr": ["$timestamp", 0, 10]}}},
-        {"$group": {"_id": "$date", "shares": {"$sum": 1}}},
-        {"$sort": {"_id": 1}}
-    ])
-    shares_timeline = {}
-    async for doc in shares_cursor:
-        shares_timeline[doc["_id"]] = doc["shares"]
+            {"$group": {"_id": "$page_id", "clicks": {"$sum": "$clicks"}}}
+        ]).to_list(None),
+        click_timeline({"meta.page_id": {"$in": page_ids}}, since),
+        share_event_breakdown({"meta.page_id": {"$in": page_ids}}, since)
+    )
+    page_clicks = {d["_id"]: d["clicks"] for d in page_clicks_list}
+    total_clicks = sum(page_clicks.values())
+    breakdowns = dict(NO_SKETCH_BREAKDOWNS)
+    uniques = dict(NO_UNIQUES)
+    if has_advanced:
+        sketches, uniques = await asyncio.gather(load_page_sketches(page_ids), recent_uniques(page_ids))
+        breakdowns = sketch_breakdowns(sketches)
     
     # Merge timeline
     for item in timeline:
-        item["shares"] = shares_timeline.get(item["date"], 0)
-    
-    # Get shares by type
-    shares_by_type_cursor = db.shares.aggregate([
-        {"$match": {"page_id": {"$in": page_ids}}},
-        {"$group": {"_id": "$type", "count": {"$sum": 1}}}
-    ])
-    shares_by_type = {}
-    async for doc in shares_by_type_cursor:
-        shares_by_type[doc["_id"] or "link"] = doc["count"]
+        item["shares"] = shares["timeline"].get(item["date"], 0)
     
     # Page stats (only for PRO)
     page_stats = []
     if has_advanced:
         for p in pages:
-            page_links = [l for l in links if l["page_id"] == p["id"]]
-            page_clicks = sum(l.get("clicks", 0) for l in page_links)
             page_stats.append({
                 "id": p["id"],
                 "title": p["title"],
                 "slug": p["slug"],
                 "views": p.get("views", 0),
-                "clicks": page_clicks,
+                "clicks": page_clicks.get(p["id"], 0),
                 "shares": p.get("shares", 0),
                 "qr_scans": p.get("qr_scans", 0)
             })
@@ -1830,9 +4057,9 @@ async def get_global_analytics(user: dict = Depends(get_current_user)):
         "total_clicks": total_clicks,
         "total_shares": total_shares,
         "total_qr_scans": total_qr_scans,
-        "shares_by_type": shares_by_type,
-        "by_country": by_country,
-        "by_city": by_city,
+        "shares_by_type": shares["by_type"],
+        **breakdowns,
+        **uniques,
         "timeline": timeline,
         "pages": page_stats,
         "has_advanced_analytics": has_advanced
@@ -1840,7 +4067,7 @@ async def get_global_analytics(user: dict = Depends(get_current_user)):
 
 # ===================== ADMIN ROUTES =====================
 
-@api_router.get("/admin/users")
+@app.get("/api/admin/users")
 async def admin_get_users(admin_user: dict = Depends(get_admin_user)):
     users = await db.users.find({}, {"_id": 0, "password_hash": 0}).to_list(1000)
     
@@ -1851,7 +4078,7 @@ async def admin_get_users(admin_user: dict = Depends(get_admin_user)):
     
     return users
 
-@api_router.get("/admin/pages")
+@app.get("/api/admin/pages")
 async def admin_get_pages(admin_user: dict = Depends(get_admin_user)):
     pages = await db.pages.find({}, {"_id": 0}).to_list(1000)
     
@@ -1865,7 +4092,7 @@ async def admin_get_pages(admin_user: dict = Depends(get_admin_user)):
     
     return pages
 
-@api_router.put("/admin/users/{user_id}/block")
+@app.put("/api/admin/users/{user_id}/block")
 async def admin_block_user(user_id: str, admin_user: dict = Depends(get_admin_user)):
     user = await db.users.find_one({"id": user_id})
     if not user:
@@ -1876,19 +4103,20 @@ async def admin_block_user(user_id: str, admin_user: dict = Depends(get_admin_us
     
     return {"message": f"User {new_status}", "status": new_status}
 
-@api_router.put("/admin/pages/{page_id}/disable")
+@app.put("/api/admin/pages/{page_id}/disable")
 async def admin_disable_page(page_id: str, admin_user: dict = Depends(get_admin_user)):
     page = await db.pages.find_one({"id": page_id})
     if not page:
         raise HTTPException(status_code=404, detail="Page not found")
     
     new_status = "disabled" if page["status"] == "active" else "active"
-    await db.pages.update_one({"id": page_id}, {"$set": {"status": new_status}})
+    await db.pages.update_one({"id": page_id}, {"$set": {"status": new_status}, "$inc": {"version": 1}})
+    await set_page_route({**page, "status": new_status, "version": page.get("version", 0) + 1})
     
     return {"message": f"Page {new_status}", "status": new_status}
 
 # Admin verification management
-@api_router.get("/admin/verification/requests")
+@app.get("/api/admin/verification/requests")
 async def admin_get_verification_requests(admin_user: dict = Depends(get_admin_user)):
     """Get all verification requests"""
     requests = await db.verification_requests.find(
@@ -1898,7 +4126,7 @@ async def admin_get_verification_requests(admin_user: dict = Depends(get_admin_u
     
     return requests
 
-@api_router.put("/admin/verification/{user_id}/approve")
+@app.put("/api/admin/verification/{user_id}/approve")
 async def admin_approve_verification(user_id: str, admin_user: dict = Depends(get_admin_user)):
     """Approve verification request"""
     user = await db.users.find_one({"id": user_id})
@@ -1913,6 +4141,7 @@ async def admin_approve_verification(user_id: str, admin_user: dict = Depends(ge
             "verification_status": "approved"
         }}
     )
+    await invalidate_user_caches(user_id)
     
     # Update request
     await db.verification_requests.update_one(
@@ -1938,7 +4167,7 @@ async def admin_approve_verification(user_id: str, admin_user: dict = Depends(ge
     
     return {"message": "Верификация одобрена"}
 
-@api_router.put("/admin/verification/{user_id}/reject")
+@app.put("/api/admin/verification/{user_id}/reject")
 async def admin_reject_verification(user_id: str, reason: str = "", admin_user: dict = Depends(get_admin_user)):
     """Reject verification request"""
     user = await db.users.find_one({"id": user_id})
@@ -1976,7 +4205,7 @@ async def admin_reject_verification(user_id: str, reason: str = "", admin_user:
     
     return {"message": "Верификация отклонена"}
 
-@api_router.put("/admin/verification/{user_id}/grant")
+@app.put("/api/admin/verification/{user_id}/grant")
 async def admin_grant_verification(user_id: str, admin_user: dict = Depends(get_admin_user)):
     """Grant verification directly to user"""
     user = await db.users.find_one({"id": user_id})
@@ -1994,6 +4223,7 @@ async def admin_grant_verification(user_id: str, admin_user: dict = Depends(get_
             "verification_status": "approved"
         }}
     )
+    await invalidate_user_caches(user_id)
     
     # Create notification
     notification = {
@@ -2009,7 +4239,7 @@ async def admin_grant_verification(user_id: str, admin_user: dict = Depends(get_
     
     return {"message": "Верификация выдана"}
 
-@api_router.put("/admin/verification/{user_id}/revoke")
+@app.put("/api/admin/verification/{user_id}/revoke")
 async def admin_revoke_verification(user_id: str, admin_user: dict = Depends(get_admin_user)):
     """Revoke verification from user"""
     user = await db.users.find_one({"id": user_id})
@@ -2024,6 +4254,7 @@ async def admin_revoke_verification(user_id: str, admin_user: dict = Depends(get
             "verification_status": "none"
         }}
     )
+    await invalidate_user_caches(user_id)
     
     # Create notification
     notification = {
@@ -2040,198 +4271,719 @@ async def admin_revoke_verification(user_id: str, admin_user: dict = Depends(get
     return {"message": "Верификация отозвана"}
 
 # Admin global analytics - all users
-@api_router.get("/admin/analytics/global")
+@app.get("/api/admin/analytics/global")
 async def admin_global_analytics(admin_user: dict = Depends(get_admin_user)):
     """Global analytics for all users - admin only"""
-    
-    # Get all pages
-    pages = await db.pages.find({}, {"_id": 0}).to_list(10000)
-    page_ids = [p["id"] for p in pages]
-    
-    # Get all links
-    links = await db.links.find({}, {"_id": 0}).to_list(10000)
-    
-    # Calculate totals
-    total_views = sum(p.get("views", 0) for p in pages)
-    total_clicks = sum(l.get("clicks", 0) for l in links)
-    total_shares = sum(p.get("shares", 0) for p in pages)
-    total_qr_scans = sum(p.get("qr_scans", 0) for p in pages)
-    
-    # Get clicks by country
-    by_country = []
-    if page_ids:
-        clicks_cursor = db.clicks.aggregate([
-            {"$group": {"_id": "$country", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}},
-            {"$limit": 10}
-        ])
-        async for doc in clicks_cursor:
-            by_country.append({"country": doc["_id"] or "Неизвестно", "clicks": doc["count"]})
-    
-    # Get clicks by city
-    by_city = []
-    if page_ids:
-        city_cursor = db.clicks.aggregate([
-            {"$group": {"_id": "$city", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}},
-            {"$limit": 10}
-        ])
-        async for doc in city_cursor:
-            by_city.append({"city": doc["_id"] or "Неизвестно", "clicks": doc["count"]})
-    
-    # Timeline (last 30 days)
-    timeline = []
-    thirty_days_ago = (datetime.now(timezone.utc) - timedelta(days=30)).isoformat()
-    
-    timeline_cursor = db.clicks.aggregate([
-        {"$match": {"timestamp": {"$gte": thirty_days_ago}}},
-        {"$addFields": {"date": {"$substr": ["$timestamp", 0, 10]}}},
-        {"$group": {"_id": "$date", "clicks": {"$sum": 1}}},
-        {"$sort": {"_id": 1}}
-    ])
-    async for doc in timeline_cursor:
-        timeline.append({"date": doc["_id"], "clicks": doc["clicks"]})
-    
-    # Shares timeline
-    shares_cursor = db.shares.aggregate([
-        {"$match": {"timestamp": {"$gte": thirty_days_ago}}},
-        {"$addFields": {"date": {"$substr": ["$timestamp", 0, 10]}}},
-        {"$group": {"_id": "$date", "shares": {"$sum": 1}}},
-        {"$sort": {"_id": 1}}
-    ])
-    shares_timeline = {}
-    async for doc in shares_cursor:
-        shares_timeline[doc["_id"]] = doc["shares"]
+    since = datetime.now(timezone.utc) - timedelta(days=ANALYTICS_TIMELINE_DAYS)
+    
+    # Page totals and the most viewed pages in one pass, independent of the number of pages
+    pages_facet = db.pages.aggregate([{"$facet": {
+        "totals": [{"$group": {
+            "_id": None,
+            "pages": {"$sum": 1},
+            "views": {"$sum": "$views"},
+            "shares": {"$sum": "$shares"},
+            "qr_scans": {"$sum": "$qr_scans"}
+        }}],
+        "top": [
+            {"$sort": {"views": -1}},
+            {"$limit": ANALYTICS_TOP_N},
+            {"$project": {"_id": 0, "id": 1, "title": 1, "slug": 1, "views": 1, "shares": 1, "user_id": 1}}
+        ]
+    }}]).to_list(1)
+    link_totals = db.links.aggregate([{"$group": {"_id": None, "clicks": {"$sum": "$clicks"}}}]).to_list(1)
+    
+    (pages_result,), link_result, timeline, shares, site_sketches, uniques, users_count = await asyncio.gather(
+        pages_facet,
+        link_totals,
+        click_timeline({}, since),
+        share_event_breakdown({}, since),
+        load_page_sketches([SITE_SKETCH_ID]),
+        recent_uniques([SITE_SKETCH_ID]),
+        db.users.count_documents({})
+    )
+    breakdowns = sketch_breakdowns(site_sketches)
+    totals = pages_result["totals"][0] if pages_result["totals"] else {}
+    top_pages = pages_result["top"]
+    
+    # Batched enrichment of the top pages: one query for their clicks, one for their owners
+    top_ids = [p["id"] for p in top_pages]
+    page_clicks_list, owners = await asyncio.gather(
+        db.links.aggregate([
+            {"$match": {"page_id": {"$in": top_ids}}},
+            {"$group": {"_id": "$page_id", "clicks": {"$sum": "$clicks"}}}
+        ]).to_list(None),
+        db.users.find(
+            {"id": {"$in": list({p["user_id"] for p in top_pages if p.get("user_id")})}},
+            {"_id": 0, "id": 1, "username": 1}
+        ).to_list(None)
+    )
+    page_clicks = {d["_id"]: d["clicks"] for d in page_clicks_list}
+    usernames = {u["id"]: u.get("username", "Unknown") for u in owners}
     
     for item in timeline:
-        item["shares"] = shares_timeline.get(item["date"], 0)
-    
-    # Top pages by views
-    top_pages = sorted(pages, key=lambda x: x.get("views", 0), reverse=True)[:10]
-    top_pages_data = []
-    for p in top_pages:
-        page_links = [l for l in links if l["page_id"] == p["id"]]
-        page_clicks = sum(l.get("clicks", 0) for l in page_links)
-        user = await db.users.find_one({"id": p["user_id"]}, {"_id": 0, "username": 1})
-        top_pages_data.append({
+        item["shares"] = shares["timeline"].get(item["date"], 0)
+    
+    return {
+        "total_views": totals.get("views", 0),
+        "total_clicks": link_result[0]["clicks"] if link_result else 0,
+        "total_shares": totals.get("shares", 0),
+        "total_qr_scans": totals.get("qr_scans", 0),
+        "total_pages": totals.get("pages", 0),
+        "total_users": users_count,
+        "shares_by_type": shares["by_type"],
+        **breakdowns,
+        **uniques,
+        "timeline": timeline,
+        "top_pages": [{
             "id": p["id"],
             "title": p["title"],
             "slug": p["slug"],
             "views": p.get("views", 0),
-            "clicks": page_clicks,
+            "clicks": page_clicks.get(p["id"], 0),
             "shares": p.get("shares", 0),
-            "username": user.get("username", "Unknown") if user else "Unknown"
-        })
-    
-    # Shares by type
-    shares_by_type = {}
-    type_cursor = db.shares.aggregate([
-        {"$group": {"_id": "$type", "count": {"$sum": 1}}}
-    ])
-    async for doc in type_cursor:
-        shares_by_type[doc["_id"] or "link"] = doc["count"]
-    
-    # Users count
-    users_count = await db.users.count_documents({})
-    
-    return {
-        "total_views": total_views,
-        "total_clicks": total_clicks,
-        "total_shares": total_shares,
-        "total_qr_scans": total_qr_scans,
-        "total_pages": len(pages),
-        "total_users": users_count,
-        "shares_by_type": shares_by_type,
-        "by_country": by_country,
-        "by_city": by_city,
-        "timeline": timeline,
-        "top_pages": top_pages_data
+            "username": usernames.get(p.get("user_id"), "Unknown")
+        } for p in top_pages]
     }
 
 # VPS Resource Monitoring - admin only
-@api_router.get("/admin/system/metrics")
+@app.get("/api/admin/system/metrics")
 async def admin_system_metrics(admin_user: dict = Depends(get_admin_user)):
-    """Get VPS system metrics - admin only"""
-    import psutil
-    
-    # CPU usage
-    cpu_percent = psutil.cpu_percent(interval=0.5)
-    cpu_count = psutil.cpu_count()
-    
-    # Memory usage
-    memory = psutil.virtual_memory()
-    memory_total = memory.total / (1024 ** 3)  # GB
-    memory_used = memory.used / (1024 ** 3)  # GB
-    memory_percent = memory.percent
-    
-    # Disk usage
-    disk = psutil.disk_usage('/')
-    disk_total = disk.total / (1024 ** 3)  # GB
-    disk_used = disk.used / (1024 ** 3)  # GB
-    disk_percent = disk.percent
-    
-    # Network I/O
-    net_io = psutil.net_io_counters()
-    bytes_sent = net_io.bytes_sent / (1024 ** 2)  # MB
-    bytes_recv = net_io.bytes_recv / (1024 ** 2)  # MB
+    """Get VPS system metrics - latest background sample, admin only"""
+    sample = _latest_system_sample or await take_system_sample()
     
-    # Uptime
-    boot_time = datetime.fromtimestamp(psutil.boot_time())
+    boot_time = datetime.fromtimestamp(sample["boot_time"])
     uptime = datetime.now() - boot_time
     uptime_str = f"{uptime.days}д {uptime.seconds // 3600}ч {(uptime.seconds % 3600) // 60}м"
     
-    # Load average (Linux only)
-    try:
-        load_avg = psutil.getloadavg()
-        load_1, load_5, load_15 = load_avg
-    except:
-        load_1, load_5, load_15 = 0, 0, 0
-    
     return {
-        "cpu": {
-            "percent": cpu_percent,
-            "count": cpu_count,
-            "load_1m": round(load_1, 2),
-            "load_5m": round(load_5, 2),
-            "load_15m": round(load_15, 2)
-        },
-        "memory": {
-            "total_gb": round(memory_total, 2),
-            "used_gb": round(memory_used, 2),
-            "percent": memory_percent
-        },
-        "disk": {
-            "total_gb": round(disk_total, 2),
-            "used_gb": round(disk_used, 2),
-            "percent": disk_percent
-        },
+        "cpu": sample["cpu"],
+        "memory": sample["memory"],
+        "disk": sample["disk"],
         "network": {
-            "sent_mb": round(bytes_sent, 2),
-            "recv_mb": round(bytes_recv, 2)
+            "sent_mb": round(sample["network"]["bytes_sent"] / (1024 ** 2), 2),
+            "recv_mb": round(sample["network"]["bytes_recv"] / (1024 ** 2), 2)
         },
+        "process": sample["process"],
         "uptime": uptime_str,
+        "sampled_at": sample["timestamp"].isoformat(),
         "timestamp": datetime.now(timezone.utc).isoformat()
     }
 
-# VPS Metrics History - store and retrieve historical data
-@api_router.get("/admin/system/metrics/history")
-async def admin_system_metrics_history(admin_user: dict = Depends(get_admin_user), hours: int = 24):
-    """Get historical VPS metrics - admin only"""
-    
-    since = (datetime.now(timezone.utc) - timedelta(hours=hours)).isoformat()
+# VPS Metrics History - 1m/1h rollups written by system_metrics_sampler
+@app.get("/api/admin/system/metrics/history")
+async def admin_system_metrics_history(
+    admin_user: dict = Depends(get_admin_user),
+    hours: int = 24,
+    resolution: Optional[str] = None
+):
+    """Get historical VPS metrics - admin only. Defaults to 1m up to 48h, 1h beyond."""
+    if resolution is None:
+        resolution = "1m" if hours <= 48 else "1h"
+    if resolution not in SYSTEM_METRICS_RETENTION:
+        raise HTTPException(status_code=400, detail="resolution must be 1m or 1h")
     
+    since = datetime.now(timezone.utc) - timedelta(hours=hours)
     metrics = await db.system_metrics.find(
-        {"timestamp": {"$gte": since}},
-        {"_id": 0}
-    ).sort("timestamp", 1).to_list(1000)
+        {"resolution": resolution, "timestamp": {"$gte": since}},
+        {"_id": 0, "expires_at": 0}
+    ).sort("timestamp", 1).to_list(5000)
     
     return metrics
 
+# ===================== ANALYTICS SNAPSHOTS =====================
+
+# Columnar copies of the event collections for offline analysis, so ad-hoc
+# queries read files instead of the primary. analytics_snapshot_loop appends
+# events between each collection's high-water mark (app_settings
+# "analytics_snapshot:<collection>") and now - ANALYTICS_SNAPSHOT_LAG_SECONDS:
+#   ANALYTICS_SNAPSHOT_DIR/<collection>/date=YYYY-MM-DD/part-<from>-<to>-<n>.parquet
+# Files are partitioned by day; rows inside are sorted by page_id so per-page
+# reads skip row groups by their statistics. A window is recorded as pending
+# before it is written, so an interrupted run rewrites the same files.
+# Nothing is exported before the event backfill (migration 4) is recorded:
+# it inserts legacy events with their original timestamps, which would land
+# behind the high-water mark and never be exported.
+# With workers on several hosts the directory must be shared storage.
+ANALYTICS_SNAPSHOT_DIR = Path(os.environ.get("ANALYTICS_SNAPSHOT_DIR", str(ROOT_DIR / "snapshots")))
+ANALYTICS_SNAPSHOT_FORMAT = os.environ.get("ANALYTICS_SNAPSHOT_FORMAT", "parquet")  # parquet | arrow (IPC)
+ANALYTICS_SNAPSHOT_INTERVAL_SECONDS = int(os.environ.get("ANALYTICS_SNAPSHOT_INTERVAL_SECONDS", "3600"))  # 0 disables
+ANALYTICS_SNAPSHOT_LAG_SECONDS = 300  # late inserts still in flight
+ANALYTICS_SNAPSHOT_ROWS_PER_FILE = 50_000  # rows held in memory per write
+ANALYTICS_SNAPSHOT_LOCK_SECONDS = 300
+ANALYTICS_SNAPSHOT_MAX_DAYS = 366  # per download
+SNAPSHOT_COLUMNS = {
+    "click_events": ["page_id", "link_id", "country", "city", "referrer", "source"],
+    "view_events": ["page_id", "country", "city", "source"],
+    "share_events": ["page_id", "type", "country", "city"],
+}
+
+def as_utc(value: datetime) -> datetime:
+    """MongoDB returns naive UTC datetimes"""
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+def snapshot_extension() -> str:
+    return "arrow" if ANALYTICS_SNAPSHOT_FORMAT == "arrow" else "parquet"
+
+def write_snapshot_files(name: str, docs: list, window_tag: str, part: int) -> int:
+    """Write one batch of events as one file per day; runs in a worker thread"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    meta_fields = EVENT_COLLECTIONS[name][1]
+    by_date = defaultdict(list)
+    for doc in docs:
+        by_date[doc["timestamp"].strftime("%Y-%m-%d")].append(doc)
+    
+    for date, day_docs in by_date.items():
+        day_docs.sort(key=lambda d: (d["meta"].get("page_id") or "", d["timestamp"]))
+        columns = {"timestamp": pa.array([as_utc(d["timestamp"]) for d in day_docs], pa.timestamp("ms", tz="UTC"))}
+        for column in SNAPSHOT_COLUMNS[name]:
+            if column in meta_fields:
+                values = [d["meta"].get(column) for d in day_docs]
+            else:
+                values = [d.get(column) for d in day_docs]
+            columns[column] = pa.array(values, pa.string())
+        table = pa.table(columns)
+        
+        directory = ANALYTICS_SNAPSHOT_DIR / name / f"date={date}"
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / f"part-{window_tag}-{part:04d}.{snapshot_extension()}"
+        tmp_path = path.with_name(path.name + ".tmp")
+        if ANALYTICS_SNAPSHOT_FORMAT == "arrow":
+            options = pa.ipc.IpcWriteOptions(compression="zstd")
+            with pa.OSFile(str(tmp_path), "wb") as sink, pa.ipc.new_file(sink, table.schema, options=options) as writer:
+                writer.write_table(table)
+        else:
+            pq.write_table(table, tmp_path, compression="zstd")
+        os.replace(tmp_path, path)
+    return len(by_date)
+
+def remove_snapshot_window(name: str, window_tag: str):
+    """Drop files left by an interrupted export of the same window"""
+    for path in (ANALYTICS_SNAPSHOT_DIR / name).glob(f"date=*/part-{window_tag}-*"):
+        path.unlink()
+
+async def acquire_snapshot_lock(owner: str) -> bool:
+    """Take or renew the exporter lease (one exporter across workers)"""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.app_settings.update_one(
+            {"key": "analytics_snapshot_lock", "$or": [{"owner": owner}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"owner": owner, "expires_at": now + timedelta(seconds=ANALYTICS_SNAPSHOT_LOCK_SECONDS)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+async def export_event_snapshot(name: str, owner: str) -> dict:
+    """Append one collection's events since its high-water mark to the snapshot files"""
+    state_key = f"analytics_snapshot:{name}"
+    state = await db.app_settings.find_one({"key": state_key}, {"_id": 0}) or {}
+    since = as_utc(state["high_water_mark"]) if state.get("high_water_mark") else None
+    if state.get("pending_until"):
+        until = as_utc(state["pending_until"])
+    else:
+        until = (datetime.now(timezone.utc) - timedelta(seconds=ANALYTICS_SNAPSHOT_LAG_SECONDS)).replace(microsecond=0)
+    if since and until <= since:
+        return {"rows": 0, "files": 0}
+    
+    await db.app_settings.update_one({"key": state_key}, {"$set": {"pending_until": until}}, upsert=True)
+    window_tag = f"{since:%Y%m%dT%H%M%S}-{until:%Y%m%dT%H%M%S}" if since else f"0-{until:%Y%m%dT%H%M%S}"
+    await asyncio.to_thread(remove_snapshot_window, name, window_tag)
+    
+    query = {"timestamp": {"$lte": until, **({"$gt": since} if since else {})}}
+    projection = {"_id": 0, "timestamp": 1, "meta": 1, **{c: 1 for c in SNAPSHOT_COLUMNS[name]}}
+    # No sort: write_snapshot_files regroups every batch by day anyway
+    cursor = db[name].find(query, projection).batch_size(5000)
+    
+    rows, files, part = 0, 0, 0
+    batch = []
+    async for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= ANALYTICS_SNAPSHOT_ROWS_PER_FILE:
+            files += await asyncio.to_thread(write_snapshot_files, name, batch, window_tag, part)
+            rows += len(batch)
+            part += 1
+            batch = []
+            if not await acquire_snapshot_lock(owner):
+                raise RuntimeError("Analytics snapshot lock lost to another process")
+    if batch:
+        files += await asyncio.to_thread(write_snapshot_files, name, batch, window_tag, part)
+        rows += len(batch)
+    
+    await db.app_settings.update_one(
+        {"key": state_key},
+        {
+            "$set": {
+                "high_water_mark": until,
+                "last_run_at": datetime.now(timezone.utc).isoformat(),
+                "last_rows": rows,
+                "last_files": files
+            },
+            "$inc": {"total_rows": rows},
+            "$unset": {"pending_until": ""}
+        }
+    )
+    return {"rows": rows, "files": files}
+
+async def event_backfill_applied() -> bool:
+    return await db.schema_migrations.find_one({"name": "backfill_time_series_events"}, {"_id": 1}) is not None
+
+async def run_analytics_snapshot(owner: Optional[str] = None) -> Optional[dict]:
+    """Export every event collection; returns None if another process is exporting"""
+    if not await event_backfill_applied():
+        logging.info("Analytics snapshot skipped: event backfill (migration 4) not applied yet")
+        return {}
+    owner = owner or f"{os.uname().nodename}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    if not await acquire_snapshot_lock(owner):
+        return None
+    try:
+        results = {}
+        for name in EVENT_COLLECTIONS:
+            results[name] = await export_event_snapshot(name, owner)
+        logging.info(f"Analytics snapshot written: {results}")
+        return results
+    finally:
+        await db.app_settings.update_one(
+            {"key": "analytics_snapshot_lock", "owner": owner},
+            {"$set": {"expires_at": datetime.now(timezone.utc)}}
+        )
+
+async def analytics_snapshot_loop():
+    while True:
+        await asyncio.sleep(ANALYTICS_SNAPSHOT_INTERVAL_SECONDS)
+        try:
+            await run_analytics_snapshot()
+        except Exception as e:
+            logging.warning(f"Analytics snapshot failed: {e}")
+
+def list_snapshot_partitions(name: str) -> list:
+    partitions = []
+    for directory in sorted((ANALYTICS_SNAPSHOT_DIR / name).glob("date=*")):
+        files = [p for p in directory.iterdir() if not p.name.endswith(".tmp")]
+        partitions.append({
+            "date": directory.name[len("date="):],
+            "files": len(files),
+            "bytes": sum(p.stat().st_size for p in files)
+        })
+    return partitions
+
+@app.get("/api/admin/analytics/snapshots")
+async def admin_list_analytics_snapshots(user: dict = Depends(get_admin_user)):
+    """Exporter state and the day partitions available per collection"""
+    states = {
+        doc["key"].split(":", 1)[1]: doc
+        async for doc in db.app_settings.find({"key": {"$regex": "^analytics_snapshot:"}}, {"_id": 0})
+    }
+    collections = {}
+    for name in EVENT_COLLECTIONS:
+        state = states.get(name, {})
+        partitions = await asyncio.to_thread(list_snapshot_partitions, name)
+        collections[name] = {
+            "high_water_mark": as_utc(state["high_water_mark"]).isoformat() if state.get("high_water_mark") else None,
+            "last_run_at": state.get("last_run_at"),
+            "total_rows": state.get("total_rows", 0),
+            "partitions": partitions
+        }
+    return {
+        "format": snapshot_extension(),
+        "interval_seconds": ANALYTICS_SNAPSHOT_INTERVAL_SECONDS,
+        "collections": collections
+    }
+
+@app.post("/api/admin/analytics/snapshots/run")
+async def admin_run_analytics_snapshot(user: dict = Depends(get_admin_user)):
+    """Start an export now instead of waiting for the next interval"""
+    if not has_role_permission(user.get("role", "user"), "admin"):
+        raise HTTPException(status_code=403, detail="Требуется роль админа или владельца")
+    if not await event_backfill_applied():
+        raise HTTPException(status_code=409, detail="Перенос событий (миграция 4) ещё не завершён")
+    
+    start_background_task(run_analytics_snapshot())
+    await log_admin_action(user["id"], "ADMIN_RUN_ANALYTICS_SNAPSHOT", {})
+    return {"started": True}
+
+def build_snapshot_archive(name: str, start: str, end: str) -> Optional[str]:
+    """Zip the partitions of [start, end] into a temp file; None if there are none"""
+    files = [
+        path
+        for directory in sorted((ANALYTICS_SNAPSHOT_DIR / name).glob("date=*"))
+        if start <= directory.name[len("date="):] <= end
+        for path in sorted(directory.iterdir())
+        if not path.name.endswith(".tmp")
+    ]
+    if not files:
+        return None
+    fd, archive_path = tempfile.mkstemp(prefix="snapshot-", suffix=".zip")
+    # Parquet/Arrow files are already compressed
+    with os.fdopen(fd, "wb") as archive_file, zipfile.ZipFile(archive_file, "w", zipfile.ZIP_STORED) as archive:
+        for path in files:
+            archive.write(path, str(path.relative_to(ANALYTICS_SNAPSHOT_DIR)))
+    return archive_path
+
+@app.get("/api/admin/analytics/snapshots/download")
+async def admin_download_analytics_snapshot(
+    collection: str,
+    from_: str = Query(..., alias="from"),
+    to: str = Query(...),
+    user: dict = Depends(get_admin_user)
+):
+    """Download one collection's snapshot files for a date range (inclusive) as a zip"""
+    if not has_role_permission(user.get("role", "user"), "admin"):
+        raise HTTPException(status_code=403, detail="Требуется роль админа или владельца")
+    if collection not in EVENT_COLLECTIONS:
+        raise HTTPException(status_code=400, detail=f"collection must be one of: {', '.join(EVENT_COLLECTIONS)}")
+    try:
+        start = datetime.strptime(from_, "%Y-%m-%d")
+        end = datetime.strptime(to, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="from/to must be YYYY-MM-DD")
+    if end < start or (end - start).days >= ANALYTICS_SNAPSHOT_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"Date range must be 1-{ANALYTICS_SNAPSHOT_MAX_DAYS} days")
+    
+    archive_path = await asyncio.to_thread(build_snapshot_archive, collection, from_, to)
+    if not archive_path:
+        raise HTTPException(status_code=404, detail="No snapshot files in this range")
+    
+    await log_admin_action(user["id"], "ADMIN_DOWNLOAD_ANALYTICS_SNAPSHOT", {"collection": collection, "from": from_, "to": to})
+    return FileResponse(
+        archive_path,
+        media_type="application/zip",
+        filename=f"{collection}-{from_}-{to}.zip",
+        background=BackgroundTask(os.unlink, archive_path)
+    )
+
+# ===================== PERFORMANCE INSTRUMENTATION =====================
+
+# Per-worker, in-memory: request latency and DB round-trip histograms per
+# route (PerfMiddleware), event loop lag (event_loop_lag_monitor) and a
+# watchdog thread that captures the loop thread's stack while it is blocked.
+# Exposed at /api/admin/system/perf and in Prometheus text format.
+PERF_LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+PERF_DB_ROUNDTRIP_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+PERF_BLOCKING_THRESHOLD_MS = int(os.environ.get('PERF_BLOCKING_THRESHOLD_MS', '100'))
+PERF_STACK_DEPTH = 12
+PROMETHEUS_TOKEN = os.environ.get('PROMETHEUS_TOKEN', '')
+# Same query shape issued this many times in one request = likely N+1 loop
+DB_REPEATED_QUERY_THRESHOLD = int(os.environ.get('DB_REPEATED_QUERY_THRESHOLD', '10'))
+# Anything but "production" adds X-DB-Queries / X-DB-Time debug headers
+APP_ENV = os.environ.get('APP_ENV', 'production')
+DB_DEBUG_HEADERS = APP_ENV != 'production'
+
+class Histogram:
+    """Fixed-bucket histogram (cumulative counts are built at export time)"""
+    __slots__ = ("bounds", "counts", "count", "total", "max")
+    
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # last slot is +Inf
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    
+    def observe(self, value: float):
+        index = 0
+        while index < len(self.bounds) and value > self.bounds[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+    
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th observation (capped at the max seen)"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(self.bounds[index], self.max) if index < len(self.bounds) else self.max
+        return self.max
+
+class RouteStats:
+    __slots__ = ("latency_ms", "db_roundtrips", "db_time_ms", "errors", "repeated_query_requests", "worst_repeated_query")
+    
+    def __init__(self):
+        self.latency_ms = Histogram(PERF_LATENCY_BUCKETS_MS)
+        self.db_roundtrips = Histogram(PERF_DB_ROUNDTRIP_BUCKETS)
+        self.db_time_ms = 0.0
+        self.errors = 0
+        self.repeated_query_requests = 0
+        self.worst_repeated_query = None  # {"shape", "count"}
+
+_route_stats = defaultdict(RouteStats)  # (method, route template) -> RouteStats
+_loop_lag_histogram = Histogram(PERF_LATENCY_BUCKETS_MS)
+_perf_since = datetime.now(timezone.utc).isoformat()
+
+class PerfMiddleware:
+    """Times every HTTP request, counts its MongoDB round-trips and flags repeated query shapes"""
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        status = {"code": 500, "streaming": False}
+        
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                # Server-Sent Events: the connection's lifetime is not a request latency
+                status["streaming"] = any(
+                    key == b"content-type" and value.startswith(b"text/event-stream")
+                    for key, value in message.get("headers", [])
+                )
+                if DB_DEBUG_HEADERS:
+                    message["headers"] = [
+                        *message.get("headers", []),
+                        (b"x-db-queries", str(db_stats.roundtrips).encode()),
+                        (b"x-db-time", f"{db_stats.time_ms:.1f}ms".encode())
+                    ]
+            await send(message)
+        
+        db_stats = RequestDbStats()
+        token = _request_db_stats.set(db_stats)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            _request_db_stats.reset(token)
+            if not status["streaming"]:
+                route = scope.get("route")
+                route_path = route.path if route else "<unmatched>"
+                stats = _route_stats[(scope["method"], route_path)]
+                stats.latency_ms.observe(elapsed_ms)
+                stats.db_roundtrips.observe(db_stats.roundtrips)
+                stats.db_time_ms += db_stats.time_ms
+                if status["code"] >= 500:
+                    stats.errors += 1
+                if db_stats.shapes:
+                    record_repeated_queries(scope["method"], route_path, stats, db_stats)
+
+def record_repeated_queries(method: str, route_path: str, stats: RouteStats, db_stats: RequestDbStats):
+    """Warn when one query shape repeats DB_REPEATED_QUERY_THRESHOLD+ times in a request (N+1)"""
+    shape, count = max(db_stats.shapes.items(), key=lambda kv: kv[1])
+    if count < DB_REPEATED_QUERY_THRESHOLD:
+        return
+    stats.repeated_query_requests += 1
+    if not stats.worst_repeated_query or count > stats.worst_repeated_query["count"]:
+        stats.worst_repeated_query = {"shape": shape, "count": count}
+    logging.warning(
+        f"Repeated query: {method} {route_path} issued `{shape}` {count}x "
+        f"({db_stats.roundtrips} queries, {db_stats.time_ms:.1f}ms DB)"
+    )
+
+class LoopBlockWatchdog:
+    """
+    Thread that notices when the event loop stops running callbacks for longer
+    than threshold_ms and samples the loop thread's stack while it is stuck.
+    """
+    def __init__(self, threshold_ms: int, check_interval: float = 0.02, max_episodes: int = 50, max_samples: int = 5):
+        self.threshold_ms = threshold_ms
+        self.check_interval = check_interval
+        self.max_samples = max_samples
+        self.episodes = deque(maxlen=max_episodes)
+        self.blocked_total = 0
+        self.blocked_ms_total = 0.0
+        self._loop = None
+        self._thread_id = None
+        self._last_beat = time.monotonic()
+        self._running = False
+    
+    def start(self, loop):
+        """Call from the loop thread"""
+        self._loop = loop
+        self._thread_id = threading.get_ident()
+        self._running = True
+        self._last_beat = time.monotonic()
+        loop.call_soon(self._beat)
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+    
+    def stop(self):
+        self._running = False
+    
+    def _beat(self):
+        self._last_beat = time.monotonic()
+        if self._running:
+            self._loop.call_later(self.check_interval, self._beat)
+    
+    def _sample_stack(self) -> str:
+        frame = sys._current_frames().get(self._thread_id)
+        if frame is None:
+            return ""
+        return "".join(traceback.format_list(traceback.extract_stack(frame)[-PERF_STACK_DEPTH:]))
+    
+    def _finish(self, episode: dict, last_beat: float):
+        duration_ms = (last_beat - episode.pop("beat") - self.check_interval) * 1000
+        episode["duration_ms"] = round(max(duration_ms, episode["detected_after_ms"]), 1)
+        self.blocked_total += 1
+        self.blocked_ms_total += episode["duration_ms"]
+        self.episodes.appendleft(episode)
+    
+    def _watch(self):
+        episode = None
+        while self._running:
+            time.sleep(self.check_interval)
+            last_beat = self._last_beat
+            stalled_ms = (time.monotonic() - last_beat - self.check_interval) * 1000
+            
+            if episode is not None and episode["beat"] != last_beat:
+                self._finish(episode, last_beat)
+                episode = None
+            
+            if stalled_ms < self.threshold_ms:
+                continue
+            if episode is None:
+                episode = {
+                    "beat": last_beat,
+                    "at": (datetime.now(timezone.utc) - timedelta(milliseconds=stalled_ms)).isoformat(),
+                    "detected_after_ms": round(stalled_ms, 1),
+                    "stacks": []
+                }
+            if len(episode["stacks"]) < self.max_samples:
+                stack = self._sample_stack()
+                if stack and stack not in episode["stacks"]:
+                    episode["stacks"].append(stack)
+
+_loop_watchdog = LoopBlockWatchdog(PERF_BLOCKING_THRESHOLD_MS)
+
+def _histogram_summary(histogram: Histogram) -> dict:
+    return {
+        "count": histogram.count,
+        "avg": round(histogram.total / histogram.count, 2) if histogram.count else 0.0,
+        "p50": round(histogram.quantile(0.5), 2),
+        "p95": round(histogram.quantile(0.95), 2),
+        "p99": round(histogram.quantile(0.99), 2),
+        "max": round(histogram.max, 2)
+    }
+
+@app.get("/api/admin/system/perf")
+async def admin_system_perf(sort: str = "total_time", limit: int = 50, admin_user: dict = Depends(get_admin_user)):
+    """Per-route latency and DB round-trips, loop lag and blocking episodes for this worker"""
+    routes = []
+    for (method, route), stats in _route_stats.items():
+        latency = _histogram_summary(stats.latency_ms)
+        routes.append({
+            "method": method,
+            "route": route,
+            "latency_ms": latency,
+            "total_time_ms": round(stats.latency_ms.total, 1),
+            "errors": stats.errors,
+            "db_roundtrips": _histogram_summary(stats.db_roundtrips),
+            "db_time_ms_avg": round(stats.db_time_ms / stats.latency_ms.count, 2) if stats.latency_ms.count else 0.0,
+            "repeated_query_requests": stats.repeated_query_requests,
+            "worst_repeated_query": stats.worst_repeated_query
+        })
+    sort_keys = {
+        "total_time": lambda r: r["total_time_ms"],
+        "p99": lambda r: r["latency_ms"]["p99"],
+        "count": lambda r: r["latency_ms"]["count"],
+        "db_roundtrips": lambda r: r["db_roundtrips"]["avg"],
+        "repeated_queries": lambda r: r["repeated_query_requests"],
+    }
+    routes.sort(key=sort_keys.get(sort, sort_keys["total_time"]), reverse=True)
+    
+    return {
+        "pid": os.getpid(),
+        "since": _perf_since,
+        "event_loop": {
+            "lag_ms_last": round(_loop_lag["last_ms"], 2),
+            "lag_ms": _histogram_summary(_loop_lag_histogram),
+            "blocking_threshold_ms": PERF_BLOCKING_THRESHOLD_MS,
+            "blocked_total": _loop_watchdog.blocked_total,
+            "blocked_ms_total": round(_loop_watchdog.blocked_ms_total, 1),
+            "blocking_episodes": list(_loop_watchdog.episodes)
+        },
+        "repeated_query_threshold": DB_REPEATED_QUERY_THRESHOLD,
+        "routes": routes[:limit],
+        "db_commands": dict(sorted(_db_command_counts.items(), key=lambda kv: -kv[1]))
+    }
+
+def _prom_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _prom_histogram(lines: list, name: str, histogram: Histogram, labels: str, scale: float = 1.0):
+    cumulative = 0
+    for bound, bucket_count in zip(histogram.bounds, histogram.counts):
+        cumulative += bucket_count
+        lines.append(f'{name}_bucket{{{labels},le="{bound * scale:g}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+    lines.append(f'{name}_sum{{{labels}}} {histogram.total * scale:.6f}')
+    lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+
+def render_prometheus_metrics() -> str:
+    worker = f'worker="{os.getpid()}"'
+    lines = [
+        "# HELP muslink_http_request_duration_seconds Request latency by route",
+        "# TYPE muslink_http_request_duration_seconds histogram",
+    ]
+    for (method, route), stats in _route_stats.items():
+        labels = f'{worker},method="{method}",route="{_prom_label(route)}"'
+        _prom_histogram(lines, "muslink_http_request_duration_seconds", stats.latency_ms, labels, scale=0.001)
+    
+    lines += [
+        "# HELP muslink_http_request_db_roundtrips MongoDB commands issued per request",
+        "# TYPE muslink_http_request_db_roundtrips histogram",
+    ]
+    for (method, route), stats in _route_stats.items():
+        labels = f'{worker},method="{method}",route="{_prom_label(route)}"'
+        _prom_histogram(lines, "muslink_http_request_db_roundtrips", stats.db_roundtrips, labels)
+    
+    lines += [
+        "# HELP muslink_http_request_errors_total Responses with status >= 500",
+        "# TYPE muslink_http_request_errors_total counter",
+    ]
+    for (method, route), stats in _route_stats.items():
+        lines.append(f'muslink_http_request_errors_total{{{worker},method="{method}",route="{_prom_label(route)}"}} {stats.errors}')
+    
+    lines += [
+        "# HELP muslink_http_request_repeated_queries_total Requests that repeated one query shape past the N+1 threshold",
+        "# TYPE muslink_http_request_repeated_queries_total counter",
+    ]
+    for (method, route), stats in _route_stats.items():
+        lines.append(f'muslink_http_request_repeated_queries_total{{{worker},method="{method}",route="{_prom_label(route)}"}} {stats.repeated_query_requests}')
+    
+    lines += [
+        "# HELP muslink_event_loop_lag_seconds Event loop wake-up delay",
+        "# TYPE muslink_event_loop_lag_seconds histogram",
+    ]
+    _prom_histogram(lines, "muslink_event_loop_lag_seconds", _loop_lag_histogram, worker, scale=0.001)
+    
+    lines += [
+        "# HELP muslink_event_loop_blocked_total Times the loop was blocked longer than the threshold",
+        "# TYPE muslink_event_loop_blocked_total counter",
+        f"muslink_event_loop_blocked_total{{{worker}}} {_loop_watchdog.blocked_total}",
+        "# HELP muslink_event_loop_blocked_seconds_total Time spent blocked beyond the threshold",
+        "# TYPE muslink_event_loop_blocked_seconds_total counter",
+        f"muslink_event_loop_blocked_seconds_total{{{worker}}} {_loop_watchdog.blocked_ms_total / 1000:.6f}",
+        "# HELP muslink_db_commands_total MongoDB commands by name",
+        "# TYPE muslink_db_commands_total counter",
+    ]
+    for command, count in _db_command_counts.items():
+        lines.append(f'muslink_db_commands_total{{{worker},command="{_prom_label(command)}"}} {count}')
+    return "\n".join(lines) + "\n"
+
+@app.get("/api/admin/system/perf/prometheus")
+async def admin_system_perf_prometheus(request: Request):
+    """Prometheus text format; accepts an admin session or `Authorization: Bearer $PROMETHEUS_TOKEN`"""
+    authorization = request.headers.get("authorization", "")
+    if not (PROMETHEUS_TOKEN and secrets.compare_digest(authorization, f"Bearer {PROMETHEUS_TOKEN}")):
+        await get_admin_user(authorization)
+    return Response(content=render_prometheus_metrics(), media_type="text/plain; version=0.0.4")
+
 # ===================== RBAC MANAGEMENT API =====================
 
 # --- Plan Config Management (Owner/Admin only) ---
 
-@api_router.get("/admin/plan-configs")
+@app.get("/api/admin/plan-configs")
 async def get_all_plan_configs(user: dict = Depends(get_admin_user)):
     """Get all plan configurations"""
     configs = await db.plan_configs.find({}, {"_id": 0}).to_list(100)
@@ -2242,7 +4994,7 @@ async def get_all_plan_configs(user: dict = Depends(get_admin_user)):
     
     return configs
 
-@api_router.get("/admin/plan-configs/{plan_name}")
+@app.get("/api/admin/plan-configs/{plan_name}")
 async def get_plan_config_by_name(plan_name: str, user: dict = Depends(get_admin_user)):
     """Get specific plan configuration"""
     config = await db.plan_configs.find_one({"plan_name": plan_name}, {"_id": 0})
@@ -2252,7 +5004,7 @@ async def get_plan_config_by_name(plan_name: str, user: dict = Depends(get_admin
             raise HTTPException(status_code=404, detail="Plan not found")
     return config
 
-@api_router.put("/admin/plan-configs/{plan_name}")
+@app.put("/api/admin/plan-configs/{plan_name}")
 async def update_plan_config(plan_name: str, data: PlanConfigUpdate, user: dict = Depends(get_admin_user)):
     """Update plan configuration - changes apply to all users on this plan"""
     # Check if user has permission (owner or admin)
@@ -2275,7 +5027,7 @@ async def update_plan_config(plan_name: str, data: PlanConfigUpdate, user: dict
     
     return config
 
-@api_router.post("/admin/plan-configs")
+@app.post("/api/admin/plan-configs")
 async def create_plan_config(data: PlanConfigCreate, user: dict = Depends(get_admin_user)):
     """Create new plan configuration"""
     if not has_role_permission(user.get("role", "user"), "admin"):
@@ -2293,9 +5045,54 @@ async def create_plan_config(data: PlanConfigCreate, user: dict = Depends(get_ad
     
     return {k: v for k, v in config.items() if k != "_id"}
 
+# --- Bot User-Agent Management (Owner/Admin only) ---
+
+class BotUserAgentsUpdate(BaseModel):
+    user_agents: List[str]
+
+@app.get("/api/admin/bot-user-agents")
+async def get_bot_user_agents(user: dict = Depends(get_admin_user)):
+    """Get the User-Agent substrings treated as link preview bots"""
+    return {"user_agents": BOT_USER_AGENTS, "cached_verdicts": len(_bot_verdict_cache)}
+
+@app.put("/api/admin/bot-user-agents")
+async def update_bot_user_agents(data: BotUserAgentsUpdate, user: dict = Depends(get_admin_user)):
+    """Update the bot list - applied immediately here, other workers pick it up on refresh"""
+    if not has_role_permission(user.get("role", "user"), "admin"):
+        raise HTTPException(status_code=403, detail="Требуется роль админа или владельца")
+    
+    if not any(ua.strip() for ua in data.user_agents):
+        raise HTTPException(status_code=400, detail="Bot list cannot be empty")
+    
+    set_bot_user_agents(data.user_agents)
+    await db.app_settings.update_one(
+        {"key": "bot_user_agents"},
+        {"$set": {"value": BOT_USER_AGENTS, "updated_at": datetime.now(timezone.utc).isoformat(), "updated_by": user["id"]}},
+        upsert=True
+    )
+    logging.info(f"Bot User-Agent list updated by {user['email']}: {len(BOT_USER_AGENTS)} entries")
+    
+    return {"user_agents": BOT_USER_AGENTS}
+
+@app.get("/api/admin/tracking/filter-stats")
+async def get_tracking_filter_stats(user: dict = Depends(get_admin_user)):
+    """Accepted vs dropped tracking events for this worker since it started"""
+    events = {}
+    for key, count in _tracking_event_counts.items():
+        event, outcome = key.split(":", 1)
+        events.setdefault(event, {"accepted": 0, "bot": 0, "prefetch": 0, "duplicate": 0})[outcome] = count
+    
+    return {
+        "since": _tracking_counts_since,
+        "pid": os.getpid(),
+        "dedup_window_seconds": TRACKING_DEDUP_WINDOW_SECONDS,
+        "events": events,
+        "dropped_total": sum(c for k, c in _tracking_event_counts.items() if not k.endswith(":accepted"))
+    }
+
 # --- User Management (Admin panel) ---
 
-@api_router.get("/admin/users/list")
+@app.get("/api/admin/users/list")
 async def admin_list_users(
     skip: int = 0,
     limit: int = 50,
@@ -2334,7 +5131,7 @@ async def admin_list_users(
         "limit": limit
     }
 
-@api_router.put("/admin/users/{user_id}/role")
+@app.put("/api/admin/users/{user_id}/role")
 async def admin_update_user_role(user_id: str, data: UserRoleUpdate, user: dict = Depends(get_owner_user)):
     """Update user role - OWNER ONLY"""
     if data.role not in ROLE_HIERARCHY:
@@ -2357,7 +5154,7 @@ async def admin_update_user_role(user_id: str, data: UserRoleUpdate, user: dict
     
     return {"success": True, "user_id": user_id, "new_role": data.role}
 
-@api_router.put("/admin/users/{user_id}/plan")
+@app.put("/api/admin/users/{user_id}/plan")
 async def admin_update_user_plan(user_id: str, data: UserPlanUpdate, user: dict = Depends(get_admin_user)):
     """Update user plan - Admin/Owner"""
     if data.plan not in ["free", "pro"]:
@@ -2371,12 +5168,13 @@ async def admin_update_user_plan(user_id: str, data: UserPlanUpdate, user: dict
         {"id": user_id},
         {"$set": {"plan": data.plan, "updated_at": datetime.now(timezone.utc).isoformat()}}
     )
+    await invalidate_user_caches(user_id)
     
     logging.info(f"User plan changed: {user_id} -> {data.plan} by {user['email']}")
     
     return {"success": True, "user_id": user_id, "new_plan": data.plan}
 
-@api_router.put("/owner/my-plan")
+@app.put("/api/owner/my-plan")
 async def owner_update_own_plan(data: UserPlanUpdate, user: dict = Depends(get_owner_user)):
     """Owner can change their own plan for testing purposes"""
     if data.plan not in ["free", "pro"]:
@@ -2386,12 +5184,13 @@ async def owner_update_own_plan(data: UserPlanUpdate, user: dict = Depends(get_o
         {"id": user["id"]},
         {"$set": {"plan": data.plan, "updated_at": datetime.now(timezone.utc).isoformat()}}
     )
+    await invalidate_user_caches(user["id"])
     
     logging.info(f"Owner changed own plan to {data.plan} for testing")
     
     return {"success": True, "new_plan": data.plan}
 
-@api_router.put("/admin/users/{user_id}/ban")
+@app.put("/api/admin/users/{user_id}/ban")
 async def admin_ban_user(user_id: str, data: UserBanUpdate, user: dict = Depends(get_admin_user)):
     """Ban/unban user - Admin/Moderator"""
     target_user = await db.users.find_one({"id": user_id})
@@ -2413,12 +5212,20 @@ async def admin_ban_user(user_id: str, data: UserBanUpdate, user: dict = Depends
         }}
     )
     
+    # Other workers re-read the user's pages and subdomains and drop their cached resolution
+    page_ids = [p["id"] async for p in db.pages.find({"user_id": user_id}, {"_id": 0, "id": 1})]
+    subdomains = [d["subdomain"] async for d in db.subdomains.find({"user_id": user_id}, {"_id": 0, "subdomain": 1})]
+    invalidate_subdomain_cache(user_id=user_id)
+    for subdomain in subdomains:
+        invalidate_subdomain_cache(subdomain=subdomain)
+    await publish_routing_change(page_ids=page_ids, subdomains=subdomains, user_ids=[user_id])
+    
     action = "забанен" if data.is_banned else "разбанен"
     logging.info(f"User {action}: {user_id} by {user['email']}")
     
     return {"success": True, "user_id": user_id, "is_banned": data.is_banned}
 
-@api_router.put("/admin/users/{user_id}/verify")
+@app.put("/api/admin/users/{user_id}/verify")
 async def admin_verify_user(user_id: str, data: UserVerifyUpdate, user: dict = Depends(get_admin_user)):
     """Set verified badge - Admin/Moderator"""
     target_user = await db.users.find_one({"id": user_id})
@@ -2435,13 +5242,14 @@ async def admin_verify_user(user_id: str, data: UserVerifyUpdate, user: dict = D
             "verified_by": user["id"] if data.is_verified else None
         }}
     )
+    await invalidate_user_caches(user_id)
     
     action = "верифицирован" if data.is_verified else "снята верификация"
     logging.info(f"User {action}: {user_id} by {user['email']}")
     
     return {"success": True, "user_id": user_id, "is_verified": data.is_verified}
 
-@api_router.get("/admin/users/{user_id}")
+@app.get("/api/admin/users/{user_id}")
 async def admin_get_user(user_id: str, user: dict = Depends(get_admin_user)):
     """Get user details - Admin panel"""
     target_user = await db.users.find_one(
@@ -2459,14 +5267,14 @@ async def admin_get_user(user_id: str, user: dict = Depends(get_admin_user)):
     pages = await db.pages.find({"user_id": user_id}, {"id": 1}).to_list(100)
     if pages:
         page_ids = [p["id"] for p in pages]
-        target_user["total_clicks"] = await db.clicks.count_documents({"page_id": {"$in": page_ids}})
+        target_user["total_clicks"] = await db.click_events.count_documents({"meta.page_id": {"$in": page_ids}})
     
     # Log admin view action
     await log_admin_action(user["id"], "ADMIN_VIEW_USER_PROFILE", {"target_user_id": user_id})
     
     return target_user
 
-@api_router.get("/admin/users/{user_id}/pages")
+@app.get("/api/admin/users/{user_id}/pages")
 async def admin_get_user_pages(
     user_id: str,
     skip: int = 0,
@@ -2490,12 +5298,12 @@ async def admin_get_user_pages(
     
     # Add click count for each page
     for page in pages:
-        page["total_clicks"] = await db.clicks.count_documents({"page_id": page["id"]})
+        page["total_clicks"] = await db.click_events.count_documents({"meta.page_id": page["id"]})
         # Get last 7 days clicks
         seven_days_ago = datetime.now(timezone.utc) - timedelta(days=7)
-        page["clicks_7d"] = await db.clicks.count_documents({
-            "page_id": page["id"],
-            "timestamp": {"$gte": seven_days_ago.isoformat()}
+        page["clicks_7d"] = await db.click_events.count_documents({
+            "meta.page_id": page["id"],
+            "timestamp": {"$gte": seven_days_ago}
         })
     
     # Log admin view action
@@ -2527,7 +5335,7 @@ async def log_admin_action(admin_id: str, event: str, details: dict = None):
     await db.audit_logs.insert_one(log_entry)
     logging.info(f"AUDIT: {event} by admin {admin_id} - {details}")
 
-@api_router.get("/admin/audit-logs")
+@app.get("/api/admin/audit-logs")
 async def admin_get_audit_logs(
     skip: int = 0,
     limit: int = 100,
@@ -2564,7 +5372,7 @@ async def admin_get_audit_logs(
 
 # --- Access Check API ---
 
-@api_router.get("/check-access/{requirement}")
+@app.get("/api/check-access/{requirement}")
 async def api_check_access(requirement: str, value: Optional[int] = None, user: dict = Depends(get_current_user)):
     """Check if current user has access to a feature"""
     has_access = await check_access(user, requirement, value)
@@ -2586,7 +5394,7 @@ async def api_check_access(requirement: str, value: Optional[int] = None, user:
 # Reserved subdomains that cannot be used
 RESERVED_SUBDOMAINS = {"www", "api", "admin", "app", "mail", "ftp", "smtp", "pop", "imap", "cdn", "static", "assets", "beta", "dev", "test", "staging", "preview"}
 
-@api_router.get("/subdomains")
+@app.get("/api/subdomains")
 async def get_user_subdomains(user: dict = Depends(get_current_user)):
     """Get all subdomains for current user"""
     subdomains = await db.subdomains.find({"user_id": user["id"]}, {"_id": 0}).to_list(100)
@@ -2602,7 +5410,7 @@ async def get_user_subdomains(user: dict = Depends(get_current_user)):
         "can_add": max_limit == -1 or len(subdomains) < max_limit
     }
 
-@api_router.get("/subdomains/check/{subdomain}")
+@app.get("/api/subdomains/check/{subdomain}")
 async def check_subdomain_availability(subdomain: str, user: dict = Depends(get_current_user)):
     """Check if subdomain is available"""
     subdomain = subdomain.lower().strip()
@@ -2628,7 +5436,7 @@ async def check_subdomain_availability(subdomain: str, user: dict = Depends(get_
     
     return {"available": True, "reason": None}
 
-@api_router.post("/subdomains")
+@app.post("/api/subdomains")
 async def create_subdomain(data: SubdomainCreate, user: dict = Depends(get_current_user)):
     """Create a new subdomain"""
     subdomain = data.subdomain.lower().strip()
@@ -2662,12 +5470,13 @@ async def create_subdomain(data: SubdomainCreate, user: dict = Depends(get_curre
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     await db.subdomains.insert_one(subdomain_doc)
+    await set_subdomain_route(subdomain, user["id"])
     
     logging.info(f"Subdomain created: {subdomain} by {user['email']}")
     
     return {k: v for k, v in subdomain_doc.items() if k != "_id"}
 
-@api_router.put("/subdomains/{subdomain_id}")
+@app.put("/api/subdomains/{subdomain_id}")
 async def update_subdomain(subdomain_id: str, data: SubdomainUpdate, user: dict = Depends(get_current_user)):
     """Update subdomain (toggle active status)"""
     subdomain = await db.subdomains.find_one({"id": subdomain_id, "user_id": user["id"]})
@@ -2678,10 +5487,12 @@ async def update_subdomain(subdomain_id: str, data: SubdomainUpdate, user: dict
         {"id": subdomain_id},
         {"$set": {"is_active": data.is_active, "updated_at": datetime.now(timezone.utc).isoformat()}}
     )
+    invalidate_subdomain_cache(subdomain=subdomain["subdomain"])
+    await publish_routing_change(subdomains=[subdomain["subdomain"]])
     
     return {"success": True, "is_active": data.is_active}
 
-@api_router.delete("/subdomains/{subdomain_id}")
+@app.delete("/api/subdomains/{subdomain_id}")
 async def delete_subdomain(subdomain_id: str, user: dict = Depends(get_current_user)):
     """Delete a subdomain"""
     subdomain = await db.subdomains.find_one({"id": subdomain_id, "user_id": user["id"]})
@@ -2689,6 +5500,7 @@ async def delete_subdomain(subdomain_id: str, user: dict = Depends(get_current_u
         raise HTTPException(status_code=404, detail="Поддомен не найден")
     
     await db.subdomains.delete_one({"id": subdomain_id})
+    await set_subdomain_route(subdomain["subdomain"], None)
     
     logging.info(f"Subdomain deleted: {subdomain['subdomain']} by {user['email']}")
     
@@ -2696,7 +5508,7 @@ async def delete_subdomain(subdomain_id: str, user: dict = Depends(get_current_u
 
 # --- Admin Subdomain Management ---
 
-@api_router.get("/admin/subdomains")
+@app.get("/api/admin/subdomains")
 async def admin_list_subdomains(
     skip: int = 0,
     limit: int = 50,
@@ -2723,7 +5535,7 @@ async def admin_list_subdomains(
         "limit": limit
     }
 
-@api_router.put("/admin/subdomains/{subdomain_id}/toggle")
+@app.put("/api/admin/subdomains/{subdomain_id}/toggle")
 async def admin_toggle_subdomain(subdomain_id: str, data: SubdomainUpdate, user: dict = Depends(get_admin_user)):
     """Force toggle subdomain status - Admin only"""
     subdomain = await db.subdomains.find_one({"id": subdomain_id})
@@ -2740,12 +5552,15 @@ async def admin_toggle_subdomain(subdomain_id: str, data: SubdomainUpdate, user:
         }}
     )
     
+    invalidate_subdomain_cache(subdomain=subdomain["subdomain"])
+    await publish_routing_change(subdomains=[subdomain["subdomain"]])
+    
     action = "включен" if data.is_active else "выключен"
     logging.info(f"Subdomain {action} by admin: {subdomain['subdomain']} by {user['email']}")
     
     return {"success": True, "is_active": data.is_active}
 
-@api_router.delete("/admin/subdomains/{subdomain_id}")
+@app.delete("/api/admin/subdomains/{subdomain_id}")
 async def admin_delete_subdomain(subdomain_id: str, user: dict = Depends(get_admin_user)):
     """Force delete subdomain - Admin only"""
     subdomain = await db.subdomains.find_one({"id": subdomain_id})
@@ -2753,6 +5568,7 @@ async def admin_delete_subdomain(subdomain_id: str, user: dict = Depends(get_adm
         raise HTTPException(status_code=404, detail="Поддомен не найден")
     
     await db.subdomains.delete_one({"id": subdomain_id})
+    await set_subdomain_route(subdomain["subdomain"], None)
     
     logging.info(f"Subdomain force deleted: {subdomain['subdomain']} by {user['email']}")
     
@@ -2760,13 +5576,13 @@ async def admin_delete_subdomain(subdomain_id: str, user: dict = Depends(get_adm
 
 # --- Waitlist Admin API ---
 
-@api_router.get("/admin/waitlist")
+@app.get("/api/admin/waitlist")
 async def admin_get_waitlist(user: dict = Depends(get_admin_user)):
     """Get all waitlist emails - Admin only"""
     emails = await db.waitlist.find({}, {"_id": 0}).sort("created_at", -1).to_list(500)
     return {"emails": emails, "total": len(emails)}
 
-@api_router.delete("/admin/waitlist/{email_id}")
+@app.delete("/api/admin/waitlist/{email_id}")
 async def admin_delete_waitlist_email(email_id: str, user: dict = Depends(get_admin_user)):
     """Delete waitlist email - Admin only"""
     result = await db.waitlist.delete_one({"id": email_id})
@@ -2776,20 +5592,21 @@ async def admin_delete_waitlist_email(email_id: str, user: dict = Depends(get_ad
 
 # --- Subdomain Resolution API ---
 
-@api_router.get("/resolve/{subdomain}")
+@app.get("/api/resolve/{subdomain}")
 async def resolve_subdomain(subdomain: str):
     """Resolve subdomain to user - for middleware"""
     subdomain = subdomain.lower().strip()
     
-    subdomain_doc = await db.subdomains.find_one({"subdomain": subdomain}, {"_id": 0})
+    resolved = await resolve_subdomain_owner(subdomain)
+    subdomain_doc = resolved["subdomain"]
     if not subdomain_doc:
         raise HTTPException(status_code=404, detail="Subdomain not found")
     
     if not subdomain_doc.get("is_active", True):
         raise HTTPException(status_code=410, detail="Домен неактивен")
     
-    # Get user info
-    user = await db.users.find_one({"id": subdomain_doc["user_id"]}, {"_id": 0, "id": 1, "username": 1, "is_banned": 1})
+    # Check user
+    user = resolved["user"]
     if not user or user.get("is_banned"):
         raise HTTPException(status_code=410, detail="Домен неактивен")
     
@@ -2799,13 +5616,14 @@ async def resolve_subdomain(subdomain: str):
         "username": user.get("username")
     }
 
-@api_router.get("/resolve/{subdomain}/page/{path}")
+@app.get("/api/resolve/{subdomain}/page/{path}")
 async def resolve_subdomain_page(subdomain: str, path: str):
     """Resolve subdomain + path to a specific page"""
     subdomain = subdomain.lower().strip()
     
     # Check subdomain
-    subdomain_doc = await db.subdomains.find_one({"subdomain": subdomain}, {"_id": 0})
+    resolved = await resolve_subdomain_owner(subdomain)
+    subdomain_doc = resolved["subdomain"]
     if not subdomain_doc:
         raise HTTPException(status_code=404, detail="Subdomain not found")
     
@@ -2813,10 +5631,15 @@ async def resolve_subdomain_page(subdomain: str, path: str):
         raise HTTPException(status_code=410, detail="Домен неактивен")
     
     # Check user
-    user = await db.users.find_one({"id": subdomain_doc["user_id"]}, {"_id": 0})
+    user = resolved["user"]
     if not user or user.get("is_banned"):
         raise HTTPException(status_code=410, detail="Домен неактивен")
     
+    # Unknown slugs or pages of another user are rejected from the routing table
+    route = await lookup_slug_route(path)
+    if not route or route["status"] != "active" or route["user_id"] != subdomain_doc["user_id"]:
+        raise HTTPException(status_code=404, detail="Page not found")
+    
     # Find page by slug belonging to this user
     page = await db.pages.find_one(
         {"slug": path, "user_id": subdomain_doc["user_id"], "status": "active"},
@@ -2825,8 +5648,8 @@ async def resolve_subdomain_page(subdomain: str, path: str):
     if not page:
         raise HTTPException(status_code=404, detail="Page not found")
     
-    # Increment view count
-    await db.pages.update_one({"id": page["id"]}, {"$inc": {"views": 1}})
+    # Increment view count (flushed in batches)
+    record_page_view(page["id"])
     
     # Get links
     links = await db.links.find({"page_id": page["id"], "active": True}, {"_id": 0}).sort("order", 1).to_list(100)
@@ -2841,7 +5664,7 @@ async def resolve_subdomain_page(subdomain: str, path: str):
 
 # --- Subdomain Page Endpoint (for direct subdomain access) ---
 
-@api_router.get("/subdomain-page")
+@app.get("/api/subdomain-page")
 async def get_subdomain_page(request: Request, slug: Optional[str] = None):
     """
     Get page data when accessing via subdomain.
@@ -2853,8 +5676,9 @@ async def get_subdomain_page(request: Request, slug: Optional[str] = None):
     if not subdomain:
         raise HTTPException(status_code=400, detail="Поддомен не указан")
     
-    # Resolve subdomain
-    subdomain_doc = await db.subdomains.find_one({"subdomain": subdomain}, {"_id": 0})
+    # Resolve subdomain (cached, including misses)
+    resolved = await resolve_subdomain_owner(subdomain)
+    subdomain_doc = resolved["subdomain"]
     if not subdomain_doc:
         raise HTTPException(status_code=404, detail="Поддомен не найден")
     
@@ -2862,7 +5686,7 @@ async def get_subdomain_page(request: Request, slug: Optional[str] = None):
         raise HTTPException(status_code=410, detail="Домен неактивен")
     
     # Check user
-    user = await db.users.find_one({"id": subdomain_doc["user_id"]}, {"_id": 0})
+    user = resolved["user"]
     if not user or user.get("is_banned"):
         raise HTTPException(status_code=410, detail="Домен неактивен")
     
@@ -2884,31 +5708,92 @@ async def get_subdomain_page(request: Request, slug: Optional[str] = None):
             "social_links": user.get("social_links", {})
         }
     
-    # Find specific page by slug
-    page = await db.pages.find_one(
-        {"slug": slug, "user_id": subdomain_doc["user_id"], "status": "active"},
-        {"_id": 0}
-    )
-    if not page:
+    # Unknown slugs or pages of another user are rejected from the routing table
+    route = await lookup_slug_route(slug)
+    if not route or route["status"] != "active" or route["user_id"] != subdomain_doc["user_id"]:
         raise HTTPException(status_code=404, detail="Страница не найдена")
     
-    # Increment view count
-    await db.pages.update_one({"id": page["id"]}, {"$inc": {"views": 1}})
+    # Subdomain, owner, page, active links and plan config in one round-trip.
+    # State is re-checked on the fresh documents, the cache only short-circuits misses.
+    docs = await db.subdomains.aggregate(subdomain_page_pipeline(subdomain, slug)).to_list(1)
+    if not docs:
+        raise HTTPException(status_code=404, detail="Поддомен не найден")
+    result = docs[0]
     
-    # Get links
-    links = await db.links.find({"page_id": page["id"], "active": True}, {"_id": 0}).sort("order", 1).to_list(100)
-    page["links"] = links
+    if not result.get("is_active", True) or result.get("disabled_by_admin", False):
+        raise HTTPException(status_code=410, detail="Домен неактивен")
     
-    # Get plan config for branding
-    plan_config = await get_plan_config(user.get("plan", "free"))
+    owner = result["owner"][0] if result["owner"] else None
+    if not owner or owner.get("is_banned"):
+        raise HTTPException(status_code=410, detail="Домен неактивен")
+    
+    if not result["page"]:
+        raise HTTPException(status_code=404, detail="Страница не найдена")
+    page = result["page"][0]
+    
+    # Increment view count (flushed in batches)
+    record_page_view(page["id"])
+    
+    page["links"] = result["links"]
+    
+    # Plan config for branding (defaults if the plan has no stored config)
+    plan_config = result["plan_config"][0] if result["plan_config"] else DEFAULT_PLAN_CONFIGS.get(
+        owner.get("plan", "free"), DEFAULT_PLAN_CONFIGS["free"]
+    )
     page["can_remove_branding"] = plan_config.get("can_remove_branding", False)
-    page["user_verified"] = user.get("verified", False) and user.get("show_verification_badge", True)
+    page["user_verified"] = owner.get("verified", False) and owner.get("show_verification_badge", True)
     page["subdomain"] = subdomain
-    page["owner_username"] = user.get("username")
+    page["owner_username"] = owner.get("username")
     
     return page
 
-@api_router.get("/my-limits")
+def subdomain_page_pipeline(subdomain: str, slug: str) -> list:
+    """Aggregation assembling a complete subdomain page payload from the subdomains collection"""
+    return [
+        {"$match": {"subdomain": subdomain}},
+        {"$limit": 1},
+        {"$project": {"_id": 0}},
+        {"$lookup": {
+            "from": "users",
+            "localField": "user_id",
+            "foreignField": "id",
+            "pipeline": [{"$project": SUBDOMAIN_OWNER_PROJECTION}],
+            "as": "owner"
+        }},
+        {"$lookup": {
+            "from": "pages",
+            "localField": "user_id",
+            "foreignField": "user_id",
+            "pipeline": [
+                {"$match": {"slug": slug, "status": "active"}},
+                {"$limit": 1},
+                {"$project": {"_id": 0}}
+            ],
+            "as": "page"
+        }},
+        {"$lookup": {
+            "from": "links",
+            "localField": "page.id",
+            "foreignField": "page_id",
+            "pipeline": [
+                {"$match": {"active": True}},
+                {"$sort": {"order": 1}},
+                {"$limit": 100},
+                {"$project": {"_id": 0}}
+            ],
+            "as": "links"
+        }},
+        {"$addFields": {"owner_plan": {"$ifNull": [{"$first": "$owner.plan"}, "free"]}}},
+        {"$lookup": {
+            "from": "plan_configs",
+            "localField": "owner_plan",
+            "foreignField": "plan_name",
+            "pipeline": [{"$project": {"_id": 0}}],
+            "as": "plan_config"
+        }}
+    ]
+
+@app.get("/api/my-limits")
 async def get_my_limits(user: dict = Depends(get_current_user)):
     """Get current user's plan limits and usage"""
     plan_config = await get_plan_config(user.get("plan", "free"))
@@ -2928,9 +5813,10 @@ async def get_my_limits(user: dict = Depends(get_current_user)):
 
 # ===================== METADATA LOOKUP =====================
 
-@api_router.get("/lookup/itunes")
+@app.get("/api/lookup/itunes", dependencies=[Depends(LOOKUP_RATE_LIMIT)])
 async def lookup_itunes(id: Optional[str] = None, term: Optional[str] = None):
     """Proxy endpoint for iTunes API to avoid CORS issues"""
+    import httpx
     try:
         async with httpx.AsyncClient() as client:
             if id:
@@ -2962,9 +5848,10 @@ async def lookup_itunes(id: Optional[str] = None, term: Optional[str] = None):
         logging.error(f"iTunes lookup error: {e}")
         return {"artwork": "", "trackName": "", "artistName": "", "collectionName": ""}
 
-@api_router.get("/lookup/spotify")
+@app.get("/api/lookup/spotify", dependencies=[Depends(LOOKUP_RATE_LIMIT)])
 async def lookup_spotify(url: str):
     """Proxy endpoint for Spotify oEmbed to avoid CORS issues"""
+    import httpx
     try:
         async with httpx.AsyncClient() as client:
             oembed_url = f"https://open.spotify.com/oembed?url={url}"
@@ -2980,10 +5867,11 @@ async def lookup_spotify(url: str):
         logging.error(f"Spotify lookup error: {e}")
         return {"artwork": "", "title": "", "provider": "spotify"}
 
-@api_router.get("/lookup/odesli")
+@app.get("/api/lookup/odesli", dependencies=[Depends(LOOKUP_RATE_LIMIT)])
 async def lookup_odesli(url: str, country: Optional[str] = "RU"):
     """Proxy endpoint for Odesli (song.link) API to get links for all platforms.
     Supports URLs and UPC codes (via iTunes lookup first)."""
+    import httpx
     try:
         async with httpx.AsyncClient() as client:
             # Check if input is a UPC code (numeric, typically 12-14 digits)
@@ -3084,7 +5972,7 @@ async def lookup_odesli(url: str, country: Optional[str] = "RU"):
 
 # ===================== FILE UPLOAD =====================
 
-@api_router.post("/upload")
+@app.post("/api/upload")
 async def upload_file(file: UploadFile = File(...), user: dict = Depends(get_current_user)):
     
     # Validate file type
@@ -3105,14 +5993,16 @@ async def upload_file(file: UploadFile = File(...), user: dict = Depends(get_cur
     # Generate blurred background
     bg_filename = f"{uuid.uuid4()}_blur.jpg"
     bg_filepath = UPLOAD_DIR / bg_filename
-    generate_blurred_background(str(filepath), str(bg_filepath))
+    await asyncio.get_running_loop().run_in_executor(
+        _image_executor, generate_blurred_background, str(filepath), str(bg_filepath)
+    )
     
     return {
         "cover_url": f"/api/uploads/{filename}",
         "background_url": f"/api/uploads/{bg_filename}"
     }
 
-@api_router.get("/uploads/{filename}")
+@app.get("/api/uploads/{filename}")
 async def get_upload(filename: str):
     filepath = UPLOAD_DIR / filename
     if not filepath.exists():
@@ -3125,7 +6015,7 @@ class CoverUploadRequest(BaseModel):
     image: str  # Base64 encoded image
     filename: Optional[str] = None
 
-@api_router.post("/covers/upload")
+@app.post("/api/covers/upload")
 async def upload_cover(data: CoverUploadRequest, user: dict = Depends(get_current_user)):
     """Upload a cover image (Base64) and save to server"""
     try:
@@ -3176,7 +6066,7 @@ async def upload_cover(data: CoverUploadRequest, user: dict = Depends(get_curren
         logging.error(f"Cover upload error: {e}")
         raise HTTPException(status_code=500, detail=f"Ошибка загрузки: {str(e)}")
 
-@api_router.get("/covers")
+@app.get("/api/covers")
 async def get_user_covers(user: dict = Depends(get_current_user)):
     """Get all covers for current user"""
     covers = await db.covers.find(
@@ -3185,7 +6075,7 @@ async def get_user_covers(user: dict = Depends(get_current_user)):
     ).sort("created_at", -1).to_list(100)
     return {"covers": covers}
 
-@api_router.delete("/covers/{cover_id}")
+@app.delete("/api/covers/{cover_id}")
 async def delete_cover(cover_id: str, user: dict = Depends(get_current_user)):
     """Delete a cover"""
     cover = await db.covers.find_one({"id": cover_id, "user_id": user["id"]})
@@ -3202,7 +6092,7 @@ async def delete_cover(cover_id: str, user: dict = Depends(get_current_user)):
     
     return {"success": True, "message": "Обложка удалена"}
 
-@api_router.get("/uploads/covers/{filename}")
+@app.get("/api/uploads/covers/{filename}")
 async def get_cover(filename: str):
     """Serve cover image"""
     filepath = COVERS_DIR / filename
@@ -3226,7 +6116,7 @@ class CoverProjectResponse(BaseModel):
     created_at: str
     updated_at: str
 
-@api_router.post("/projects/save")
+@app.post("/api/projects/save")
 async def save_cover_project(data: CoverProjectSave, user: dict = Depends(get_current_user)):
     """Save or update a cover project"""
     try:
@@ -3318,7 +6208,7 @@ async def save_cover_project(data: CoverProjectSave, user: dict = Depends(get_cu
         logging.error(f"Project save error: {e}")
         raise HTTPException(status_code=500, detail=f"Ошибка сохранения: {str(e)}")
 
-@api_router.get("/projects")
+@app.get("/api/projects")
 async def get_user_projects(user: dict = Depends(get_current_user)):
     """Get all cover projects for current user"""
     projects = await db.cover_projects.find(
@@ -3328,7 +6218,7 @@ async def get_user_projects(user: dict = Depends(get_current_user)):
     
     return {"projects": projects}
 
-@api_router.get("/projects/{project_id}")
+@app.get("/api/projects/{project_id}")
 async def get_project(project_id: str, user: dict = Depends(get_current_user)):
     """Get a specific cover project"""
     project = await db.cover_projects.find_one(
@@ -3341,7 +6231,7 @@ async def get_project(project_id: str, user: dict = Depends(get_current_user)):
     
     return {"project": project}
 
-@api_router.delete("/projects/{project_id}")
+@app.delete("/api/projects/{project_id}")
 async def delete_project(project_id: str, user: dict = Depends(get_current_user)):
     """Delete a cover project"""
     project = await db.cover_projects.find_one({
@@ -3371,9 +6261,10 @@ async def delete_project(project_id: str, user: dict = Depends(get_current_user)
 class AIGenerateRequest(BaseModel):
     prompt: str = Field(..., min_length=1, max_length=500)
 
-@api_router.post("/generate-bg")
+@app.post("/api/generate-bg")
 async def generate_ai_background(request: AIGenerateRequest, user: dict = Depends(get_current_user)):
     """Generate AI background image using Hugging Face Stable Diffusion XL"""
+    import httpx
     
     # Check if user has AI generation access
     plan_config = await get_plan_config(user.get("plan", "free"))
@@ -3454,7 +6345,7 @@ async def generate_ai_background(request: AIGenerateRequest, user: dict = Depend
 
 # ===================== SUPPORT TICKETS =====================
 
-@api_router.post("/tickets")
+@app.post("/api/tickets")
 async def create_ticket(data: TicketCreate, user: dict = Depends(get_current_user)):
     """Create a new support ticket"""
     ticket = {
@@ -3483,7 +6374,7 @@ async def create_ticket(data: TicketCreate, user: dict = Depends(get_current_use
     
     return {k: v for k, v in ticket.items() if k != "_id"}
 
-@api_router.get("/tickets")
+@app.get("/api/tickets")
 async def get_user_tickets(user: dict = Depends(get_current_user)):
     """Get all tickets for current user"""
     tickets = await db.tickets.find(
@@ -3493,7 +6384,7 @@ async def get_user_tickets(user: dict = Depends(get_current_user)):
     
     return tickets
 
-@api_router.get("/tickets/{ticket_id}")
+@app.get("/api/tickets/{ticket_id}")
 async def get_ticket(ticket_id: str, user: dict = Depends(get_current_user)):
     """Get specific ticket - user can only view their own tickets"""
     ticket = await db.tickets.find_one({"id": ticket_id}, {"_id": 0})
@@ -3515,7 +6406,7 @@ async def get_ticket(ticket_id: str, user: dict = Depends(get_current_user)):
     
     return ticket
 
-@api_router.post("/tickets/{ticket_id}/reply")
+@app.post("/api/tickets/{ticket_id}/reply")
 async def reply_to_ticket(ticket_id: str, data: TicketReply, user: dict = Depends(get_current_user)):
     """Add a reply to ticket"""
     ticket = await db.tickets.find_one({"id": ticket_id})
@@ -3557,7 +6448,7 @@ async def reply_to_ticket(ticket_id: str, data: TicketReply, user: dict = Depend
     updated_ticket = await db.tickets.find_one({"id": ticket_id}, {"_id": 0})
     return updated_ticket
 
-@api_router.get("/tickets/user/unread-count")
+@app.get("/api/tickets/user/unread-count")
 async def get_user_unread_tickets(user: dict = Depends(get_current_user)):
     """Get count of unread tickets for current user (staff replied)"""
     count = await db.tickets.count_documents({
@@ -3567,7 +6458,7 @@ async def get_user_unread_tickets(user: dict = Depends(get_current_user)):
     return {"unread_count": count}
 
 # Admin ticket endpoints
-@api_router.get("/admin/tickets")
+@app.get("/api/admin/tickets")
 async def admin_get_tickets(
     status: Optional[str] = None,
     skip: int = 0,
@@ -3587,7 +6478,7 @@ async def admin_get_tickets(
     
     return {"tickets": tickets, "total": total}
 
-@api_router.get("/admin/tickets/unread-count")
+@app.get("/api/admin/tickets/unread-count")
 async def admin_get_unread_tickets_count(user: dict = Depends(get_admin_user)):
     """Get count of unread tickets for staff"""
     if not has_role_permission(user.get("role", "user"), "moderator"):
@@ -3599,7 +6490,7 @@ async def admin_get_unread_tickets_count(user: dict = Depends(get_admin_user)):
     })
     return {"unread_count": count}
 
-@api_router.get("/admin/tickets/{ticket_id}")
+@app.get("/api/admin/tickets/{ticket_id}")
 async def admin_get_ticket(ticket_id: str, user: dict = Depends(get_admin_user)):
     """Get specific ticket and mark as read by staff"""
     if not has_role_permission(user.get("role", "user"), "moderator"):
@@ -3620,7 +6511,7 @@ async def admin_get_ticket(ticket_id: str, user: dict = Depends(get_admin_user))
     
     return ticket
 
-@api_router.put("/admin/tickets/{ticket_id}/status")
+@app.put("/api/admin/tickets/{ticket_id}/status")
 async def admin_update_ticket_status(ticket_id: str, data: TicketStatusUpdate, user: dict = Depends(get_admin_user)):
     """Update ticket status"""
     if not has_role_permission(user.get("role", "user"), "moderator"):
@@ -3639,8 +6530,376 @@ async def admin_update_ticket_status(ticket_id: str, data: TicketStatusUpdate, u
     
     return {"success": True, "status": data.status}
 
+# ===================== INDEX REGISTRY =====================
+
+# Every index the app relies on: (collection, keys, options).
+# ensure_indexes() creates them at startup and verify_indexes() checks that
+# what exists in MongoDB still matches (keys and unique/sparse/TTL options).
+INDEX_REGISTRY = [
+    ("users", [("email", 1)], {"unique": True}),
+    ("users", [("username", 1)], {"unique": True}),
+    ("users", [("reset_token", 1)], {"sparse": True}),
+    ("pages", [("slug", 1)], {"unique": True}),
+    ("pages", [("user_id", 1)], {}),
+    ("links", [("page_id", 1)], {}),
+    ("plan_configs", [("plan_name", 1)], {"unique": True}),
+    ("subdomains", [("subdomain", 1)], {"unique": True}),
+    ("subdomains", [("user_id", 1)], {}),
+    ("cover_projects", [("user_id", 1)], {}),
+    ("covers", [("user_id", 1), ("created_at", -1)], {}),
+    ("tickets", [("user_id", 1)], {}),
+    ("tickets", [("status", 1), ("is_read_by_staff", 1)], {}),
+    ("notifications", [("user_id", 1), ("created_at", -1)], {}),
+    ("verification_requests", [("user_id", 1), ("status", 1)], {}),
+    ("audit_logs", [("timestamp", -1)], {}),
+    ("waitlist", [("email", 1)], {}),
+    ("rate_limits", [("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ("system_metrics", [("resolution", 1), ("timestamp", 1)], {}),
+    ("system_metrics", [("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ("live_analytics", [("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ("live_analytics", [("created_at", 1)], {}),
+    ("live_subscriptions", [("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ("routing_changes", [("seq", 1)], {"unique": True}),
+    ("routing_changes", [("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ("app_settings", [("key", 1)], {"unique": True}),
+    ("page_analytics", [("page_id", 1)], {"unique": True}),
+    ("page_daily_uniques", [("page_id", 1), ("date", 1)], {}),
+    # Analytics events (time-series): per-page and per-link range scans
+    ("click_events", [("meta.page_id", 1), ("timestamp", 1)], {}),
+    ("click_events", [("meta.link_id", 1), ("timestamp", 1)], {}),
+    ("view_events", [("meta.page_id", 1), ("timestamp", 1)], {}),
+    ("share_events", [("meta.page_id", 1), ("timestamp", 1)], {}),
+]
+INDEX_OPTIONS_CHECKED = ("unique", "sparse", "expireAfterSeconds")
+# Unique indexes that upsert-based leases and sketch version checks rely on
+# to raise DuplicateKeyError.
+# Every worker creates them at boot, before its background loops start
+# (small collections; a no-op once the index exists).
+BOOT_INDEX_COLLECTIONS = ("app_settings", "page_analytics")
+
+async def create_registry_indexes(collections: Optional[tuple] = None):
+    """Create registry indexes (all, or only those of `collections`); failures are logged, not raised"""
+    for collection, keys, options in INDEX_REGISTRY:
+        if collections is not None and collection not in collections:
+            continue
+        try:
+            await db[collection].create_index(keys, **options)
+        except Exception as e:
+            logging.error(f"Failed to create index {collection} {keys}: {e}")
+
+async def ensure_indexes() -> List[dict]:
+    """Create all registry indexes and verify them; boot continues on failures"""
+    await create_registry_indexes()
+    
+    report = await verify_indexes()
+    problems = [r for r in report if r["status"] != "ok"]
+    if problems:
+        logging.warning(f"Index verification: {len(problems)} problem(s): {problems}")
+    else:
+        logging.info(f"Index verification: all {len(report)} registry indexes present")
+    return report
+
+async def verify_indexes() -> List[dict]:
+    """Compare INDEX_REGISTRY with the indexes that actually exist"""
+    existing_by_collection = {}
+    report = []
+    for collection, keys, options in INDEX_REGISTRY:
+        if collection not in existing_by_collection:
+            try:
+                existing_by_collection[collection] = await db[collection].index_information()
+            except Exception:
+                existing_by_collection[collection] = {}
+        
+        entry = {"collection": collection, "keys": [list(k) for k in keys], "options": options}
+        wanted = [tuple(k) for k in keys]
+        match = next(
+            ((name, info) for name, info in existing_by_collection[collection].items()
+             if [tuple(k) for k in info["key"]] == wanted),
+            None
+        )
+        
+        if not match:
+            entry["status"] = "missing"
+        else:
+            name, info = match
+            entry["name"] = name
+            mismatched = [opt for opt in INDEX_OPTIONS_CHECKED if info.get(opt) != options.get(opt)]
+            entry["status"] = "options_mismatch" if mismatched else "ok"
+            if mismatched:
+                entry["mismatched_options"] = mismatched
+        report.append(entry)
+    return report
+
+class DbProfilerUpdate(BaseModel):
+    level: int = Field(ge=0, le=2)
+    slowms: int = 100
+
+@app.get("/api/admin/db/indexes")
+async def admin_index_report(collscan_limit: int = 20, user: dict = Depends(get_admin_user)):
+    """Registry verification, per-index usage ($indexStats) and recent collection scans"""
+    registry = await verify_indexes()
+    
+    usage = []
+    for collection in sorted({c for c, _, _ in INDEX_REGISTRY}):
+        try:
+            async for stat in db[collection].aggregate([{"$indexStats": {}}]):
+                usage.append({
+                    "collection": collection,
+                    "name": stat["name"],
+                    "key": stat.get("key"),
+                    "ops": stat.get("accesses", {}).get("ops", 0),
+                    "since": stat.get("accesses", {}).get("since")
+                })
+        except Exception as e:
+            usage.append({"collection": collection, "error": str(e)})
+    usage.sort(key=lambda u: u.get("ops", 0))
+    
+    # Collection scans come from the database profiler (system.profile), if enabled
+    profiler = await db.command({"profile": -1})
+    collscans = []
+    if profiler.get("was", 0) > 0:
+        cursor = db.system.profile.aggregate([
+            {"$match": {"planSummary": "COLLSCAN", "ns": {"$not": {"$regex": r"\.system\."}}}},
+            {"$group": {
+                "_id": {"ns": "$ns", "op": "$op", "filter": {"$ifNull": ["$command.filter", "$command.pipeline"]}},
+                "count": {"$sum": 1},
+                "total_millis": {"$sum": "$millis"},
+                "max_docs_examined": {"$max": "$docsExamined"},
+                "last_seen": {"$max": "$ts"}
+            }},
+            {"$sort": {"total_millis": -1}},
+            {"$limit": collscan_limit}
+        ])
+        async for doc in cursor:
+            collscans.append({**doc.pop("_id"), **doc})
+    
+    return {
+        "registry": registry,
+        "usage": usage,
+        "profiler": {"level": profiler.get("was", 0), "slowms": profiler.get("slowms")},
+        "collscans": collscans
+    }
+
+@app.put("/api/admin/db/profiler")
+async def admin_set_db_profiler(data: DbProfilerUpdate, user: dict = Depends(get_admin_user)):
+    """Set the MongoDB profiler level (0 off, 1 slow ops, 2 all ops) that feeds the collscan report"""
+    if not has_role_permission(user.get("role", "user"), "admin"):
+        raise HTTPException(status_code=403, detail="Требуется роль админа или владельца")
+    
+    await db.command({"profile": data.level, "slowms": data.slowms})
+    await log_admin_action(user["id"], "ADMIN_SET_DB_PROFILER", {"level": data.level, "slowms": data.slowms})
+    return {"level": data.level, "slowms": data.slowms}
+
+# ===================== SCHEMA MIGRATIONS =====================
+
+# Data migrations run once per database instead of on every worker boot.
+# Applied versions are recorded in schema_migrations, and a lease document in
+# the same collection lets only one process run them at a time. Workers start
+# the runner in the background; deploys can run it up front with
+#   python server.py migrate
+# Migrations must be idempotent: an interrupted one is re-run from the start.
+MIGRATION_LOCK_SECONDS = 60
+MIGRATIONS = []  # (version, name, coroutine function), sorted by version
+
+def migration(version: int, name: str):
+    """Register a numbered data migration"""
+    def register(func):
+        if any(v == version for v, _, _ in MIGRATIONS):
+            raise ValueError(f"Duplicate migration version: {version}")
+        MIGRATIONS.append((version, name, func))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+    return register
+
+@migration(1, "rbac_fields_for_existing_users")
+async def migrate_rbac_fields():
+    result = await db.users.update_many(
+        {"is_banned": {"$exists": False}},
+        {"$set": {"is_banned": False, "is_verified": False}}
+    )
+    return f"{result.modified_count} users updated"
+
+@migration(2, "plan_config_feature_fields")
+async def migrate_plan_config_fields():
+    for plan_name in ["free", "pro"]:
+        default_config = DEFAULT_PLAN_CONFIGS[plan_name]
+        await db.plan_configs.update_one(
+            {"plan_name": plan_name, "max_subdomains_limit": {"$exists": False}},
+            {"$set": {
+                "max_subdomains_limit": default_config.get("max_subdomains_limit", 0),
+                "can_use_ai_generation": default_config.get("can_use_ai_generation", False),
+                "can_verify_profile": default_config.get("can_verify_profile", False)
+            }}
+        )
+
+@migration(3, "ultimate_plan_to_pro")
+async def migrate_ultimate_plan():
+    result = await db.users.update_many({"plan": "ultimate"}, {"$set": {"plan": "pro"}})
+    await db.plan_configs.delete_one({"plan_name": "ultimate"})
+    return f"{result.modified_count} users moved to pro"
+
+@migration(4, "backfill_time_series_events")
+async def migrate_time_series_events():
+    copied = {}
+    for name in EVENT_COLLECTIONS:
+        copied[name] = await backfill_event_collection(name)
+    return copied
+
+@migration(5, "page_analytics_sketches")
+async def migrate_page_analytics_sketches():
+    """
+    Seed the top-K sketches from the clicks made before sketch ingestion
+    started; workers flush the later ones themselves.
+    """
+    cutoff = await mark_sketch_ingestion_started()
+    
+    async def history_delta(match: dict) -> dict:
+        # One $group per dimension, read through a cursor: the site-wide city/referrer
+        # groups can be larger than one 16 MB document
+        delta = new_sketch_delta()
+        for dimension in SKETCH_DIMENSIONS:
+            pipeline = [
+                {"$match": {**match, "timestamp": {"$lt": cutoff}}},
+                {"$group": {"_id": SKETCH_HISTORY_GROUP_KEYS[dimension], "count": {"$sum": 1}}}
+            ]
+            async for d in db.click_events.aggregate(pipeline, allowDiskUse=True):
+                value = referrer_host(d["_id"]) if dimension == "referrer" else (d["_id"] or "Неизвестно")
+                if value:
+                    delta[dimension][value] += d["count"]
+        delta["clicks"] = sum(delta["country"].values())
+        return delta
+    
+    done = {
+        doc["page_id"]
+        async for doc in db.page_analytics.find({"backfilled": True}, {"_id": 0, "page_id": 1})
+    }
+    seeded = 0
+    async for page in db.pages.find({}, {"_id": 0, "id": 1}):
+        if page["id"] in done:
+            continue
+        await apply_sketch_delta(page["id"], await history_delta({"meta.page_id": page["id"]}), extra={"backfilled": True})
+        seeded += 1
+    if SITE_SKETCH_ID not in done:
+        await apply_sketch_delta(SITE_SKETCH_ID, await history_delta({}), extra={"backfilled": True})
+    return {"pages": seeded}
+
+async def acquire_migration_lock(owner: str) -> bool:
+    """Take or renew the migration lease"""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.schema_migrations.update_one(
+            {"_id": "lock", "$or": [{"owner": owner}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"owner": owner, "expires_at": now + timedelta(seconds=MIGRATION_LOCK_SECONDS)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+async def _renew_migration_lock(owner: str, lease: dict):
+    """
+    Keep the lease alive. If it is taken by another process, or cannot be
+    renewed before it may expire, cancel the running migration (lease["task"])
+    so two processes never run one concurrently.
+    """
+    renewed = time.monotonic()
+    while True:
+        await asyncio.sleep(MIGRATION_LOCK_SECONDS / 3)
+        try:
+            if await acquire_migration_lock(owner):
+                renewed = time.monotonic()
+                continue
+            reason = "taken by another process"
+        except Exception as e:
+            if time.monotonic() - renewed < MIGRATION_LOCK_SECONDS * 2 / 3:
+                logging.warning(f"Migration lock renewal failed, retrying: {e}")
+                continue
+            reason = f"not renewed in time: {e}"
+        logging.error(f"Migration lock lost ({reason}); stopping the running migration")
+        lease["lost"] = True
+        if lease["task"]:
+            lease["task"].cancel()
+        return
+
+async def get_applied_migrations() -> dict:
+    return {
+        doc["version"]: doc
+        async for doc in db.schema_migrations.find({"version": {"$exists": True}}, {"_id": 0})
+    }
+
+async def run_migrations(owner: Optional[str] = None) -> Optional[List[dict]]:
+    """
+    Create/verify the registry indexes, then apply pending migrations in
+    version order. Indexes come first: leases, salts and sketch upserts rely on
+    the unique ones, and a long backfill must not leave them missing.
+    Returns the applied migrations, or None if another process holds the lock.
+    A migration interrupted by losing the lock raises RuntimeError and is not
+    recorded; it runs again (from the start) next time.
+    """
+    owner = owner or f"{os.uname().nodename}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    if not await acquire_migration_lock(owner):
+        return None
+    
+    lease = {"task": None, "lost": False}
+    heartbeat = asyncio.create_task(_renew_migration_lock(owner, lease))
+    applied_now = []
+    try:
+        await ensure_indexes()
+        applied = await get_applied_migrations()
+        for version, name, func in MIGRATIONS:
+            if version in applied:
+                continue
+            if lease["lost"]:
+                raise RuntimeError("Migration lock lost; pending migrations were not run")
+            logging.info(f"Running migration {version}: {name}")
+            started = time.monotonic()
+            lease["task"] = asyncio.ensure_future(func())
+            try:
+                result = await lease["task"]
+            except asyncio.CancelledError:
+                if not lease["lost"]:
+                    raise
+                raise RuntimeError(f"Migration {version} stopped: migration lock lost")
+            finally:
+                lease["task"] = None
+            if lease["lost"]:
+                raise RuntimeError(f"Migration {version} finished after the migration lock was lost; not recorded")
+            record = {
+                "version": version,
+                "name": name,
+                "result": result,
+                "applied_at": datetime.now(timezone.utc).isoformat(),
+                "duration_ms": round((time.monotonic() - started) * 1000)
+            }
+            await db.schema_migrations.insert_one({**record})
+            applied_now.append(record)
+            logging.info(f"Migration {version} done in {record['duration_ms']}ms: {result}")
+    finally:
+        heartbeat.cancel()
+        await db.schema_migrations.delete_one({"_id": "lock", "owner": owner})
+    
+    return applied_now
+
+async def run_migrations_in_background():
+    """Startup hook: whichever worker wins the lock migrates, the rest skip"""
+    try:
+        applied = await run_migrations()
+        if applied is None:
+            logging.info("Migrations are being run by another process")
+    except Exception as e:
+        logging.error(f"Migrations failed: {e}")
+
 # ===================== STARTUP =====================
 
+# Strong references to long-running tasks so they are not garbage collected
+_background_tasks = set()
+
+def start_background_task(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
 @app.on_event("startup")
 async def startup_event():
     # Create default admin if not exists
@@ -3680,84 +6939,63 @@ async def startup_event():
             })
             logging.info(f"Created default plan config: {plan_name}")
     
-    # Migrate existing users to have new RBAC fields
-    users_migration = await db.users.update_many(
-        {"is_banned": {"$exists": False}},
-        {"$set": {"is_banned": False, "is_verified": False}}
-    )
-    if users_migration.modified_count > 0:
-        logging.info(f"Migrated {users_migration.modified_count} users with RBAC fields")
-    
-    # Create indexes
-    await db.users.create_index("email", unique=True)
-    await db.users.create_index("username", unique=True)
-    await db.pages.create_index("slug", unique=True)
-    await db.pages.create_index("user_id")
-    await db.links.create_index("page_id")
-    await db.clicks.create_index("link_id")
-    await db.plan_configs.create_index("plan_name", unique=True)
-    await db.subdomains.create_index("subdomain", unique=True)
-    await db.subdomains.create_index("user_id")
-    await db.cover_projects.create_index("user_id")
-    await db.tickets.create_index("user_id")
-    await db.tickets.create_index([("status", 1), ("is_read_by_staff", 1)])
-    
-    # Update existing plan configs with new fields
-    for plan_name in ["free", "pro"]:
-        if plan_name in DEFAULT_PLAN_CONFIGS:
-            default_config = DEFAULT_PLAN_CONFIGS[plan_name]
-            await db.plan_configs.update_one(
-                {"plan_name": plan_name},
-                {"$set": {
-                    "max_subdomains_limit": default_config.get("max_subdomains_limit", 0),
-                    "can_use_ai_generation": default_config.get("can_use_ai_generation", False),
-                    "can_verify_profile": default_config.get("can_verify_profile", False)
-                }},
-                upsert=True
-            )
+    # Analytics event collections must exist before the first tracking insert
+    await ensure_event_collections()
     
-    # Migrate users from 'ultimate' plan to 'pro'
-    await db.users.update_many(
-        {"plan": "ultimate"},
-        {"$set": {"plan": "pro"}}
-    )
+    # Lease/upsert unique indexes before anything below can race on them
+    await create_registry_indexes(BOOT_INDEX_COLLECTIONS)
     
-    # Remove old 'ultimate' plan config
-    await db.plan_configs.delete_one({"plan_name": "ultimate"})
+    # Visitor id salts, kept a day ahead so ingestion never waits on them
+    await refresh_visitor_salts()
+    start_background_task(visitor_salt_refresh_loop())
     
-    # Migrate old "Unknown" entries to "Неизвестно" for consistency
-    migration_result = await db.clicks.update_many(
-        {"$or": [{"country": "Unknown"}, {"city": "Unknown"}]},
-        {"$set": {"country": "Неизвестно", "city": "Неизвестно"}}
-    )
-    if migration_result.modified_count > 0:
-        logging.info(f"Migrated {migration_result.modified_count} click records with Unknown values")
+    # Clicks from here on reach the sketches live; migration 5 seeds the earlier ones
+    await mark_sketch_ingestion_started()
     
-    # Same for views
-    views_result = await db.views.update_many(
-        {"$or": [{"country": "Unknown"}, {"city": "Unknown"}]},
-        {"$set": {"country": "Неизвестно", "city": "Неизвестно"}}
-    )
-    if views_result.modified_count > 0:
-        logging.info(f"Migrated {views_result.modified_count} view records with Unknown values")
+    # Data migrations and index creation run in one worker, off the boot path
+    start_background_task(run_migrations_in_background())
     
-    # Same for shares
-    shares_result = await db.shares.update_many(
-        {"$or": [{"country": "Unknown"}, {"city": "Unknown"}]},
-        {"$set": {"country": "Неизвестно", "city": "Неизвестно"}}
-    )
-    if shares_result.modified_count > 0:
-        logging.info(f"Migrated {shares_result.modified_count} share records with Unknown values")
+    # Batch page view increments and analytics sketch updates
+    start_background_task(page_view_flush_loop())
+    start_background_task(page_sketch_flush_loop())
+    
+    # Live analytics counters from the other workers
+    if LIVE_ANALYTICS_BACKEND == "mongo":
+        start_background_task(live_broadcast_loop())
+        start_background_task(live_listener_loop())
+    
+    # Event loop lag probe, blocking watchdog and host/process metrics history
+    start_background_task(event_loop_lag_monitor())
+    _loop_watchdog.start(asyncio.get_running_loop())
+    start_background_task(system_metrics_sampler())
+    
+    # Warm the slug routing table and keep it in sync across workers
+    await load_routing_table()
+    start_background_task(routing_refresh_loop())
+    
+    # Load bot User-Agent list overrides and keep them in sync across workers
+    await load_bot_user_agents()
+    start_background_task(bot_user_agents_refresh_loop())
+    
+    # Incremental Parquet/Arrow copies of the event collections (one exporter holds the lease)
+    if ANALYTICS_SNAPSHOT_INTERVAL_SECONDS > 0:
+        start_background_task(analytics_snapshot_loop())
     
     logging.info(f"RBAC System initialized. Launch mode: {LAUNCH_MODE}")
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    _loop_watchdog.stop()
+    for task in list(_background_tasks):
+        task.cancel()
+    await flush_page_views()
+    await flush_page_sketches()
+    await flush_unique_visitors()
+    if _live_registry["registered"]:
+        await db.live_subscriptions.delete_one({"_id": LIVE_WORKER_ID})
     client.close()
 
-# Include router and configure CORS
-app.include_router(api_router)
-
+# Configure CORS
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -3766,8 +7004,37 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Outermost, so timings include every other middleware
+app.add_middleware(PerfMiddleware)
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
+
+async def _migrate_cli(list_only: bool):
+    applied = await get_applied_migrations()
+    if list_only:
+        for version, name, _ in MIGRATIONS:
+            status = f"applied {applied[version]['applied_at']}" if version in applied else "pending"
+            print(f"{version:>4}  {name:<40} {status}")
+        return
+    
+    await ensure_event_collections()
+    result = await run_migrations()
+    if result is None:
+        print("Another process holds the migration lock, try again later")
+        raise SystemExit(1)
+    print(f"Applied {len(result)} migration(s)")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Muslink backend maintenance")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subcommands.add_parser("migrate", help="apply pending schema migrations")
+    migrate_parser.add_argument("--list", action="store_true", help="show migration status without applying")
+    args = parser.parse_args()
+    
+    if args.command == "migrate":
+        asyncio.run(_migrate_cli(args.list))
@@ -0,0 +1,29 @@
+"""
+Shared setup for the unit tests that import backend/server.py directly.
+server.py reads its settings from the environment at import time; the Motor
+client connects lazily, so importing it needs no running MongoDB.
+"""
+import os
+import sys
+
+import pytest
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend")
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "muslink_unit_tests")
+os.environ.setdefault("JWT_SECRET", "unit-test-secret")
+os.environ.setdefault("OWNER_EMAIL", "owner@example.com")
+
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """server.db replaced by an in-memory mongomock_motor database (skipped when not installed)"""
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    import server
+    mock_db = mongomock_motor.AsyncMongoMockClient()["unit_tests"]
+    monkeypatch.setattr(server, "db", mock_db)
+    return mock_db
@@ -0,0 +1,171 @@
+"""
+Unit tests for the page analytics sketches
+Tests: SpaceSaving top-K, HyperLogLog serialization and merge, sketch_top,
+seeding sketches from the click history next to live ingestion (migration 5).
+Migration tests run against mongomock_motor (skipped when not installed).
+"""
+import asyncio
+import hashlib
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import pytest
+
+import server
+from server import HyperLogLog, SpaceSaving, sketch_top
+
+
+def hll_with(values, precision=12):
+    hll = HyperLogLog(precision)
+    for value in values:
+        hll.add_hash(int.from_bytes(hashlib.sha256(value.encode()).digest()[:8], "big"))
+    return hll
+
+
+class TestSpaceSaving:
+    """Weighted Space-Saving summary"""
+
+    def test_exact_below_capacity(self):
+        summary = SpaceSaving(4)
+        for value, weight in [("RU", 5), ("US", 2), ("RU", 1), ("DE", 3)]:
+            summary.add(value, weight)
+        assert summary.counters == {"RU": [6, 0], "US": [2, 0], "DE": [3, 0]}
+
+    def test_eviction_inherits_floor_as_error(self):
+        summary = SpaceSaving(2)
+        summary.add("a", 5)
+        summary.add("b", 2)
+        summary.add("c", 1)
+        # "b" (smallest) is evicted; "c" overestimates by at most 2
+        assert summary.counters == {"a": [5, 0], "c": [3, 2]}
+
+    def test_heavy_hitter_is_kept(self):
+        summary = SpaceSaving(8)
+        for i in range(500):
+            summary.add(f"rare{i}")
+            if i % 3 == 0:
+                summary.add("heavy")
+        count, error = summary.counters["heavy"]
+        assert count - error <= 167 <= count
+
+    def test_round_trip_through_list(self):
+        summary = SpaceSaving(3)
+        summary.add("x", 4)
+        summary.add("y", 1)
+        restored = SpaceSaving(3, summary.to_list())
+        assert restored.counters == summary.counters
+
+
+class TestHyperLogLog:
+    """Distinct count estimates and their stored form"""
+
+    def test_empty(self):
+        assert HyperLogLog().count() == 0
+
+    def test_estimate_within_error(self):
+        hll = hll_with(f"visitor-{i}" for i in range(20000))
+        assert abs(hll.count() - 20000) / 20000 < 0.05
+
+    def test_duplicates_do_not_count(self):
+        hll = hll_with(["same"] * 1000)
+        assert hll.count() == 1
+
+    def test_sparse_serialization_round_trip(self):
+        hll = hll_with(f"v{i}" for i in range(50))
+        data = hll.to_bytes()
+        assert len(data) < hll.size  # sparse form: 3 bytes per used register
+        assert len(data) % 3 == 0
+        assert HyperLogLog(12, data).registers == hll.registers
+
+    def test_dense_serialization_round_trip(self):
+        hll = hll_with(f"v{i}" for i in range(20000))
+        data = hll.to_bytes()
+        assert len(data) == hll.size
+        assert HyperLogLog(12, data).registers == hll.registers
+
+    def test_merge_is_union(self):
+        left = hll_with(f"v{i}" for i in range(0, 6000))
+        right = hll_with(f"v{i}" for i in range(3000, 9000))
+        union = hll_with(f"v{i}" for i in range(0, 9000))
+        left.merge(right)
+        assert left.registers == union.registers
+
+    def test_merge_of_restored_sketches(self):
+        left = HyperLogLog(12, hll_with(["a", "b"]).to_bytes())
+        left.merge(HyperLogLog(12, hll_with(["b", "c"]).to_bytes()))
+        assert left.count() == 3
+
+
+class TestSketchTop:
+    """Dashboard top lists read from stored sketches"""
+
+    def test_reports_guaranteed_counts_across_docs(self):
+        docs = [
+            {"top": {"country": [["RU", 10, 0], ["US", 6, 4]]}},
+            {"top": {"country": [["US", 3, 0], ["DE", 5, 1]]}},
+            {"top": {}},
+        ]
+        assert sketch_top(docs, "country") == [("RU", 10), ("US", 5), ("DE", 4)]
+
+    def test_limit(self):
+        docs = [{"top": {"city": [[f"c{i}", i, 0] for i in range(20)]}}]
+        assert [value for value, _ in sketch_top(docs, "city", limit=3)] == ["c19", "c18", "c17"]
+
+    def test_referrer_host(self):
+        assert server.referrer_host("https://www.Example.com/path?q=1") == "example.com"
+        assert server.referrer_host("t.co/abc") == "t.co"
+        assert server.referrer_host("") is None
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def live_click(page_id, country, referrer=None):
+    """What track_click does for the sketches"""
+    await server.db.click_events.insert_one(server.event_doc(
+        {"page_id": page_id, "link_id": "l1"}, referrer=referrer, country=country, city="Москва"
+    ))
+    server.record_click_sketch(page_id, country, "Москва", referrer)
+
+
+class TestSketchMigration:
+    """migrate_page_analytics_sketches with clicks already counted live"""
+
+    @pytest.fixture(autouse=True)
+    def history(self, db, monkeypatch):
+        monkeypatch.setattr(server, "_pending_sketches", defaultdict(server.new_sketch_delta))
+        # mongomock has no $regexFind; the results go through referrer_host() either way
+        monkeypatch.setitem(server.SKETCH_HISTORY_GROUP_KEYS, "referrer", "$referrer")
+        run(db.pages.insert_many([{"id": "p1"}, {"id": "p2"}]))
+        run(db.click_events.insert_many([
+            server.event_doc({"page_id": "p1", "link_id": "l1"}, datetime(2024, 1, 1, tzinfo=timezone.utc),
+                             country="Россия", city="Москва", referrer="https://www.t.co/x")
+            for _ in range(3)
+        ]))
+
+    def test_live_clicks_before_the_migration_are_not_counted_twice(self, db):
+        async def scenario():
+            await server.mark_sketch_ingestion_started()  # worker boot
+            await live_click("p1", "Россия", "https://t.co/y")
+            await live_click("p1", "Казахстан")
+            await live_click("p2", "Россия")
+            await server.flush_page_sketches()
+            await server.migrate_page_analytics_sketches()  # runs after the first flushes
+            return {doc["page_id"]: doc async for doc in db.page_analytics.find({}, {"_id": 0})}
+
+        docs = run(scenario())
+        assert docs["p1"]["clicks"] == 5
+        assert docs["p2"]["clicks"] == 1
+        assert docs[server.SITE_SKETCH_ID]["clicks"] == 6
+        assert sketch_top([docs["p1"]], "country") == [("Россия", 4), ("Казахстан", 1)]
+        assert sketch_top([docs["p1"]], "referrer") == [("t.co", 4)]
+
+    def test_cutoff_is_the_first_boot(self, db):
+        first = run(server.mark_sketch_ingestion_started())
+        assert run(server.mark_sketch_ingestion_started()) == first
+
+    def test_no_live_clicks_seeds_everything(self, db):
+        run(server.migrate_page_analytics_sketches())
+        doc = run(db.page_analytics.find_one({"page_id": "p1"}))
+        assert doc["clicks"] == 3 and doc["backfilled"] is True
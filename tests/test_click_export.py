@@ -0,0 +1,63 @@
+"""
+Unit tests for the raw click export helpers
+Tests: parse_export_bound, csv_safe_cell
+"""
+from datetime import datetime, timezone, timedelta
+
+import pytest
+from fastapi import HTTPException
+
+from server import csv_safe_cell, parse_export_bound
+
+
+class TestParseExportBound:
+    """from/to query values"""
+
+    def test_empty(self):
+        assert parse_export_bound(None, "from") is None
+        assert parse_export_bound("", "to", end=True) is None
+
+    def test_date_start(self):
+        assert parse_export_bound("2024-03-01", "from") == datetime(2024, 3, 1, tzinfo=timezone.utc)
+
+    def test_date_end_includes_whole_day(self):
+        assert parse_export_bound("2024-03-01", "to", end=True) == datetime(2024, 3, 2, tzinfo=timezone.utc)
+
+    def test_naive_datetime_is_utc(self):
+        assert parse_export_bound("2024-03-01T12:30:00", "from") == datetime(2024, 3, 1, 12, 30, tzinfo=timezone.utc)
+
+    def test_zulu_and_offset(self):
+        assert parse_export_bound("2024-03-01T12:00:00Z", "from") == datetime(2024, 3, 1, 12, tzinfo=timezone.utc)
+        bound = parse_export_bound("2024-03-01T15:00:00+03:00", "to", end=True)
+        assert bound == datetime(2024, 3, 1, 12, tzinfo=timezone.utc)
+        assert bound.utcoffset() == timedelta(hours=3)
+
+    @pytest.mark.parametrize("value", ["yesterday", "2024-13-01", "01.03.2024"])
+    def test_invalid(self, value):
+        with pytest.raises(HTTPException) as exc:
+            parse_export_bound(value, "from")
+        assert exc.value.status_code == 400
+        assert "'from'" in exc.value.detail
+
+
+class TestCsvSafeCell:
+    """Spreadsheet formula neutralisation"""
+
+    @pytest.mark.parametrize("value", [
+        "=HYPERLINK(\"http://evil\",\"x\")",
+        "+1+2",
+        "-2+3",
+        "@SUM(A1)",
+        "\tcmd",
+        "\rcmd",
+    ])
+    def test_formulas_are_quoted(self, value):
+        assert csv_safe_cell(value) == "'" + value
+
+    @pytest.mark.parametrize("value", ["Россия", "t.co", "2024-03-01T12:00:00+00:00", "", "a=b"])
+    def test_plain_values_unchanged(self, value):
+        assert csv_safe_cell(value) == value
+
+    def test_non_strings_unchanged(self):
+        assert csv_safe_cell(None) is None
+        assert csv_safe_cell(-5) == -5
@@ -0,0 +1,142 @@
+"""
+Unit tests for the time-series event storage
+Tests: legacy record conversion, backfill of legacy collections (resume,
+deleted pages), event deletion with pages.
+Runs against mongomock_motor (skipped when not installed).
+"""
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+import server
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def legacy_click(i, page_id="p1"):
+    return {
+        "id": f"click-{i}",
+        "page_id": page_id,
+        "link_id": "l1",
+        "timestamp": datetime(2024, 1, 1, tzinfo=timezone.utc).isoformat(),
+        "country": "Unknown",
+    }
+
+
+@pytest.fixture
+def pages(db, monkeypatch):
+    monkeypatch.setattr(server, "EVENT_BACKFILL_BATCH_SIZE", 4)
+    run(db.pages.insert_many([{"id": "p1", "slug": "one"}, {"id": "p2", "slug": "two"}]))
+
+
+class TestLegacyConversion:
+    """legacy_event_to_doc"""
+
+    def test_fields_and_meta(self):
+        doc = server.legacy_event_to_doc(
+            {**legacy_click(1), "city": "Unknown", "referrer": "https://t.co/x"},
+            ("page_id", "link_id"),
+        )
+        assert doc["meta"] == {"page_id": "p1", "link_id": "l1"}
+        assert doc["timestamp"] == datetime(2024, 1, 1, tzinfo=timezone.utc)
+        assert doc["country"] == "Неизвестно" and doc["city"] == "Неизвестно"
+        assert doc["referrer"] == "https://t.co/x"
+        assert "page_id" not in doc and "link_id" not in doc
+
+    def test_naive_timestamp_is_utc(self):
+        doc = server.legacy_event_to_doc({"page_id": "p1", "timestamp": "2024-01-01T10:00:00"}, ("page_id",))
+        assert doc["timestamp"] == datetime(2024, 1, 1, 10, tzinfo=timezone.utc)
+
+    def test_missing_timestamp_uses_object_id_time(self):
+        from bson import ObjectId
+        object_id = ObjectId.from_datetime(datetime(2023, 5, 1, tzinfo=timezone.utc))
+        doc = server.legacy_event_to_doc({"_id": object_id, "page_id": "p1"}, ("page_id",))
+        assert doc["timestamp"] == datetime(2023, 5, 1, tzinfo=timezone.utc)
+
+
+class TestEventBackfill:
+    """backfill_event_collection"""
+
+    def test_moves_everything_and_drops_legacy(self, db, pages):
+        async def scenario():
+            await db.clicks.insert_many([legacy_click(i) for i in range(10)])
+            copied = await server.backfill_event_collection("click_events")
+            events = await db.click_events.find({}, {"_id": 0}).to_list(None)
+            return copied, events, await db.list_collection_names()
+
+        copied, events, collections = run(scenario())
+        assert copied == 10
+        assert len(events) == 10
+        assert "clicks" not in collections
+        assert events[0]["meta"] == {"page_id": "p1", "link_id": "l1"}
+
+    def test_resumes_interrupted_batch_without_duplicates(self, db, pages):
+        async def scenario():
+            # State left by a run stopped after inserting a batch but before
+            # deleting it from the legacy collection and saving progress
+            await db.clicks.insert_many([legacy_click(i) for i in range(4, 10)])
+            await db.click_events.insert_many([
+                server.legacy_event_to_doc(legacy_click(i), ("page_id", "link_id")) for i in range(0, 8)
+            ])
+            await db.app_settings.insert_one({"key": "event_backfill:clicks", "copied": 4})
+
+            copied = await server.backfill_event_collection("click_events")
+            ids = [doc["id"] async for doc in db.click_events.find({}, {"_id": 0, "id": 1})]
+            progress = await db.app_settings.find_one({"key": "event_backfill:clicks"})
+            return copied, ids, progress
+
+        copied, ids, progress = run(scenario())
+        assert copied == 10
+        assert sorted(ids) == sorted(f"click-{i}" for i in range(10))
+        assert progress["completed_at"]
+
+    def test_records_of_deleted_pages_are_dropped(self, db, pages):
+        async def scenario():
+            await db.clicks.insert_many([legacy_click(i, page_id="p1") for i in range(3)])
+            await db.clicks.insert_many([legacy_click(i, page_id="gone") for i in range(3, 9)])
+            copied = await server.backfill_event_collection("click_events")
+            page_ids = await db.click_events.distinct("meta.page_id")
+            return copied, page_ids, await db.list_collection_names()
+
+        copied, page_ids, collections = run(scenario())
+        assert copied == 3
+        assert page_ids == ["p1"]
+        assert "clicks" not in collections
+
+    def test_missing_legacy_collection_is_a_no_op(self, db):
+        assert run(server.backfill_event_collection("view_events")) == 0
+
+
+class TestDeletePageEvents:
+    """Events go with their page, wherever they are stored"""
+
+    def test_time_series_and_legacy_rows(self, db, pages):
+        async def scenario():
+            await db.clicks.insert_many([legacy_click(1, "p1"), legacy_click(2, "p2")])
+            await db.views.insert_many([{"page_id": "p1"}, {"page_id": "p2"}])
+            await db.click_events.insert_many([
+                server.event_doc({"page_id": "p1", "link_id": "l1"}),
+                server.event_doc({"page_id": "p2", "link_id": "l2"}),
+            ])
+            await db.share_events.insert_one(server.event_doc({"page_id": "p1"}, share_type="link"))
+            await server.delete_page_events(["p1"])
+            return {
+                name: await db[name].distinct(field)
+                for name, field in [("clicks", "page_id"), ("views", "page_id"),
+                                    ("click_events", "meta.page_id"), ("share_events", "meta.page_id")]
+            }
+
+        remaining = run(scenario())
+        assert remaining == {"clicks": ["p2"], "views": ["p2"], "click_events": ["p2"], "share_events": []}
+
+    def test_delete_page_handler(self, db, pages):
+        owner = {"id": "u1", "role": "owner", "email": "o@example.com"}
+        run(db.pages.update_one({"id": "p1"}, {"$set": {"user_id": "u1"}}))
+        run(db.views.insert_one({"page_id": "p1"}))
+        run(db.view_events.insert_one(server.event_doc({"page_id": "p1"})))
+        run(server.delete_page("p1", owner))
+        assert run(db.views.count_documents({})) == 0
+        assert run(db.view_events.count_documents({})) == 0
@@ -0,0 +1,133 @@
+"""
+Unit tests for the migration runner
+Tests: version order, resume after a failed migration, the migration lock.
+Runs against mongomock_motor (skipped when not installed).
+"""
+import asyncio
+
+import pytest
+
+import server
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+class TestRunMigrations:
+    """run_migrations ordering, resume and locking"""
+
+    @pytest.fixture
+    def migrations(self, monkeypatch):
+        calls = []
+        failing = set()
+        registry = []
+
+        def register(version, name, fail=False):
+            if fail:
+                failing.add(version)
+
+            async def func():
+                calls.append(version)
+                if version in failing:
+                    raise RuntimeError("interrupted")
+                return f"done {version}"
+            registry.append((version, name, func))
+
+        monkeypatch.setattr(server, "MIGRATIONS", registry)
+        monkeypatch.setattr(server, "INDEX_REGISTRY", [("app_settings", [("key", 1)], {"unique": True})])
+        return register, calls, failing
+
+    def test_applies_pending_in_order(self, db, migrations):
+        register, calls, _ = migrations
+        register(1, "first")
+        register(2, "second")
+
+        applied = run(server.run_migrations(owner="unit"))
+        assert [m["version"] for m in applied] == [1, 2]
+        assert calls == [1, 2]
+        assert run(server.run_migrations(owner="unit")) == []
+        assert calls == [1, 2]
+
+    def test_resumes_after_failed_migration(self, db, migrations):
+        register, calls, failing = migrations
+        register(1, "first")
+        register(2, "second", fail=True)
+
+        with pytest.raises(RuntimeError):
+            run(server.run_migrations(owner="unit"))
+        assert set(run(server.get_applied_migrations())) == {1}
+
+        # Fixed and re-run: only the unfinished migration runs again
+        failing.clear()
+        calls.clear()
+        applied = run(server.run_migrations(owner="unit"))
+        assert [m["version"] for m in applied] == [2]
+        assert calls == [2]
+
+    def test_lock_released_after_failure(self, db, migrations):
+        register, _, _ = migrations
+        register(1, "first", fail=True)
+        with pytest.raises(RuntimeError):
+            run(server.run_migrations(owner="unit"))
+        assert run(db.schema_migrations.find_one({"_id": "lock"})) is None
+
+    def test_held_lock_skips_run(self, db, migrations):
+        register, calls, _ = migrations
+        register(1, "first")
+        assert run(server.acquire_migration_lock("other"))
+        assert run(server.run_migrations(owner="unit")) is None
+        assert calls == []
+
+
+class TestLeaseLoss:
+    """A migration stops when its lease is lost and is not recorded"""
+
+    @pytest.fixture
+    def slow_migration(self, db, monkeypatch):
+        monkeypatch.setattr(server, "MIGRATION_LOCK_SECONDS", 0.3)
+        monkeypatch.setattr(server, "INDEX_REGISTRY", [])
+        progress = {"started": False, "finished": False}
+
+        async def slow():
+            progress["started"] = True
+            await asyncio.sleep(5)
+            progress["finished"] = True
+
+        monkeypatch.setattr(server, "MIGRATIONS", [(1, "slow", slow)])
+        return progress
+
+    def test_taken_lease_cancels_migration(self, db, slow_migration):
+        async def scenario():
+            runner = asyncio.create_task(server.run_migrations(owner="unit"))
+            while not slow_migration["started"]:
+                await asyncio.sleep(0.01)
+            # Another process takes the lease (e.g. after a long pause of this one)
+            await db.schema_migrations.update_one(
+                {"_id": "lock"},
+                {"$set": {"owner": "other", "expires_at": server.datetime.now(server.timezone.utc) + server.timedelta(hours=1)}}
+            )
+            with pytest.raises(RuntimeError, match="lock lost"):
+                await asyncio.wait_for(runner, 3)
+            return await server.get_applied_migrations(), await db.schema_migrations.find_one({"_id": "lock"})
+
+        applied, lock = run(scenario())
+        assert applied == {}
+        assert slow_migration["finished"] is False
+        assert lock["owner"] == "other"  # the other process keeps its lease
+
+    def test_unrenewable_lease_cancels_migration(self, db, slow_migration, monkeypatch):
+        acquire = server.acquire_migration_lock
+        calls = []
+
+        async def flaky_acquire(owner):
+            calls.append(owner)
+            if len(calls) > 1:
+                raise ConnectionError("connection lost")
+            return await acquire(owner)
+
+        monkeypatch.setattr(server, "acquire_migration_lock", flaky_acquire)
+        with pytest.raises(RuntimeError, match="lock lost"):
+            run(asyncio.wait_for(server.run_migrations(owner="unit"), 3))
+        assert run(server.get_applied_migrations()) == {}
+        assert slow_migration["finished"] is False
@@ -0,0 +1,183 @@
+"""
+Unit tests for the performance instrumentation
+Tests: histograms, per-route stats from PerfMiddleware, event loop lag,
+blocking-section watchdog with stack samples, Prometheus export and its token.
+"""
+import asyncio
+import time
+from collections import defaultdict
+
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+
+import server
+from server import Histogram, LoopBlockWatchdog, PerfMiddleware
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture
+def route_stats(monkeypatch):
+    fresh = defaultdict(server.RouteStats)
+    monkeypatch.setattr(server, "_route_stats", fresh)
+    return fresh
+
+
+@pytest.fixture
+def client(route_stats):
+    app = FastAPI()
+
+    @app.get("/items/{item_id}")
+    async def get_item(item_id: str):
+        return {"id": item_id}
+
+    @app.get("/boom")
+    async def boom():
+        raise RuntimeError("boom")
+
+    @app.get("/stream")
+    async def stream():
+        return StreamingResponse(iter([b"data: 1\n\n"]), media_type="text/event-stream")
+
+    app.add_middleware(PerfMiddleware)
+    return TestClient(app, raise_server_exceptions=False)
+
+
+class TestHistogram:
+    """Histogram buckets and quantiles"""
+
+    def test_buckets_and_overflow(self):
+        histogram = Histogram((10, 100))
+        for value in (1, 10, 11, 500):
+            histogram.observe(value)
+        assert histogram.counts == [2, 1, 1]
+        assert histogram.count == 4 and histogram.total == 522 and histogram.max == 500
+
+    def test_quantile_is_bucket_bound_capped_at_max(self):
+        histogram = Histogram((10, 100, 1000))
+        for value in [5] * 98 + [40, 60]:
+            histogram.observe(value)
+        assert histogram.quantile(0.5) == 10
+        assert histogram.quantile(0.99) == 60
+
+    def test_quantile_in_overflow_bucket(self):
+        histogram = Histogram((10,))
+        histogram.observe(250)
+        assert histogram.quantile(0.99) == 250
+
+    def test_empty(self):
+        assert Histogram((10,)).quantile(0.5) == 0.0
+
+
+class TestPerfMiddleware:
+    """Per-route latency, errors and round-trips"""
+
+    def test_keyed_by_route_template(self, client, route_stats):
+        client.get("/items/a")
+        client.get("/items/b")
+        stats = route_stats[("GET", "/items/{item_id}")]
+        assert stats.latency_ms.count == 2
+        assert stats.db_roundtrips.count == 2 and stats.errors == 0
+
+    def test_server_errors_counted(self, client, route_stats):
+        assert client.get("/boom").status_code == 500
+        assert route_stats[("GET", "/boom")].errors == 1
+
+    def test_unmatched_paths_share_one_entry(self, client, route_stats):
+        client.get("/nope/1")
+        client.get("/nope/2")
+        assert list(route_stats) == [("GET", "<unmatched>")]
+        assert route_stats[("GET", "<unmatched>")].latency_ms.count == 2
+
+    def test_event_streams_are_not_timed(self, client, route_stats):
+        client.get("/stream")
+        assert ("GET", "/stream") not in route_stats
+
+
+class TestEventLoopLag:
+    """event_loop_lag_monitor"""
+
+    def test_blocked_loop_shows_as_lag(self, monkeypatch):
+        monkeypatch.setattr(server, "LOOP_LAG_PROBE_SECONDS", 0.01)
+        monkeypatch.setattr(server, "_loop_lag", {"last_ms": 0.0, "max_ms": 0.0})
+        monkeypatch.setattr(server, "_loop_lag_histogram", Histogram(server.PERF_LATENCY_BUCKETS_MS))
+
+        async def scenario():
+            task = asyncio.ensure_future(server.event_loop_lag_monitor())
+            await asyncio.sleep(0)
+            time.sleep(0.08)  # block the loop
+            await asyncio.sleep(0.03)
+            task.cancel()
+
+        run(scenario())
+        assert server._loop_lag["max_ms"] >= 50
+        assert server._loop_lag_histogram.count >= 1
+
+
+def blocking_section():
+    time.sleep(0.25)
+
+
+class TestLoopBlockWatchdog:
+    """Blocking episodes with stack samples"""
+
+    def test_captures_blocking_stack(self):
+        watchdog = LoopBlockWatchdog(threshold_ms=50, check_interval=0.01)
+
+        async def scenario():
+            watchdog.start(asyncio.get_running_loop())
+            await asyncio.sleep(0.05)
+            blocking_section()
+            await asyncio.sleep(0.1)
+            watchdog.stop()
+
+        run(scenario())
+        assert watchdog.blocked_total == 1
+        episode = watchdog.episodes[0]
+        assert episode["duration_ms"] >= 150
+        assert any("blocking_section" in stack for stack in episode["stacks"])
+
+    def test_short_pauses_are_ignored(self):
+        watchdog = LoopBlockWatchdog(threshold_ms=200, check_interval=0.01)
+
+        async def scenario():
+            watchdog.start(asyncio.get_running_loop())
+            time.sleep(0.05)
+            await asyncio.sleep(0.1)
+            watchdog.stop()
+
+        run(scenario())
+        assert watchdog.blocked_total == 0 and not watchdog.episodes
+
+
+class TestPrometheus:
+    """Text export and access"""
+
+    def test_cumulative_buckets(self, client, route_stats):
+        client.get("/items/a")
+        text = server.render_prometheus_metrics()
+        lines = [line for line in text.splitlines() if line.startswith("muslink_http_request_duration_seconds")]
+        buckets = [int(line.rsplit(" ", 1)[1]) for line in lines if "_bucket" in line]
+        assert buckets == sorted(buckets) and buckets[-1] == 1
+        assert any('route="/items/{item_id}"' in line and 'le="+Inf"' in line for line in lines)
+        assert text.endswith("\n")
+
+    def test_label_escaping(self):
+        assert server._prom_label('a"b\\c\nd') == 'a\\"b\\\\c\\nd'
+
+    def test_token_access(self, monkeypatch, route_stats):
+        monkeypatch.setattr(server, "PROMETHEUS_TOKEN", "scrape-secret")
+        request = server.Request({"type": "http", "headers": [(b"authorization", b"Bearer scrape-secret")]})
+        response = run(server.admin_system_perf_prometheus(request))
+        assert response.media_type.startswith("text/plain")
+
+    def test_wrong_token_needs_admin_session(self, monkeypatch):
+        monkeypatch.setattr(server, "PROMETHEUS_TOKEN", "scrape-secret")
+        request = server.Request({"type": "http", "headers": [(b"authorization", b"Bearer guess")]})
+        with pytest.raises(server.HTTPException) as exc:
+            run(server.admin_system_perf_prometheus(request))
+        assert exc.value.status_code == 401
@@ -0,0 +1,150 @@
+"""
+Unit tests for the per-request MongoDB query profiler
+Tests: query shapes, command attribution to the request, N+1 detection and
+its warning, X-DB-Queries / X-DB-Time debug headers.
+"""
+import logging
+from collections import defaultdict
+from types import SimpleNamespace
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import server
+from server import DbCommandListener, PerfMiddleware, RequestDbStats, query_shape
+
+
+def command_event(name, command, duration_micros=2000):
+    return SimpleNamespace(command_name=name, command=command, duration_micros=duration_micros)
+
+
+def issue(listener, name, command, duration_micros=2000):
+    event = command_event(name, command, duration_micros)
+    listener.started(event)
+    listener.succeeded(event)
+
+
+@pytest.fixture
+def route_stats(monkeypatch):
+    fresh = defaultdict(server.RouteStats)
+    monkeypatch.setattr(server, "_route_stats", fresh)
+    return fresh
+
+
+def make_client(queries_per_request):
+    """App whose handler 'issues' MongoDB commands through the listener"""
+    app = FastAPI()
+    listener = DbCommandListener()
+
+    @app.get("/pages/{page_id}")
+    async def handler(page_id: str):
+        issue(listener, "find", {"find": "pages", "filter": {"id": page_id}})
+        for i in range(queries_per_request):
+            issue(listener, "find", {"find": "links", "filter": {"page_id": f"p{i}"}})
+        return {"ok": True}
+
+    app.add_middleware(PerfMiddleware)
+    return TestClient(app)
+
+
+class TestQueryShape:
+    """Literal values stripped, structure kept"""
+
+    def test_find(self):
+        assert query_shape("find", {"find": "users", "filter": {"id": "u1"}}) == "find users {id:?}"
+
+    def test_same_shape_for_different_values(self):
+        first = query_shape("find", {"find": "links", "filter": {"page_id": "a", "active": True}})
+        second = query_shape("find", {"find": "links", "filter": {"active": False, "page_id": "b"}})
+        assert first == second == "find links {active:?,page_id:?}"
+
+    def test_operators_kept(self):
+        shape = query_shape("find", {"find": "pages", "filter": {"id": {"$in": ["a", "b"]}}})
+        assert shape == "find pages {id:{$in:[?]}}"
+
+    def test_aggregate_uses_first_match(self):
+        command = {"aggregate": "click_events", "pipeline": [{"$match": {"meta.page_id": "p1"}}, {"$group": {}}]}
+        assert query_shape("aggregate", command) == "aggregate click_events {meta.page_id:?}"
+
+    def test_update_and_count(self):
+        assert query_shape("update", {"update": "pages", "updates": [{"q": {"id": "p"}, "u": {}}]}) == "update pages {id:?}"
+        assert query_shape("count", {"count": "users", "query": {"plan": "pro"}}) == "count users {plan:?}"
+
+    def test_other_commands(self):
+        assert query_shape("insert", {"insert": "audit_logs", "documents": []}) == "insert audit_logs"
+
+
+class TestAttribution:
+    """DbCommandListener counts commands for the request in the context"""
+
+    def test_counts_time_and_shapes(self):
+        stats = RequestDbStats()
+        token = server._request_db_stats.set(stats)
+        try:
+            listener = DbCommandListener()
+            issue(listener, "find", {"find": "users", "filter": {"id": "1"}}, 1500)
+            issue(listener, "find", {"find": "users", "filter": {"id": "2"}}, 500)
+            issue(listener, "getMore", {"getMore": 1, "collection": "users"})
+        finally:
+            server._request_db_stats.reset(token)
+        assert stats.roundtrips == 3
+        assert stats.time_ms == pytest.approx(4.0)
+        assert stats.shapes == {"find users {id:?}": 2}  # getMore continues a query
+
+    def test_outside_a_request_only_global_counts(self, monkeypatch):
+        counts = defaultdict(int)
+        monkeypatch.setattr(server, "_db_command_counts", counts)
+        issue(DbCommandListener(), "find", {"find": "users", "filter": {}})
+        assert counts == {"find": 1}
+
+
+class TestRepeatedQueries:
+    """N+1 detection"""
+
+    def test_below_threshold_is_quiet(self, route_stats, monkeypatch, caplog):
+        monkeypatch.setattr(server, "DB_REPEATED_QUERY_THRESHOLD", 5)
+        with caplog.at_level(logging.WARNING):
+            make_client(4).get("/pages/p")
+        stats = route_stats[("GET", "/pages/{page_id}")]
+        assert stats.repeated_query_requests == 0 and stats.worst_repeated_query is None
+        assert "Repeated query" not in caplog.text
+
+    def test_repeated_shape_is_flagged(self, route_stats, monkeypatch, caplog):
+        monkeypatch.setattr(server, "DB_REPEATED_QUERY_THRESHOLD", 5)
+        with caplog.at_level(logging.WARNING):
+            make_client(7).get("/pages/p")
+        stats = route_stats[("GET", "/pages/{page_id}")]
+        assert stats.repeated_query_requests == 1
+        assert stats.worst_repeated_query == {"shape": "find links {page_id:?}", "count": 7}
+        assert "GET /pages/{page_id} issued `find links {page_id:?}` 7x (8 queries" in caplog.text
+
+    def test_worst_request_is_kept(self, route_stats, monkeypatch):
+        monkeypatch.setattr(server, "DB_REPEATED_QUERY_THRESHOLD", 5)
+        make_client(9).get("/pages/p")
+        make_client(6).get("/pages/p")
+        stats = route_stats[("GET", "/pages/{page_id}")]
+        assert stats.repeated_query_requests == 2
+        assert stats.worst_repeated_query["count"] == 9
+
+    def test_roundtrip_histogram(self, route_stats):
+        make_client(3).get("/pages/p")
+        stats = route_stats[("GET", "/pages/{page_id}")]
+        assert stats.db_roundtrips.total == 4
+        assert stats.db_time_ms == pytest.approx(8.0)
+
+
+class TestDebugHeaders:
+    """X-DB-Queries / X-DB-Time outside production"""
+
+    def test_headers_when_enabled(self, route_stats, monkeypatch):
+        monkeypatch.setattr(server, "DB_DEBUG_HEADERS", True)
+        response = make_client(2).get("/pages/p")
+        assert response.headers["x-db-queries"] == "3"
+        assert response.headers["x-db-time"] == "6.0ms"
+
+    def test_no_headers_in_production(self, route_stats, monkeypatch):
+        monkeypatch.setattr(server, "DB_DEBUG_HEADERS", False)
+        response = make_client(2).get("/pages/p")
+        assert "x-db-queries" not in response.headers
+        assert "x-db-time" not in response.headers
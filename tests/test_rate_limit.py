@@ -0,0 +1,201 @@
+"""
+Unit tests for the in-process rate limiter
+Tests: token bucket and sliding window (memory backend), RateLimit.check, fail-open,
+client keys from trusted proxies only, separate password limits
+"""
+import asyncio
+
+import pytest
+
+import server
+from server import MemoryRateLimitBackend, RateLimit
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def make_request(peer="127.0.0.1", forwarded_for=None):
+    headers = [(b"x-forwarded-for", forwarded_for.encode())] if forwarded_for else []
+    return server.Request({"type": "http", "headers": headers, "client": (peer, 50000)})
+
+
+class FakeClock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    fresh = MemoryRateLimitBackend()
+    monkeypatch.setattr(server, "_memory_rate_limit_backend", fresh)
+    return fresh
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Start of a 60 s window, so sliding window weights are easy to follow
+    fake = FakeClock(1_700_000_040.0)
+    monkeypatch.setattr(server.time, "time", fake)
+    return fake
+
+
+class TestTokenBucket:
+    """MemoryRateLimitBackend.token_bucket"""
+
+    def test_burst_up_to_capacity(self):
+        bucket = MemoryRateLimitBackend()
+        results = [run(bucket.token_bucket("k", 3, 1.0, 100.0))[0] for _ in range(4)]
+        assert results == [True, True, True, False]
+
+    def test_refill_over_time(self):
+        bucket = MemoryRateLimitBackend()
+        for _ in range(3):
+            run(bucket.token_bucket("k", 3, 0.5, 100.0))
+        assert run(bucket.token_bucket("k", 3, 0.5, 101.0))[0] is False  # 0.5 token
+        assert run(bucket.token_bucket("k", 3, 0.5, 102.0))[0] is True   # 1.0 token
+
+    def test_refill_capped_at_capacity(self):
+        bucket = MemoryRateLimitBackend()
+        run(bucket.token_bucket("k", 2, 1.0, 100.0))
+        allowed, tokens = run(bucket.token_bucket("k", 2, 1.0, 10_000.0))
+        assert allowed and tokens == 1
+
+    def test_keys_are_independent(self):
+        bucket = MemoryRateLimitBackend()
+        run(bucket.token_bucket("a", 1, 0.01, 100.0))
+        assert run(bucket.token_bucket("a", 1, 0.01, 100.0))[0] is False
+        assert run(bucket.token_bucket("b", 1, 0.01, 100.0))[0] is True
+
+
+class TestSlidingWindow:
+    """MemoryRateLimitBackend.sliding_window"""
+
+    def test_counts_current_and_previous(self):
+        window = MemoryRateLimitBackend()
+        for _ in range(3):
+            run(window.sliding_window("k", 10))
+        assert run(window.sliding_window("k", 11)) == (1, 3)
+
+    def test_old_windows_reset(self):
+        window = MemoryRateLimitBackend()
+        run(window.sliding_window("k", 10))
+        assert run(window.sliding_window("k", 12)) == (1, 0)
+
+    def test_bounded_keys(self):
+        window = MemoryRateLimitBackend(max_keys=2)
+        for key in ("a", "b", "c"):
+            run(window.sliding_window(key, 1))
+        assert list(window._entries) == ["b", "c"]
+
+
+class TestRateLimit:
+    """RateLimit.check with the memory backend"""
+
+    def test_sliding_window_limit(self, backend, clock):
+        limit = RateLimit("unit", 3, 60, backend="memory")
+        results = [run(limit.check("1.2.3.4")) for _ in range(4)]
+        assert [allowed for allowed, _ in results] == [True, True, True, False]
+        assert 1 <= results[-1][1] <= 61
+
+    def test_previous_window_weighs_less_over_time(self, backend, clock):
+        limit = RateLimit("unit", 4, 60, backend="memory")
+        for _ in range(4):
+            run(limit.check("ip"))
+        clock.now += 60 + 15  # previous window still weighs 3/4
+        assert run(limit.check("ip"))[0] is True    # 3 + 1
+        assert run(limit.check("ip"))[0] is False   # 3 + 2
+        clock.now += 30       # now weighs 1/4
+        assert run(limit.check("ip"))[0] is True    # 1 + 3
+
+    def test_token_bucket_retry_after(self, backend, clock):
+        limit = RateLimit("unit", 2, 60, algorithm="token_bucket", backend="memory")
+        assert run(limit.check("ip")) == (True, 0)
+        assert run(limit.check("ip")) == (True, 0)
+        allowed, retry_after = run(limit.check("ip"))
+        assert not allowed and retry_after == 31  # one token every 30 s
+
+    def test_limits_are_per_name_and_client(self, backend, clock):
+        login = RateLimit("login_unit", 1, 60, backend="memory")
+        other = RateLimit("other_unit", 1, 60, backend="memory")
+        assert run(login.check("ip"))[0]
+        assert not run(login.check("ip"))[0]
+        assert run(login.check("ip2"))[0]
+        assert run(other.check("ip"))[0]
+
+    def test_unknown_algorithm(self):
+        with pytest.raises(ValueError):
+            RateLimit("unit", 1, 60, algorithm="leaky")
+
+    def test_check_request_fails_open(self, monkeypatch):
+        async def broken(*args, **kwargs):
+            raise RuntimeError("backend down")
+        limit = RateLimit("unit", 1, 60, backend="memory")
+        monkeypatch.setattr(limit, "check", broken)
+        request = server.Request({"type": "http", "headers": [], "client": ("1.2.3.4", 1)})
+        assert run(limit.check_request(request)) == (True, 0)
+
+
+class TestClientKey:
+    """get_trusted_client_ip: limits must not be keyed on client-chosen headers"""
+
+    def test_proxy_written_hop(self, monkeypatch):
+        monkeypatch.setattr(server, "TRUSTED_PROXY_HOPS", 1)
+        assert server.get_trusted_client_ip(make_request(forwarded_for="203.0.113.5")) == "203.0.113.5"
+
+    def test_client_supplied_entries_ignored(self, monkeypatch):
+        monkeypatch.setattr(server, "TRUSTED_PROXY_HOPS", 1)
+        spoofed = make_request(forwarded_for="10.9.8.7, 203.0.113.5")
+        assert server.get_trusted_client_ip(spoofed) == "203.0.113.5"
+
+    def test_two_proxies(self, monkeypatch):
+        monkeypatch.setattr(server, "TRUSTED_PROXY_HOPS", 2)
+        request = make_request(forwarded_for="1.1.1.1, 203.0.113.5, 10.0.0.2")
+        assert server.get_trusted_client_ip(request) == "203.0.113.5"
+
+    def test_bypassed_proxy_uses_peer(self, monkeypatch):
+        monkeypatch.setattr(server, "TRUSTED_PROXY_HOPS", 2)
+        request = make_request(peer="198.51.100.4", forwarded_for="203.0.113.5")
+        assert server.get_trusted_client_ip(request) == "198.51.100.4"
+
+    def test_no_trusted_proxy_uses_peer(self, monkeypatch):
+        monkeypatch.setattr(server, "TRUSTED_PROXY_HOPS", 0)
+        request = make_request(peer="198.51.100.4", forwarded_for="203.0.113.5")
+        assert server.get_trusted_client_ip(request) == "198.51.100.4"
+
+    def test_rotating_forwarded_for_does_not_bypass(self, backend, clock, monkeypatch):
+        monkeypatch.setattr(server, "TRUSTED_PROXY_HOPS", 1)
+        limit = RateLimit("unit", 2, 60, backend="memory")
+        results = [
+            run(limit.check_request(make_request(forwarded_for=f"10.0.0.{i}, 203.0.113.5")))[0]
+            for i in range(3)
+        ]
+        assert results == [True, True, False]
+
+
+class TestPasswordLimits:
+    """forgot-password and reset-password draw from separate buckets"""
+
+    @staticmethod
+    def limits_of(path):
+        route = next(r for r in server.app.routes if getattr(r, "path", None) == path)
+        return [d.dependency for d in route.dependencies if isinstance(d.dependency, RateLimit)]
+
+    def test_separate_instances(self):
+        forgot = self.limits_of("/api/auth/forgot-password")
+        reset = self.limits_of("/api/auth/reset-password")
+        assert forgot == [server.FORGOT_PASSWORD_RATE_LIMIT]
+        assert reset == [server.RESET_PASSWORD_RATE_LIMIT]
+        assert forgot[0].name != reset[0].name
+
+    def test_forgot_requests_do_not_block_reset(self, backend, clock):
+        def in_memory(limit):
+            return RateLimit(limit.name, limit.limit, limit.window_seconds, limit.algorithm, backend="memory")
+        forgot = in_memory(server.FORGOT_PASSWORD_RATE_LIMIT)
+        reset = in_memory(server.RESET_PASSWORD_RATE_LIMIT)
+        while run(forgot.check("ip"))[0]:
+            pass
+        assert run(reset.check("ip"))[0] is True
@@ -0,0 +1,181 @@
+"""
+Unit tests for the slug routing table and the caches it invalidates
+Tests: change log sync between workers, trusted misses, full reload on gaps,
+public page cache, cross-worker invalidation from admin actions.
+Runs against mongomock_motor (skipped when not installed).
+"""
+import asyncio
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+import server
+
+ADMIN = {"id": "admin", "email": "admin@example.com", "role": "owner"}
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def page_doc(page_id, slug, user_id="u1", status="active", version=0):
+    return {"id": page_id, "slug": slug, "user_id": user_id, "status": status, "version": version, "views": 0}
+
+
+async def other_worker_change(db, page_ids=(), subdomains=()):
+    """What publish_routing_change() leaves in the database when another worker calls it"""
+    result = await db.app_settings.find_one_and_update(
+        {"key": "routing_epoch"}, {"$inc": {"value": 1}}, upsert=True, return_document=True
+    )
+    await db.routing_changes.insert_one({
+        "seq": result["value"],
+        "page_ids": list(page_ids),
+        "subdomains": list(subdomains),
+        "expires_at": datetime.now(timezone.utc) + timedelta(hours=1),
+    })
+
+
+@pytest.fixture
+def routing(db, monkeypatch):
+    """Seeded database plus a loaded routing table; counts full reloads"""
+    run(db.pages.insert_one(page_doc("p1", "artist")))
+    run(db.links.insert_one({"id": "l1", "page_id": "p1", "platform": "spotify", "url": "https://x", "active": True, "order": 0}))
+    run(db.subdomains.insert_one({"id": "s1", "subdomain": "band", "user_id": "u1", "is_active": True}))
+    run(server.load_routing_table())
+
+    reloads = []
+    load = server.load_routing_table
+
+    async def counted_load():
+        reloads.append(1)
+        await load()
+
+    monkeypatch.setattr(server, "load_routing_table", counted_load)
+    return reloads
+
+
+class TestRoutingSync:
+    """Changes made by other workers"""
+
+    def test_trusted_miss_does_not_query(self, db, routing):
+        run(db.pages.insert_one(page_doc("p2", "fresh")))
+        # Not in the table yet: the miss is trusted until the change log is applied
+        assert run(server.lookup_slug_route("fresh")) is None
+        run(other_worker_change(db, page_ids=["p2"]))
+        run(server.sync_routing_table())
+        assert run(server.lookup_slug_route("fresh"))["page_id"] == "p2"
+        assert run(server.lookup_page_slug("p2")) == "fresh"
+        assert routing == []
+
+    def test_rename_and_delete_applied_incrementally(self, db, routing):
+        run(db.pages.update_one({"id": "p1"}, {"$set": {"slug": "renamed", "version": 1}}))
+        run(other_worker_change(db, page_ids=["p1"]))
+        run(server.sync_routing_table())
+        assert run(server.lookup_slug_route("artist")) is None
+        assert run(server.lookup_slug_route("renamed"))["version"] == 1
+
+        run(db.pages.delete_one({"id": "p1"}))
+        run(other_worker_change(db, page_ids=["p1"]))
+        run(server.sync_routing_table())
+        assert run(server.lookup_page_slug("p1")) is None
+        assert server._slug_routes == {}
+        assert routing == []
+
+    def test_slug_reused_by_another_page(self, db, routing):
+        # p1 gives up its slug and p2 takes it, applied in one sync
+        run(db.pages.update_one({"id": "p1"}, {"$set": {"slug": "old-artist"}}))
+        run(db.pages.insert_one(page_doc("p2", "artist", user_id="u2")))
+        run(other_worker_change(db, page_ids=["p2"]))
+        run(other_worker_change(db, page_ids=["p1"]))
+        run(server.sync_routing_table())
+        assert run(server.lookup_slug_route("artist"))["page_id"] == "p2"
+        assert run(server.lookup_slug_route("old-artist"))["page_id"] == "p1"
+
+    def test_own_change_is_not_reapplied(self, db, routing):
+        run(server.set_page_route(page_doc("p3", "mine")))
+        epoch = server._routing_state["epoch"]
+        run(server.sync_routing_table())
+        assert server._routing_state["epoch"] == epoch
+        assert run(server.lookup_slug_route("mine"))["page_id"] == "p3"
+
+    def test_gap_waits_one_round_then_reloads(self, db, routing):
+        # Epoch bumped, change log entry not written (yet)
+        run(db.app_settings.update_one({"key": "routing_epoch"}, {"$inc": {"value": 1}}, upsert=True))
+        run(db.pages.insert_one(page_doc("p2", "later")))
+        run(other_worker_change(db, page_ids=["p2"]))
+        run(server.sync_routing_table())
+        assert routing == []
+        run(server.sync_routing_table())
+        assert routing == [1]
+        assert run(server.lookup_slug_route("later"))["page_id"] == "p2"
+
+    def test_stale_table_falls_back_to_database(self, db, routing, monkeypatch):
+        run(db.pages.insert_one(page_doc("p2", "fresh")))
+        monkeypatch.setitem(server._routing_state, "synced_at", server.time.monotonic() - server.ROUTING_STALE_SECONDS - 1)
+        assert run(server.lookup_slug_route("fresh"))["page_id"] == "p2"
+        assert server.subdomain_may_exist("unknown")
+
+
+class TestSubdomainInvalidation:
+    """Subdomain routes and the resolution cache across workers"""
+
+    def test_disabled_elsewhere_drops_cached_resolution(self, db, routing):
+        entry = run(server.resolve_subdomain_owner("band"))
+        assert entry["subdomain"]["is_active"] is True
+
+        run(db.subdomains.update_one({"subdomain": "band"}, {"$set": {"is_active": False}}))
+        run(other_worker_change(db, subdomains=["band"]))
+        run(server.sync_routing_table())
+        assert run(server.resolve_subdomain_owner("band"))["subdomain"]["is_active"] is False
+
+    def test_deleted_elsewhere_is_rejected(self, db, routing):
+        run(db.subdomains.delete_one({"subdomain": "band"}))
+        run(other_worker_change(db, subdomains=["band"]))
+        run(server.sync_routing_table())
+        assert not server.subdomain_may_exist("band")
+
+    def test_toggle_publishes_subdomain(self, db, routing):
+        run(server.admin_toggle_subdomain("s1", server.SubdomainUpdate(is_active=False), ADMIN))
+        change = run(db.routing_changes.find_one({}, sort=[("seq", -1)]))
+        assert change["subdomains"] == ["band"]
+
+    def test_ban_publishes_pages_and_subdomains(self, db, routing):
+        run(db.users.insert_one({"id": "u1", "email": "u1@example.com", "role": "user"}))
+        run(server.admin_ban_user("u1", server.UserBanUpdate(is_banned=True), ADMIN))
+        change = run(db.routing_changes.find_one({}, sort=[("seq", -1)]))
+        assert change["page_ids"] == ["p1"]
+        assert change["subdomains"] == ["band"]
+
+
+class TestPublicPageCache:
+    """/artist/{slug} content cache"""
+
+    def test_served_from_cache(self, db, routing):
+        first = run(server.get_public_page("artist"))
+        run(db.pages.update_one({"id": "p1"}, {"$set": {"title": "direct write"}}))
+        second = run(server.get_public_page("artist"))
+        assert [link["id"] for link in second["links"]] == ["l1"]
+        assert "title" not in second and first["id"] == second["id"]
+
+    def test_link_change_invalidates_here_and_elsewhere(self, db, routing):
+        run(server.get_public_page("artist"))
+        run(db.links.update_one({"id": "l1"}, {"$set": {"active": False}}))
+        run(server.publish_page_content_change("p1"))
+        assert run(server.get_public_page("artist"))["links"] == []
+        change = run(db.routing_changes.find_one({}, sort=[("seq", -1)]))
+        assert change["page_ids"] == ["p1"]
+
+    def test_change_from_other_worker_invalidates(self, db, routing):
+        run(server.get_public_page("artist"))
+        run(db.pages.update_one({"id": "p1"}, {"$set": {"title": "New title", "version": 1}}))
+        run(other_worker_change(db, page_ids=["p1"]))
+        run(server.sync_routing_table())
+        assert run(server.get_public_page("artist"))["title"] == "New title"
+
+    def test_inactive_page_is_not_served(self, db, routing):
+        run(db.pages.update_one({"id": "p1"}, {"$set": {"status": "inactive", "version": 1}}))
+        run(other_worker_change(db, page_ids=["p1"]))
+        run(server.sync_routing_table())
+        with pytest.raises(server.HTTPException) as exc:
+            run(server.get_public_page("artist"))
+        assert exc.value.status_code == 404
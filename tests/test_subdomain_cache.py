@@ -0,0 +1,108 @@
+"""
+Unit tests for the subdomain resolution cache
+Tests: positive/negative entries, TTL, size bound, invalidation by subdomain
+and by user, on this worker and through the change log on the others.
+Runs against mongomock_motor (skipped when not installed).
+"""
+import asyncio
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+import server
+
+ADMIN = {"id": "admin", "email": "admin@example.com", "role": "owner"}
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(server.time, "monotonic", fake)
+    return fake
+
+
+@pytest.fixture
+def seeded(db, clock):
+    run(db.users.insert_one({"id": "u1", "email": "u1@example.com", "username": "artist", "plan": "free", "role": "user"}))
+    run(db.subdomains.insert_one({"id": "s1", "subdomain": "band", "user_id": "u1", "is_active": True}))
+    run(server.load_routing_table())
+
+
+async def other_worker_user_change(db, user_id):
+    """What invalidate_user_caches() leaves in the database when another worker calls it"""
+    result = await db.app_settings.find_one_and_update(
+        {"key": "routing_epoch"}, {"$inc": {"value": 1}}, upsert=True, return_document=True
+    )
+    await db.routing_changes.insert_one({
+        "seq": result["value"], "page_ids": [], "subdomains": [], "user_ids": [user_id],
+        "expires_at": datetime.now(timezone.utc) + timedelta(hours=1),
+    })
+
+
+class TestResolution:
+    """resolve_subdomain_owner caching"""
+
+    def test_positive_entry_cached_until_ttl(self, db, seeded, clock):
+        assert run(server.resolve_subdomain_owner("band"))["user"]["plan"] == "free"
+        run(db.users.update_one({"id": "u1"}, {"$set": {"plan": "pro"}}))
+        assert run(server.resolve_subdomain_owner("band"))["user"]["plan"] == "free"
+        clock.now += server.SUBDOMAIN_CACHE_TTL_SECONDS + 1
+        assert run(server.resolve_subdomain_owner("band"))["user"]["plan"] == "pro"
+
+    def test_unknown_subdomain_cached_as_negative(self, db, seeded, clock):
+        entry = run(server.resolve_subdomain_owner("nobody"))
+        assert entry["subdomain"] is None and entry["user"] is None
+        assert server._subdomain_cache["nobody"]["expires"] == clock.now + server.SUBDOMAIN_NEGATIVE_TTL_SECONDS
+
+    def test_size_bound_evicts_least_recent(self, db, seeded, monkeypatch):
+        monkeypatch.setattr(server, "SUBDOMAIN_CACHE_MAX_ENTRIES", 2)
+        for name in ("a", "b", "band", "c"):
+            run(server.resolve_subdomain_owner(name))
+        assert list(server._subdomain_cache) == ["band", "c"]
+
+    def test_invalidate_by_subdomain(self, db, seeded):
+        run(server.resolve_subdomain_owner("band"))
+        server.invalidate_subdomain_cache(subdomain="band")
+        assert "band" not in server._subdomain_cache
+
+    def test_invalidate_by_user(self, db, seeded):
+        run(server.resolve_subdomain_owner("band"))
+        run(server.resolve_subdomain_owner("nobody"))
+        server.invalidate_subdomain_cache(user_id="u1")
+        assert list(server._subdomain_cache) == ["nobody"]
+
+
+class TestUserChangesAcrossWorkers:
+    """User-keyed invalidation goes through the routing change log"""
+
+    def test_plan_change_is_published(self, db, seeded):
+        run(server.resolve_subdomain_owner("band"))
+        run(server.admin_update_user_plan("u1", server.UserPlanUpdate(plan="pro"), ADMIN))
+        assert "band" not in server._subdomain_cache
+        change = run(db.routing_changes.find_one({}, sort=[("seq", -1)]))
+        assert change["user_ids"] == ["u1"]
+
+    def test_profile_change_is_published(self, db, seeded):
+        user = run(db.users.find_one({"id": "u1"}, {"_id": 0}))
+        run(server.update_profile(server.UpdateProfileRequest(username="renamed"), user))
+        change = run(db.routing_changes.find_one({}, sort=[("seq", -1)]))
+        assert change["user_ids"] == ["u1"]
+
+    def test_other_worker_change_drops_cached_owner(self, db, seeded):
+        assert run(server.resolve_subdomain_owner("band"))["user"]["plan"] == "free"
+        run(db.users.update_one({"id": "u1"}, {"$set": {"plan": "pro"}}))
+        run(other_worker_user_change(db, "u1"))
+        run(server.sync_routing_table())
+        assert run(server.resolve_subdomain_owner("band"))["user"]["plan"] == "pro"
@@ -0,0 +1,141 @@
+"""
+Unit tests for the system metrics rollups
+Tests: minute rollups shared by workers, hour rollups rebuilt from the stored
+1m rollups (delay, workers that restarted across the hour, late minutes,
+expiring minutes), the sampler loop.
+Runs against mongomock_motor (skipped when not installed).
+"""
+import asyncio
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+import server
+
+HOUR = datetime(2024, 3, 1, 10, tzinfo=timezone.utc)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def sample(timestamp, cpu=10.0, rss=100.0, lag=1.0, sent=0, recv=0):
+    return {
+        "timestamp": timestamp,
+        "cpu": {"percent": cpu, "count": 2, "load_1m": 0.5, "load_5m": 0.4, "load_15m": 0.3},
+        "memory": {"total_gb": 4.0, "used_gb": 1.0, "percent": 25.0},
+        "disk": {"total_gb": 50.0, "used_gb": 10.0, "percent": 20.0},
+        "network": {"bytes_sent": sent, "bytes_recv": recv},
+        "boot_time": 0,
+        "process": {"pid": 1, "cpu_percent": cpu, "rss_mb": rss, "threads": 4,
+                    "loop_lag_ms": lag, "loop_lag_max_ms": lag},
+    }
+
+
+async def write_minutes(hour, minutes, **kwargs):
+    for minute in minutes:
+        start = hour + timedelta(minutes=minute)
+        await server.write_minute_rollup(start, [sample(start, **kwargs), sample(start + timedelta(seconds=50), **kwargs)])
+
+
+async def hour_rollups():
+    return await server.db.system_metrics.find({"resolution": "1h"}).sort("timestamp", 1).to_list(None)
+
+
+class TestMinuteRollup:
+    """build_minute_rollup / write_minute_rollup"""
+
+    def test_condenses_samples(self):
+        start = HOUR
+        host, worker = server.build_minute_rollup([
+            sample(start, cpu=10, sent=0, recv=0),
+            sample(start + timedelta(seconds=10), cpu=30, sent=10240, recv=20480, lag=5),
+        ])
+        assert host["cpu"] == {"percent_avg": 20.0, "percent_max": 30, "load_1m": 0.5}
+        assert host["network"] == {"sent_kbps": 1.0, "recv_kbps": 2.0}
+        assert worker["cpu_percent_avg"] == 20.0 and worker["loop_lag_ms_max"] == 5
+
+    def test_workers_share_the_minute(self, db, monkeypatch):
+        run(write_minutes(HOUR, [0], cpu=10))
+        monkeypatch.setattr(server.os, "getpid", lambda: 424242)
+        run(write_minutes(HOUR, [0], cpu=90))
+        docs = run(db.system_metrics.find({"resolution": "1m"}).to_list(None))
+        assert len(docs) == 1
+        assert docs[0]["cpu"]["percent_avg"] == 10.0  # host stats from the first writer
+        assert len(docs[0]["workers"]) == 2
+
+
+class TestHourRollups:
+    """write_missing_hour_rollups"""
+
+    def test_waits_for_the_delay(self, db):
+        run(write_minutes(HOUR, range(60)))
+        just_after = HOUR + timedelta(hours=1, minutes=server.SYSTEM_METRICS_HOUR_ROLLUP_DELAY_MINUTES - 1)
+        assert run(server.write_missing_hour_rollups(just_after)) == 0
+        assert run(server.write_missing_hour_rollups(just_after + timedelta(minutes=1))) == 1
+        rollup = run(hour_rollups())[0]
+        assert rollup["_id"] == f"1h:{HOUR.isoformat()}"
+        assert rollup["minutes"] == 60
+
+    def test_hours_nobody_ran_across_are_caught_up(self, db):
+        # Workers ran 10:20-10:40 and 12:05-12:30, nothing at the hour boundaries
+        run(write_minutes(HOUR, range(20, 40)))
+        run(write_minutes(HOUR + timedelta(hours=2), range(5, 30)))
+        assert run(server.write_missing_hour_rollups(HOUR + timedelta(hours=3, minutes=10))) == 2
+        rollups = run(hour_rollups())
+        assert [r["minutes"] for r in rollups] == [20, 25]
+        assert run(server.write_missing_hour_rollups(HOUR + timedelta(hours=3, minutes=11))) == 0
+
+    def test_current_hour_is_left_alone(self, db):
+        run(write_minutes(HOUR, range(30)))
+        assert run(server.write_missing_hour_rollups(HOUR + timedelta(minutes=40))) == 0
+        assert run(hour_rollups()) == []
+
+    def test_rebuilt_when_more_minutes_arrive(self, db):
+        run(write_minutes(HOUR, range(30)))
+        run(server.write_missing_hour_rollups(HOUR + timedelta(hours=1, minutes=10)))
+        run(write_minutes(HOUR, range(30, 60), cpu=50))
+        assert run(server.write_missing_hour_rollups(HOUR + timedelta(hours=1, minutes=11))) == 1
+        rollup = run(hour_rollups())[0]
+        assert rollup["minutes"] == 60
+        assert rollup["cpu"]["percent_max"] == 50
+
+    def test_expiring_minutes_do_not_shrink_the_rollup(self, db):
+        run(write_minutes(HOUR, range(60)))
+        run(server.write_missing_hour_rollups(HOUR + timedelta(hours=1, minutes=10)))
+        run(db.system_metrics.delete_many({"resolution": "1m", "timestamp": {"$lt": HOUR + timedelta(minutes=30)}}))
+        assert run(server.write_missing_hour_rollups(HOUR + timedelta(days=1))) == 0
+        assert run(hour_rollups())[0]["minutes"] == 60
+
+    def test_worker_stats_from_every_worker(self, db, monkeypatch):
+        run(write_minutes(HOUR, range(2), rss=100, lag=1))
+        monkeypatch.setattr(server.os, "getpid", lambda: 424242)
+        run(write_minutes(HOUR, range(2), rss=300, lag=9))
+        run(server.write_missing_hour_rollups(HOUR + timedelta(hours=1, minutes=10)))
+        summary = run(hour_rollups())[0]["workers_summary"]
+        assert summary == {"rss_mb_max": 300, "loop_lag_ms_avg": 5.0, "loop_lag_ms_max": 9}
+
+
+class TestSampler:
+    """system_metrics_sampler loop"""
+
+    def test_writes_minutes_and_catches_up_on_start(self, db, monkeypatch):
+        run(write_minutes(HOUR, range(10)))  # left by a previous run of the service
+        start = HOUR + timedelta(hours=1, minutes=20, seconds=30)
+        timestamps = iter([start + timedelta(seconds=10 * i) for i in range(5)])
+
+        async def fake_sample():
+            return sample(next(timestamps))
+
+        async def scenario():
+            monkeypatch.setattr(server, "take_system_sample", fake_sample)
+            monkeypatch.setattr(server, "SYSTEM_METRICS_INTERVAL_SECONDS", 0)
+            task = asyncio.ensure_future(server.system_metrics_sampler())
+            for _ in range(50):
+                await asyncio.sleep(0)
+            task.cancel()
+            return await db.system_metrics.find({}, {"_id": 1}).to_list(None)
+
+        ids = {doc["_id"] for doc in run(scenario())}
+        assert f"1h:{HOUR.isoformat()}" in ids
+        assert f"1m:{(start.replace(second=0)).isoformat()}" in ids
@@ -0,0 +1,150 @@
+"""
+Unit tests for the tracking ingestion filter
+Tests: RotatingBloomFilter windows, crawler detection, should_record_event
+"""
+import pytest
+from starlette.requests import Request
+
+import server
+from server import RotatingBloomFilter
+
+BROWSER_UA = "Mozilla/5.0 (Linux; Android 13; CUBOT KingKong) AppleWebKit/537.36 Chrome/120.0 Mobile Safari/537.36"
+
+
+def make_request(user_agent=BROWSER_UA, ip="203.0.113.7", **headers):
+    raw = [(b"user-agent", user_agent.encode())] if user_agent is not None else []
+    raw += [(name.replace("_", "-").lower().encode(), value.encode()) for name, value in headers.items()]
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": raw, "client": (ip, 40000)})
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(server.time, "monotonic", fake)
+    return fake
+
+
+class TestRotatingBloomFilter:
+    """Time-windowed repeat detection"""
+
+    def test_repeat_within_window(self, clock):
+        bloom = RotatingBloomFilter(1 << 16, 4, 30)
+        assert bloom.seen_or_add("a") is False
+        assert bloom.seen_or_add("a") is True
+        assert bloom.seen_or_add("b") is False
+
+    def test_remembered_for_one_more_window(self, clock):
+        bloom = RotatingBloomFilter(1 << 16, 4, 30)
+        bloom.seen_or_add("a")
+        clock.now += 31
+        assert bloom.seen_or_add("a") is True  # found in the previous generation
+
+    def test_forgotten_after_two_windows(self, clock):
+        bloom = RotatingBloomFilter(1 << 16, 4, 30)
+        bloom.seen_or_add("a")
+        clock.now += 61
+        assert bloom.seen_or_add("a") is False
+
+    def test_forgotten_after_two_rotations(self, clock):
+        bloom = RotatingBloomFilter(1 << 16, 4, 30)
+        bloom.seen_or_add("a")
+        clock.now += 31
+        bloom.seen_or_add("b")
+        clock.now += 31
+        assert bloom.seen_or_add("a") is False
+
+    def test_false_positive_rate(self, clock):
+        bloom = RotatingBloomFilter(1 << 16, 4, 30)
+        for i in range(2000):
+            bloom.seen_or_add(f"key{i}")
+        false_positives = sum(bloom.seen_or_add(f"other{i}") for i in range(2000))
+        assert false_positives < 20
+
+
+class TestCrawlerDetection:
+    """is_tracking_crawler user agent matching"""
+
+    @pytest.mark.parametrize("user_agent", [
+        "",
+        "Googlebot/2.1 (+http://www.google.com/bot.html)",
+        "Mozilla/5.0 (compatible; YandexBot/3.0; +http://yandex.com/bots)",
+        "TelegramBot (like TwitterBot)",
+        "Slackbot-LinkExpanding 1.0 (+https://api.slack.com/robots)",
+        "facebookexternalhit/1.1",
+        "WhatsApp/2.23.20.0",
+        "python-requests/2.31.0",
+        "curl/8.4.0",
+        "Mozilla/5.0 (X11; Linux x86_64) HeadlessChrome/120.0.0.0 Safari/537.36",
+    ])
+    def test_crawlers(self, user_agent):
+        assert server.is_tracking_crawler(user_agent)
+
+    @pytest.mark.parametrize("user_agent", [
+        BROWSER_UA,
+        "Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) AppleWebKit/605.1.15 Mobile/15E148 Instagram 300.0",
+        "Mozilla/5.0 (Linux; Android 12) AppleWebKit/537.36 Chrome/119.0 Mobile Safari/537.36 Viber/20.5",
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 Chrome/120.0 YaBrowser/24.1 Safari/537.36",
+    ])
+    def test_visitors(self, user_agent):
+        assert not server.is_tracking_crawler(user_agent)
+
+
+class TestShouldRecordEvent:
+    """Decision and per-reason counters"""
+
+    @pytest.fixture(autouse=True)
+    def fresh_state(self, monkeypatch, clock):
+        monkeypatch.setattr(server, "_tracking_dedup_filter", RotatingBloomFilter(1 << 16, 4, 30))
+        server._tracking_event_counts.clear()
+        yield
+        server._tracking_event_counts.clear()
+
+    def test_accepts_then_drops_repeat(self):
+        assert server.should_record_event("click", "l1", make_request()) is True
+        assert server.should_record_event("click", "l1", make_request()) is False
+        assert server._tracking_event_counts == {"click:accepted": 1, "click:duplicate": 1}
+
+    def test_repeat_key_is_per_ip_event_and_target(self):
+        assert server.should_record_event("click", "l1", make_request())
+        assert server.should_record_event("click", "l2", make_request())
+        assert server.should_record_event("view", "l1", make_request())
+        assert server.should_record_event("click", "l1", make_request(ip="198.51.100.1"))
+
+    def test_forwarded_ip_is_used(self, monkeypatch):
+        monkeypatch.setattr(server, "TRUSTED_PROXY_HOPS", 1)
+        assert server.should_record_event("click", "l1", make_request(ip="10.0.0.1", x_forwarded_for="198.51.100.9"))
+        assert not server.should_record_event("click", "l1", make_request(ip="10.0.0.2", x_forwarded_for="198.51.100.9"))
+
+    def test_spoofed_forwarded_for_is_still_a_repeat(self, monkeypatch):
+        monkeypatch.setattr(server, "TRUSTED_PROXY_HOPS", 1)
+        first = make_request(x_forwarded_for="1.1.1.1, 198.51.100.9")
+        second = make_request(x_forwarded_for="2.2.2.2, 198.51.100.9")
+        assert server.should_record_event("click", "l1", first)
+        assert not server.should_record_event("click", "l1", second)
+
+    def test_prefetch_dropped(self):
+        assert not server.should_record_event("view", "p1", make_request(sec_purpose="prefetch;prerender"))
+        assert not server.should_record_event("view", "p1", make_request(purpose="prefetch"))
+        assert server._tracking_event_counts == {"view:prefetch": 2}
+
+    def test_crawler_dropped(self):
+        assert not server.should_record_event("view", "p1", make_request("Googlebot/2.1 (+http://www.google.com/bot.html)"))
+        assert not server.should_record_event("view", "p1", make_request(None))
+        assert server._tracking_event_counts == {"view:bot": 2}
+
+    def test_dropped_hit_does_not_mark_visitor(self):
+        server.should_record_event("view", "p1", make_request(sec_purpose="prefetch"))
+        assert server.should_record_event("view", "p1", make_request())
+
+    def test_internal_calls_without_request(self):
+        assert server.should_record_event("share", "p1", None)
+        assert server.should_record_event("share", "p1", None)
+        assert server._tracking_event_counts == {"share:accepted": 2}